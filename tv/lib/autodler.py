@@ -27,10 +27,13 @@
 # this exception statement from your version. If you delete this exception
 # statement from all source files in the program, then also delete it here.
 
+import heapq
+
 from miro import app
 from miro import models
 from miro import prefs
 from miro import eventloop
+from miro.database import ObjectNotFoundError
 from datetime import datetime
 
 def _key_for_feed(feed):
@@ -45,6 +48,16 @@ def _key_for_feed(feed):
     return feed.origURL
 
 class Downloader:
+    """Starts pending downloads when there are free download slots.
+
+    Pending items are kept in a heap for each feed, ordered so that the
+    newest item comes first.  The feeds themselves are kept in a heap ordered
+    by (running downloads, last time we started a download), so that filling
+    a download slot doesn't require looking at every feed and item.
+
+    Heap entries are never removed directly.  Instead, we track the current
+    entry for each item/feed and skip any others when they come up.
+    """
     def __init__(self, is_auto):
         self.dc = None
         self.paused = False
@@ -53,6 +66,14 @@ class Downloader:
         self.feed_pending_count = {}
         self.feed_running_count = {}
         self.feed_time = {}
+        # maps item ids to their current entry in self.feed_pending
+        self.pending_entries = {}
+        # maps feed keys to a heap of (release date key, item id, feed key)
+        self.feed_pending = {}
+        # heap of (running count, last start time, feed key)
+        self.feed_queue = []
+        # maps feed keys to their current entry in self.feed_queue
+        self.feed_queue_entries = {}
         self.is_auto = is_auto
         if is_auto:
             pending_items = models.Item.auto_pending_view()
@@ -71,6 +92,7 @@ class Downloader:
         self.pending_items_tracker = pending_items.make_tracker()
         self.pending_items_tracker.connect('added', self.pending_on_add)
         self.pending_items_tracker.connect('removed', self.pending_on_remove)
+        self.pending_items_tracker.connect('changed', self.pending_on_change)
 
         self.running_items_tracker = running_items.make_tracker()
         self.running_items_tracker.connect('added', self.running_on_add)
@@ -98,39 +120,71 @@ class Downloader:
     def start_downloads_idle(self):
         if self.paused:
             return
-        last_count = 0
-        while (self.running_count < self.MAX
-               and self.pending_count > 0
-               and self.pending_count != last_count):
-            last_count = self.pending_count
-            candidate_feeds = []
-            for feed in models.Feed.make_view():
-                key = _key_for_feed(feed)
-                if self.is_auto:
-                    max_new = feed.get_max_new()
-                    if max_new != "unlimited":
-                        count = (self.feed_new_count.get(feed, 0) +
-                                self.feed_running_count.get(key, 0) +
-                                feed.num_unwatched())
-                        if count >= max_new:
-                            continue
-                if self.feed_pending_count.get(key, 0) <= 0:
-                    continue
-                candidate_feeds.append((feed,
-                                        self.feed_running_count.get(key, 0),
-                                        self.feed_time.get(feed, datetime.min)))
-            candidate_feeds.sort(key=lambda x: (x[1], x[2]))
-
-            for feed, count, dummy in candidate_feeds:
-                if self.is_auto:
-                    feed.start_auto_download()
-                else:
-                    feed.start_manual_download()
-                self.feed_time[feed] = datetime.now()
-                if self.running_count >= self.MAX:
-                    break
+        # feeds that we can't start a download for right now.  They get
+        # queued again once we're done.
+        skipped = []
+        while self.running_count < self.MAX and self.feed_queue:
+            entry = heapq.heappop(self.feed_queue)
+            key = entry[2]
+            if self.feed_queue_entries.get(key) is not entry:
+                continue
+            del self.feed_queue_entries[key]
+            item = self._next_pending_item(key)
+            if item is None:
+                continue
+            if self.is_auto and self._feed_is_full(item.get_feed(), key):
+                skipped.append(key)
+                continue
+            self.feed_time[key] = datetime.now()
+            item.download(autodl=self.is_auto)
+            if item.id in self.pending_entries:
+                # the download didn't start, don't try the feed again
+                # until next time
+                skipped.append(key)
+            else:
+                self._queue_feed(key)
+        for key in skipped:
+            self._queue_feed(key)
         self.dc = None
 
+    def _next_pending_item(self, key):
+        """Get the newest pending item for a feed key, or None."""
+        pending = self.feed_pending.get(key)
+        while pending:
+            entry = pending[0]
+            if self.pending_entries.get(entry[1]) is entry:
+                try:
+                    return models.Item.get_by_id(entry[1])
+                except ObjectNotFoundError:
+                    del self.pending_entries[entry[1]]
+            heapq.heappop(pending)
+        self.feed_pending.pop(key, None)
+        return None
+
+    def _feed_is_full(self, feed, key):
+        max_new = feed.get_max_new()
+        if max_new == "unlimited":
+            return False
+        count = (self.feed_new_count.get(feed, 0) +
+                self.feed_running_count.get(key, 0) +
+                feed.num_unwatched())
+        return count >= max_new
+
+    def _push_pending(self, key, obj):
+        # negate the release date so that the newest item sorts first
+        entry = (datetime.min - obj.get_pub_date_parsed(), obj.id, key)
+        self.pending_entries[obj.id] = entry
+        heapq.heappush(self.feed_pending.setdefault(key, []), entry)
+
+    def _queue_feed(self, key):
+        if self.feed_pending_count.get(key, 0) <= 0:
+            self.feed_queue_entries.pop(key, None)
+            return
+        entry = (self.feed_running_count.get(key, 0),
+                self.feed_time.get(key, datetime.min), key)
+        self.feed_queue_entries[key] = entry
+        heapq.heappush(self.feed_queue, entry)
+
     def start_downloads(self):
         if self.dc or self.paused:
             return
@@ -142,6 +196,8 @@ class Downloader:
         key = _key_for_feed(feed)
         self.pending_count = self.pending_count + 1
         self.feed_pending_count[key] = self.feed_pending_count.get(key, 0) + 1
+        self._push_pending(key, obj)
+        self._queue_feed(key)
         self.start_downloads()
 
     def pending_on_remove(self, tracker, obj):
@@ -149,18 +205,36 @@ class Downloader:
         key = _key_for_feed(feed)
         self.pending_count = self.pending_count - 1
         self.feed_pending_count[key] = self.feed_pending_count.get(key, 0) - 1
+        self.pending_entries.pop(obj.id, None)
+
+    def pending_on_change(self, tracker, obj):
+        entry = self.pending_entries.get(obj.id)
+        if entry is None:
+            return
+        key = _key_for_feed(obj.get_feed())
+        if (entry[0] != datetime.min - obj.get_pub_date_parsed() or
+                entry[2] != key):
+            if entry[2] != key:
+                self.feed_pending_count[entry[2]] -= 1
+                self.feed_pending_count[key] = (
+                        self.feed_pending_count.get(key, 0) + 1)
+            self._push_pending(key, obj)
+            if key not in self.feed_queue_entries:
+                self._queue_feed(key)
 
     def running_on_add(self, tracker, obj):
         feed = obj.get_feed()
         key = _key_for_feed(feed)
         self.running_count = self.running_count + 1
         self.feed_running_count[key] = self.feed_running_count.get(key, 0) + 1
+        self._queue_feed(key)
 
     def running_on_remove(self, tracker, obj):
         feed = obj.get_feed()
         key = _key_for_feed(feed)
         self.running_count = self.running_count - 1
         self.feed_running_count[key] = self.feed_running_count.get(key, 0) - 1
+        self._queue_feed(key)
         self.start_downloads()
 
     def new_on_add(self, tracker, obj):
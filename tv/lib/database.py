@@ -33,6 +33,7 @@ import threading
 
 from miro import app
 from miro import signals
+from miro import viewpredicate
 
 class DatabaseException(Exception):
     """Superclass for classes that subclass Exception and are all
@@ -85,6 +86,10 @@ class NotRootDBError(DatabaseStandardError):
     """
     pass
 
+# sqlite can only handle 999 variables in a statement.  When we need to pass
+# it a list of ids, we split the list into chunks this big.
+SQL_CHUNK_SIZE = 990
+
 class NoValue(object):
     """Used as a dummy value so that "None" can be treated as a valid
     value.
@@ -229,6 +234,9 @@ class ViewTrackerManager(object):
         self.table_to_tracker = {}
         # maps joined tables to trackers
         self.joined_table_to_tracker = {}
+        # maps (table_name, where, joins) to ViewPredicates.  Trackers
+        # created for the same kind of view share a single predicate.
+        self._predicates = {}
 
     def trackers_for_table(self, table_name):
         try:
@@ -237,6 +245,34 @@ class ViewTrackerManager(object):
             self.table_to_tracker[table_name] = set()
             return self.table_to_tracker[table_name]
 
+    def predicate_for_tracker(self, tracker):
+        """Get a ViewPredicate to check objects for a ViewTracker.
+
+        :returns: ViewPredicate or None if the tracker's where clause can't be
+            checked in memory.
+        """
+        if tracker.joins is not None:
+            join_key = tuple(sorted(tracker.joins.items()))
+        else:
+            join_key = None
+        key = (tracker.table_name, tracker.where, join_key)
+        try:
+            return self._predicates[key]
+        except KeyError:
+            pass
+        try:
+            predicate = viewpredicate.compile_predicate(tracker.table_name,
+                    tracker.where, tracker.joins)
+        except viewpredicate.UnsupportedSQL, e:
+            logging.debug("Can't check view in memory (%s): %s",
+                    e, tracker.where)
+            predicate = None
+        else:
+            if predicate.placeholder_count != len(tracker.values):
+                predicate = None
+        self._predicates[key] = predicate
+        return predicate
+
     def trackers_for_ddb_class(self, klass):
         return self.trackers_for_table(app.db.table_name(klass))
 
@@ -246,9 +282,14 @@ class ViewTrackerManager(object):
         for tracker in self.trackers_for_ddb_class(obj.__class__):
             tracker.object_changed(obj)
 
-    def bulk_update_view_trackers(self, table_name):
+    def bulk_update_view_trackers(self, table_name, objects):
+        """Update view trackers based on a list of changed objects.
+
+        Each tracker checks the objects in one batch and emits the
+        bulk-added/bulk-removed/bulk-changed signals if it's in bulk mode.
+        """
         for tracker in self.trackers_for_table(table_name):
-            tracker.check_all_objects()
+            tracker.check_objects(objects)
 
     def bulk_remove_from_view_trackers(self, table_name, objects):
         for tracker in self.trackers_for_table(table_name):
@@ -274,6 +315,7 @@ class ViewTracker(signals.SignalEmitter):
         self.bulk_mode = False
         self.current_ids = self._view_object_ids()
         vt_manager = app.view_tracker_manager
+        self.predicate = vt_manager.predicate_for_tracker(self)
         vt_manager.trackers_for_table(self.table_name).add(self)
 
     def unlink(self):
@@ -290,7 +332,22 @@ class ViewTracker(signals.SignalEmitter):
         self.bulk_mode = bulk_mode
 
     def _obj_in_view(self, obj):
-        """Check if a single object is in our view."""
+        """Check if a single object is in our view.
+
+        If possible, we check the object in memory using our ViewPredicate.
+        """
+        if self.predicate is not None:
+            if not app.db.id_alive(obj.id, obj.__class__):
+                # object was removed from the DB
+                return False
+            try:
+                return self.predicate.matches(obj, self.values)
+            except viewpredicate.NeedsSQL:
+                pass
+        return self._obj_in_view_sql(obj)
+
+    def _obj_in_view_sql(self, obj):
+        """Check if a single object is in our view using a SQL query."""
         where = '%s.id = ?' % (self.table_name,)
         if self.where:
             where += ' AND (%s)' % (self.where,)
@@ -299,6 +356,47 @@ class ViewTracker(signals.SignalEmitter):
         return app.db.query_count(self.table_name, where, values,
                 self.joins) > 0
 
+    def _objs_in_view(self, objects):
+        """Check which objects in a list are in our view.
+
+        This is the batch version of _obj_in_view().  Objects that we can't
+        check in memory are checked with a single "id IN (...)" query.
+
+        :returns: set of object ids that are in our view
+        """
+        in_view = set()
+        if self.predicate is not None:
+            need_sql = []
+            for obj in objects:
+                if not app.db.id_alive(obj.id, obj.__class__):
+                    continue
+                try:
+                    if self.predicate.matches(obj, self.values):
+                        in_view.add(obj.id)
+                except viewpredicate.NeedsSQL:
+                    need_sql.append(obj)
+        else:
+            need_sql = objects
+        if need_sql:
+            in_view.update(self._obj_ids_in_view_sql(
+                [obj.id for obj in need_sql]))
+        return in_view
+
+    def _obj_ids_in_view_sql(self, id_list):
+        """Check which ids in a list are in our view using SQL."""
+        in_view = set()
+        # sqlite can only handle so many variables at once, send it chunks of
+        # ids
+        for start in xrange(0, len(id_list), SQL_CHUNK_SIZE):
+            id_chunk = tuple(id_list[start:start+SQL_CHUNK_SIZE])
+            where = '%s.id IN (%s)' % (self.table_name,
+                    ', '.join('?' for i in xrange(len(id_chunk))))
+            if self.where:
+                where += ' AND (%s)' % (self.where,)
+            in_view.update(app.db.query_ids(self.table_name, where,
+                id_chunk + self.values, joins=self.joins))
+        return in_view
+
     def _view_object_ids(self):
         """Get all object ids in our view."""
         return set(app.db.query_ids(self.table_name,
@@ -329,7 +427,34 @@ class ViewTracker(signals.SignalEmitter):
         elif before and now:
             self.emit('changed', self.fetcher.fetch_obj_for_ddb_object(obj))
 
+    def check_objects(self, objects):
+        """Check a list of changed objects.
+
+        This works like calling check_object() for each object, but the
+        objects get checked in a single batch.
+        """
+        in_view = self._objs_in_view(objects)
+        added = []
+        removed = []
+        changed = []
+        for obj in objects:
+            before = (obj.id in self.current_ids)
+            now = (obj.id in in_view)
+            if before and not now:
+                self.current_ids.remove(obj.id)
+                removed.append(self.fetcher.fetch_obj_for_ddb_object(obj))
+            elif now and not before:
+                self.current_ids.add(obj.id)
+                added.append(self.fetcher.fetch_obj_for_ddb_object(obj))
+            elif before and now:
+                changed.append(self.fetcher.fetch_obj_for_ddb_object(obj))
+        self._emit_for_objects('removed', removed)
+        self._emit_for_objects('added', added)
+        self._emit_for_objects('changed', changed)
+
     def _emit_for_objects(self, signal, objects):
+        if not objects:
+            return
         if self.bulk_mode:
             self.emit('bulk-' + signal, objects)
         else:
@@ -370,6 +495,9 @@ class BulkSQLManager(object):
         self.active = False
         self.to_insert = {}
         self.to_remove = {}
+        # Journal of objects that called signal_change() while we were
+        # active.  Maps table names to dicts that map ids to objects.
+        self.to_change = {}
         self.pending_inserts = set()
         self.pending_removes = set()
 
@@ -404,20 +532,24 @@ class BulkSQLManager(object):
         for x in range(100):
             to_insert = self.to_insert
             to_remove = self.to_remove
+            to_change = self.to_change
             self.to_insert = {}
             self.to_remove = {}
+            self.to_change = {}
             self._commit_sql(to_insert, to_remove)
-            self._update_view_trackers(to_insert, to_remove)
-            if len(self.to_insert) == len(self.to_remove) == 0:
+            self._update_view_trackers(to_insert, to_remove, to_change)
+            if (len(self.to_insert) == len(self.to_remove) ==
+                    len(self.to_change) == 0):
                 break
             # inside _commit_sql() or _update_view_trackers(), we were
-            # asked to insert or remove more items, repeat the
+            # asked to insert, remove or change more items, repeat the
             # proccess again
         else:
             raise AssertionError("Called _commit_sql 100 times and still "
                     "have items to commit.  Are we in a circular loop?")
         self.to_insert = {}
         self.to_remove = {}
+        self.to_change = {}
         self.pending_inserts = set()
         self.pending_removes = set()
 
@@ -434,41 +566,23 @@ class BulkSQLManager(object):
             for obj in objects:
                 obj.removed_from_db()
 
-    def _update_view_trackers(self, to_insert, to_remove):
-        # figure out the total number of objects that have changed
-        changed_objs = set()
-        for table_name, objects in to_insert.items():
-            changed_objs.update(objects)
-        for table_name, objects in to_remove.items():
-            changed_objs.update(objects)
-        # Figure out which strategy is fastest based on the number of objects
-        # that have changed
-        if len(changed_objs) < 100:
-            self._update_view_trackers_by_object(changed_objs)
-        else:
-            self._update_view_trackers_by_table(to_insert, to_remove)
-
-    def _update_view_trackers_by_object(self, changed_objs):
-        """Update view trackers by checking each changed object.
-
-        This method is the fastest when there are not a lot of changed objects
-        """
-        for obj in changed_objs:
-            app.view_tracker_manager.update_view_trackers(obj)
-
+    def _update_view_trackers(self, to_insert, to_remove, to_change):
+        """Update view trackers for the objects in a batch.
 
-    def _update_view_trackers_by_table(self, to_insert, to_remove):
-        """Update view trackers by checking each table
-
-        This method is fastest when there are many changed objects
+        Each tracker checks all the inserted and changed objects for its table
+        at once, rather than once per object.
         """
-        for table_name in to_insert:
-            app.view_tracker_manager.bulk_update_view_trackers(table_name)
+        table_names = set(to_insert.keys() + to_change.keys())
+        for table_name in table_names:
+            objects = list(to_insert.get(table_name, []))
+            inserted_ids = set(obj.id for obj in objects)
+            for id_, obj in to_change.get(table_name, {}).items():
+                if id_ not in inserted_ids:
+                    objects.append(obj)
+            app.view_tracker_manager.bulk_update_view_trackers(table_name,
+                    objects)
 
         for table_name, objects in to_remove.items():
-            if table_name in to_insert:
-                # already updated the view above
-                continue
             app.view_tracker_manager.bulk_remove_from_view_trackers(
                 table_name, objects)
 
@@ -488,8 +602,23 @@ class BulkSQLManager(object):
     def will_remove(self, id_):
         return id_ in self.pending_removes
 
+    def add_change(self, obj):
+        """Record that an object changed while we were active.
+
+        The view trackers will be updated for the object when we commit.
+        """
+        table_name = app.db.table_name(obj.__class__)
+        try:
+            changes_for_table = self.to_change[table_name]
+        except KeyError:
+            changes_for_table = {}
+            self.to_change[table_name] = changes_for_table
+        changes_for_table[obj.id] = obj
+
     def add_remove(self, obj):
         table_name = app.db.table_name(obj.__class__)
+        if table_name in self.to_change:
+            self.to_change[table_name].pop(obj.id, None)
         if self.will_insert(obj.id):
             self.to_insert[table_name].remove(obj)
             self.pending_inserts.remove(obj.id)
@@ -608,8 +737,10 @@ class DDBObject(signals.SignalEmitter):
         return app.db.delete(cls, where, values)
 
     @classmethod
-    def select(cls, columns, where=None, values=None, convert=True):
-        return app.db.select(cls, columns, where, values, convert=convert)
+    def select(cls, columns, where=None, values=None, convert=True,
+            joins=None, group_by=None):
+        return app.db.select(cls, columns, where, values, joins=joins,
+                convert=convert, group_by=group_by)
 
     def setup_new(self):
         """Initialize a newly created object."""
@@ -718,7 +849,12 @@ class DDBObject(signals.SignalEmitter):
             return
         if needs_save:
             app.db.update_obj(self)
-        app.view_tracker_manager.update_view_trackers(self)
+        if app.bulk_sql_manager.active:
+            # Check the view trackers once for all the changes when
+            # BulkSQLManager.finish() is called.
+            app.bulk_sql_manager.add_change(self)
+        else:
+            app.view_tracker_manager.update_view_trackers(self)
 
     def on_signal_change(self):
         pass
@@ -3466,3 +3466,19 @@ def upgrade165(cursor):
     ]
     for n, t, c in indices:
         cursor.execute("CREATE INDEX %s ON %s (%s)" % (n, t, c))
+
+def upgrade166(cursor):
+    """Create the item_search_index table"""
+    cursor.execute("CREATE TABLE item_search_index"
+            "(id INTEGER PRIMARY KEY, ngrams TEXT)")
+
+def upgrade167(cursor):
+    """Add the stats column to item_info_cache"""
+    cursor.execute("ALTER TABLE item_info_cache ADD COLUMN stats BLOB")
+
+def upgrade168(cursor):
+    """Drop the item_search_index table.
+
+    Search terms are stored in item_info_cache now.
+    """
+    cursor.execute("DROP TABLE item_search_index")
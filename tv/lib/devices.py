@@ -37,8 +37,10 @@ import codecs
 import logging
 import os, os.path
 import re
+import threading
 import time
 import bisect
+from collections import deque
 try:
     from collections import Counter
 except ImportError:
@@ -67,7 +69,7 @@ from miro.download_utils import next_free_filename
 
 from miro.plat import resources
 from miro.plat.utils import (filename_to_unicode, unicode_to_filename,
-                             utf8_to_filename)
+                             utf8_to_filename, thread_body)
 
 
 # how much slower converting a file is, compared to copying
@@ -544,6 +546,11 @@ class DeviceSyncManager(object):
     """
     Represents a sync to a given device.
     """
+    # how many files we copy to the device at once
+    COPY_THREADS = 2
+    # how often we send DeviceSyncChanged messages, in seconds
+    SYNC_CHANGED_INTERVAL = 1.0
+
     def __init__(self, device):
         self.device = device
         self.device_info = self.device.info
@@ -559,7 +566,10 @@ class DeviceSyncManager(object):
         self.waiting = set()
         self.stopping = False
         self._change_timeout = None
-        self._copy_iter_running = False
+        # (info, final_path) waiting for a copy thread
+        self._copy_queue = deque()
+        self._copy_lock = threading.Lock()
+        self._copy_threads = 0
         self._info_to_conversion = {}
         self.started = False
 
@@ -953,54 +963,64 @@ class DeviceSyncManager(object):
         self.waiting.add(task.key)
 
     def copy_file(self, info, final_path):
-        if (info, final_path) in self.copying:
+        if final_path in self.copying:
             logging.warn('tried to copy %r twice', info)
             return
         file(final_path, 'w').close() # create the file so that future tries
                                       # will see it
         self.copying[final_path] = info
         self.total_size[info.id] = info.size
-        if not self._copy_iter_running:
-            self._copy_iter_running = True
-            eventloop.idle_iterate(self._copy_as_iter,
-                                   'copying files to device')
-
-    def _copy_as_iter(self):
-        while self.copying:
-            final_path, info = self.copying.popitem()
-            iterable = fileutil.copy_with_progress(info.video_path, final_path,
-                                                   block_size=128 * 1024)
-            try:
-                for count in iterable:
+        # make sure the key exists, the copy threads only update it
+        self.progress_size[info.id] = 0
+        with self._copy_lock:
+            self._copy_queue.append((info, final_path))
+            if self._copy_threads < self.COPY_THREADS:
+                self._copy_threads += 1
+                thread = threading.Thread(name='Device Sync Copy',
+                                          target=thread_body,
+                                          args=[self._copy_loop])
+                thread.setDaemon(True)
+                thread.start()
+        self._schedule_sync_changed()
+
+    def _copy_loop(self):
+        # Runs in a copy thread until there is nothing left to copy.  We only
+        # update progress_size here, _sync_changed_timeout() keeps sending it
+        # to the frontend while we copy.  This way the copy itself never
+        # waits for the event loop.
+        while True:
+            with self._copy_lock:
+                try:
+                    info, final_path = self._copy_queue.popleft()
+                except IndexError:
+                    self._copy_threads -= 1
+                    return
+            completed = False
+            if not self.stopping:
+                def progress_callback(count):
                     self.progress_size[info.id] += count
-                    if self.stopping:
-                        iterable.close()
-                        eventloop.add_idle(fileutil.delete,
-                                           "deleting canceled sync",
-                                           args=(final_path,))
-                        final_path = None
-                        break
-                    # let other stuff run
-                    self._schedule_sync_changed()
-                    yield
-            except IOError:
-                final_path = None
-            if final_path:
-                self._add_item(final_path, info)
-            # don't throw off the progress bar; we're done so pretend we got
-            # all the bytes
-            self.progress_size[info.id] = self.total_size[info.id]
-            self.finished += 1
-            self._check_finished()
-            if self.stopping:
-                break # no more copies
-            yield
-        for final_path in self.copying:
-            # canceled the sync, so remove the non-synced files
-            eventloop.add_idle(fileutil.delete,
-                               "deleting canceled sync",
-                               args=(final_path,))
-        self._copy_iter_running = False
+                    return self.stopping
+                try:
+                    completed = fileutil.copy_with_progress(
+                        info.video_path, final_path, progress_callback)
+                except (IOError, OSError), e:
+                    logging.warn('error copying %r to device: %s',
+                                 info.video_path, e)
+            eventloop.add_idle(self._copy_finished, 'device copy finished',
+                               args=(info, final_path, completed))
+
+    def _copy_finished(self, info, final_path, completed):
+        del self.copying[final_path]
+        if completed and not self.stopping:
+            self._add_item(final_path, info)
+        else:
+            # canceled or failed, so remove the partial file
+            fileutil.delete(final_path)
+        # don't throw off the progress bar; we're done so pretend we got
+        # all the bytes
+        self.progress_size[info.id] = self.total_size[info.id]
+        self.finished += 1
+        self._check_finished()
 
     def _conversion_changed_callback(self, conversion_manager, task):
         total = self.total_size[task.key]
@@ -1107,14 +1127,21 @@ class DeviceSyncManager(object):
     def _schedule_sync_changed(self):
         if not self._change_timeout:
             self._change_timeout = eventloop.add_timeout(
-                1.0,
-                self._send_sync_changed,
+                self.SYNC_CHANGED_INTERVAL,
+                self._sync_changed_timeout,
                 'sync changed update')
 
+    def _sync_changed_timeout(self):
+        self._change_timeout = None
+        self._send_sync_changed()
+        if self.copying and not self.stopping:
+            # nothing else tells us about copy progress, so keep sending
+            # updates until the copies finish
+            self._schedule_sync_changed()
+
     def _send_sync_changed(self):
         message = messages.DeviceSyncChanged(self)
         message.send_to_frontend()
-        self._change_timeout = None
 
     def _send_sync_finished(self):
         for handle in self.signal_handles:
@@ -204,13 +204,15 @@ class DownloaderBatchCommand(Command):
                 channel_name = args['channel_name']
                 url = args['url']
                 content_type = args['content_type']
-                download.start_download(url, dlid, content_type, channel_name)
+                priority = args['priority']
+                download.start_download(url, dlid, content_type, channel_name,
+                                        priority)
             elif cmd == self.RESTORE:
                 # Restoring a downloader doesn't actually change any state
                 # so don't reply.
                 mark_reply = False
                 downloader = args['downloader']
-                download.restore_downloader(downloader)
+                download.restore_downloader(downloader, args['priority'])
             else:
                 raise ValueError('unknown downloader batch command %s' % cmd)
         # Mark this so that the next time we run through the periodic update
@@ -28,8 +28,8 @@
 # statement from all source files in the program, then also delete it here.
 
 from miro.dl_daemon import command
+from miro.dl_daemon import protocol
 import os
-import cPickle
 from struct import pack, unpack, calcsize
 import tempfile
 from miro import app
@@ -139,6 +139,8 @@ class Daemon(ConnectionHandler):
         global LAST_DAEMON
         LAST_DAEMON = self
         self.size = 0
+        self.encoder = protocol.CommandEncoder()
+        self.decoder = protocol.CommandDecoder()
         self.states['ready'] = self.on_size
         self.states['command'] = self.on_command
         self.queued_commands = []
@@ -170,9 +172,9 @@ class Daemon(ConnectionHandler):
     def on_command(self):
         if self.buffer.length >= self.size:
             try:
-                comm = cPickle.loads(self.buffer.read(self.size))
-            except cPickle.UnpicklingError:
-                logging.exception("WARNING: error unpickling command.")
+                comm = self.decoder.decode(self.buffer.read(self.size))
+            except protocol.ProtocolError:
+                logging.exception("WARNING: error decoding command.")
             else:
                 self.process_command(comm)
             self.change_state('ready')
@@ -192,7 +194,7 @@ class Daemon(ConnectionHandler):
         if self.state == 'initializing':
             self.queued_commands.append((comm, callback))
         else:
-            raw = cPickle.dumps(comm, cPickle.HIGHEST_PROTOCOL)
+            raw = self.encoder.encode(comm)
             self.send_data(pack("I", len(raw)) + raw, callback)
 
 class DownloaderDaemon(Daemon):
@@ -254,6 +256,8 @@ class ControllerDaemon(Daemon):
             prefs.UPSTREAM_LIMIT_IN_KBS,
             prefs.LIMIT_DOWNSTREAM_BT,
             prefs.DOWNSTREAM_BT_LIMIT_IN_KBS,
+            prefs.LIMIT_DOWNSTREAM,
+            prefs.DOWNSTREAM_LIMIT_IN_KBS,
             prefs.BT_MIN_PORT,
             prefs.BT_MAX_PORT,
             prefs.USE_UPNP,
@@ -278,6 +282,8 @@ class ControllerDaemon(Daemon):
             prefs.LIMIT_CONNECTIONS_BT,
             prefs.CONNECTION_LIMIT_BT_NUM,
             prefs.USE_DHT,
+            prefs.HTTP_SEGMENTED_DOWNLOADS,
+            prefs.HTTP_DOWNLOAD_SEGMENTS,
             ]
 
         data = {}
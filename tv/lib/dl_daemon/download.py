@@ -45,7 +45,7 @@ from miro.clock import clock
 from miro.download_utils import (
     clean_filename, next_free_filename, next_free_directory,
     check_filename_extension, filter_directory_name, filename_from_url,
-    get_file_url_path)
+    get_file_url_path, PRIORITY_NORMAL, PRIORITY_WEIGHTS)
 from miro import eventloop
 from miro import httpclient
 from miro import fileutil
@@ -102,9 +102,11 @@ def info_hash_to_long(info_hash):
     """
     return long(str(info_hash), 16)
 
-def start_download(url, dlid, content_type, channel_name):
+def start_download(url, dlid, content_type, channel_name,
+                   priority=PRIORITY_NORMAL):
     try:
         download = _downloads[dlid]
+        download.priority = priority
         download.start()
     except KeyError:
         # There is no download with this id.  This is a new download.
@@ -114,6 +116,7 @@ def start_download(url, dlid, content_type, channel_name):
             check_f(channel_name)
         dl = create_downloader(url, content_type, dlid)
         dl.channelName = channel_name
+        dl.priority = priority
         _downloads[dlid] = dl
 
 def stop_download(dlid, delete):
@@ -181,6 +184,7 @@ def startup():
     logging.info("Starting downloaders")
     DOWNLOAD_UPDATER.start_updates()
     TORRENT_SESSION.startup()
+    BANDWIDTH_SCHEDULER.startup()
 
 def shutdown():
     logging.info("Shutting down downloaders...")
@@ -188,12 +192,13 @@ def shutdown():
         _downloads[dlid].shutdown()
     logging.info("Shutting down torrent session...")
     TORRENT_SESSION.shutdown()
+    BANDWIDTH_SCHEDULER.shutdown()
     # Flush the status updates.
     logging.info('flushing status updates...')
     DOWNLOAD_UPDATER.flush_update()
     logging.info("shutdown() finished")
 
-def restore_downloader(downloader):
+def restore_downloader(downloader, priority=PRIORITY_NORMAL):
     if downloader['dlid'] in _downloads:
         logging.warn("Not restarting active downloader: %s",
                 downloader['dlid'])
@@ -211,6 +216,7 @@ def restore_downloader(downloader):
         c.send()
         return
 
+    dl.priority = priority
     _downloads[downloader['dlid']] = dl
 
 class TorrentSession(object):
@@ -219,8 +225,10 @@ class TorrentSession(object):
     """
     def __init__(self):
         self.torrents = set()
+        self.new_torrents = set()
         self.info_hash_to_downloader = {}
         self.session = None
+        self.use_state_updates = False
         self.pnp_on = None
         self.dht_on = None
         self.pe_set = None
@@ -242,6 +250,11 @@ class TorrentSession(object):
         # MR is for Miro.
         fingerprint = lt.fingerprint("MR", major, minor, 0, 0)
         self.session = lt.session(fingerprint)
+        # libtorrent 0.16 and later can tell us which torrents changed since
+        # the last update, so we don't have to ask every torrent for its
+        # status each time.
+        self.use_state_updates = hasattr(self.session,
+                                         'post_torrent_updates')
         self.listen()
         self.set_upnp()
         self.set_dht()
@@ -374,20 +387,60 @@ class TorrentSession(object):
 
     def add_torrent(self, downloader):
         self.torrents.add(downloader)
+        self.new_torrents.add(downloader)
         info_hash = info_hash_to_long(downloader.torrent.info_hash())
         self.info_hash_to_downloader[info_hash] = downloader
 
     def remove_torrent(self, downloader):
         if downloader in self.torrents:
             self.torrents.remove(downloader)
+            self.new_torrents.discard(downloader)
             info_hash = info_hash_to_long(downloader.torrent.info_hash())
             del self.info_hash_to_downloader[info_hash]
 
     def update_torrents(self):
-        # Copy this set into a list in case any of the torrents gets
-        # removed during the iteration.
-        for torrent in [x for x in self.torrents]:
-            torrent.update_status()
+        if not self.use_state_updates:
+            # Copy this set into a list in case any of the torrents gets
+            # removed during the iteration.
+            for torrent in [x for x in self.torrents]:
+                torrent.update_status()
+            return
+        # Get a status for torrents we just added right away, rather than
+        # waiting for them to show up in a state update.
+        for torrent in [x for x in self.new_torrents]:
+            if torrent in self.torrents:
+                torrent.update_status()
+        self.new_torrents = set()
+        statuses = []
+        for alert in self.pop_alerts():
+            if isinstance(alert, lt.state_update_alert):
+                statuses.extend(alert.status)
+        self.update_statuses(statuses)
+        # The alert for this gets posted from libtorrent's thread, we'll
+        # handle it on the next update.
+        self.session.post_torrent_updates()
+
+    def pop_alerts(self):
+        if hasattr(self.session, 'pop_alerts'):
+            return self.session.pop_alerts()
+        alerts = []
+        alert = self.session.pop_alert()
+        while alert is not None:
+            alerts.append(alert)
+            alert = self.session.pop_alert()
+        return alerts
+
+    def update_statuses(self, statuses):
+        """Update the downloaders for a list of torrent_status objects."""
+        for status in statuses:
+            info_hash = info_hash_to_long(status.handle.info_hash())
+            try:
+                downloader = self.info_hash_to_downloader[info_hash]
+            except KeyError:
+                # torrent was paused or removed since libtorrent sent
+                # the update
+                continue
+            downloader.update_status(status)
 
 TORRENT_SESSION = TorrentSession()
 
@@ -450,6 +503,114 @@ class DownloadStatusUpdater(object):
 
 DOWNLOAD_UPDATER = DownloadStatusUpdater()
 
+def allocate_bandwidth(total, requests, headroom=1.25, min_rate=4096):
+    """Split a bandwidth limit between downloads.
+
+    Each download gets a share of total in proportion to its weight.
+    Downloads that are going slower than their share only get what they're
+    using (plus some headroom so they can speed up), and what's left over
+    gets split between the rest.
+
+    :param total: bandwidth to hand out in bytes/second
+    :param requests: list of (weight, rate) tuples, where rate is how fast
+        the download is currently going
+    :returns: list of limits in bytes/second, in the same order as requests
+    """
+    weights = [weight for weight, rate in requests]
+    demands = [max(rate * headroom, min_rate) for weight, rate in requests]
+    limits = [0] * len(requests)
+    unsatisfied = set(range(len(requests)))
+    remaining = float(total)
+    while unsatisfied:
+        weight_total = sum(weights[i] for i in unsatisfied)
+        satisfied = [i for i in unsatisfied
+                     if demands[i] <= remaining * weights[i] / weight_total]
+        if not satisfied:
+            break
+        for i in satisfied:
+            limits[i] = demands[i]
+            remaining -= demands[i]
+            unsatisfied.remove(i)
+    if unsatisfied:
+        weight_total = sum(weights[i] for i in unsatisfied)
+        for i in unsatisfied:
+            limits[i] = remaining * weights[i] / weight_total
+    elif requests:
+        # Everyone got what they wanted, hand out the rest so that a
+        # download can speed up before the next rebalance.
+        weight_total = sum(weights)
+        for i in xrange(len(requests)):
+            limits[i] += remaining * weights[i] / weight_total
+    # 0 means no limit to libcurl, so make sure we never return it
+    return [max(1, int(limit)) for limit in limits]
+
+class BandwidthScheduler(object):
+    """Shares the downstream limit between HTTP and BitTorrent downloads.
+
+    Every REBALANCE_INTERVAL seconds we split DOWNSTREAM_LIMIT_IN_KBS between
+    the active downloads with allocate_bandwidth() and give each downloader
+    its share with set_bandwidth_limit().  libcurl and libtorrent take care
+    of pacing the individual transfers.
+    """
+
+    REBALANCE_INTERVAL = 2
+
+    def __init__(self):
+        self.limited = set()
+        self.callback_handle = None
+
+    def startup(self):
+        self.callback_handle = app.downloader_config_watcher.connect(
+                'changed', self.on_config_changed)
+        eventloop.add_timeout(self.REBALANCE_INTERVAL, self.rebalance,
+                "Bandwidth rebalance")
+
+    def shutdown(self):
+        app.downloader_config_watcher.disconnect(self.callback_handle)
+
+    def on_config_changed(self, obj, key, value):
+        if key in (prefs.LIMIT_DOWNSTREAM.key,
+                   prefs.DOWNSTREAM_LIMIT_IN_KBS.key):
+            self.rebalance(periodic=False)
+
+    def get_limit(self):
+        """Get the total downstream limit in bytes/second, or None."""
+        if not app.config.get(prefs.LIMIT_DOWNSTREAM):
+            return None
+        limit = app.config.get(prefs.DOWNSTREAM_LIMIT_IN_KBS) * (2 ** 10)
+        # avoid OverflowErrors by keeping the value an integer
+        return min(limit, sys.maxint)
+
+    def rebalance(self, periodic=True):
+        try:
+            total = self.get_limit()
+            if total is None:
+                self.clear_limits()
+                return
+            downloaders = [dl for dl in _downloads.values()
+                           if dl.state == u'downloading']
+            requests = [(PRIORITY_WEIGHTS.get(dl.priority, 1), dl.get_rate())
+                        for dl in downloaders]
+            limits = allocate_bandwidth(total, requests)
+            for downloader, limit in zip(downloaders, limits):
+                downloader.set_bandwidth_limit(limit)
+            # Downloads that stopped shouldn't keep a stale limit around for
+            # when they get restarted.
+            for downloader in self.limited.difference(downloaders):
+                downloader.set_bandwidth_limit(None)
+            self.limited = set(downloaders)
+        finally:
+            if periodic:
+                eventloop.add_timeout(self.REBALANCE_INTERVAL,
+                        self.rebalance, "Bandwidth rebalance")
+
+    def clear_limits(self):
+        for downloader in self.limited:
+            downloader.set_bandwidth_limit(None)
+        self.limited = set()
+
+BANDWIDTH_SCHEDULER = BandwidthScheduler()
+
 # retry times in seconds.  60 seconds, 5 minutes, ...
 RETRY_TIMES = (
     60,
@@ -463,6 +624,12 @@ RETRY_TIMES = (
     )
 
 class BGDownloader(object):
+    # Set by start_download() and restore_downloader().  Restored
+    # downloaders don't go through __init__, so these are class attributes.
+    priority = PRIORITY_NORMAL
+    # max download rate in bytes/second from the BandwidthScheduler
+    bandwidth_limit = None
+
     def __init__(self, url, dlid):
         self.dlid = dlid
         self.url = url
@@ -642,6 +809,22 @@ class BGDownloader(object):
             rate = self.rate
         return rate
 
+    def set_bandwidth_limit(self, limit):
+        """Limit our download rate.
+
+        :param limit: max rate in bytes/second, or None for no limit
+        """
+        self.bandwidth_limit = limit
+        self._apply_bandwidth_limit()
+
+    def _apply_bandwidth_limit(self):
+        """Pass bandwidth_limit on to our transfers.
+
+        Subclasses should override this, by default we don't limit
+        anything.
+        """
+        pass
+
     def retry_download(self):
         self.retryDC = None
         self.start(resume=False)
@@ -706,6 +889,85 @@ class BGDownloader(object):
             accept = (size <= available)
         return accept
 
+# Segmented HTTP downloads: files are split into segments that are at least
+# this big, so small files just use 1 connection.
+MIN_SEGMENT_SIZE = 4 * 1024 * 1024
+
+def encode_segments(segments):
+    """Convert a list of [start, end, downloaded] segments into a unicode
+    string that can be stored in the downloader status.
+    """
+    if segments is None:
+        return None
+    return u','.join(u'%d-%d:%d' % tuple(segment) for segment in segments)
+
+def decode_segments(data):
+    """Reverse encode_segments().  Returns None if data is empty or
+    malformed.
+    """
+    if not data:
+        return None
+    segments = []
+    try:
+        for part in data.split(u','):
+            byte_range, downloaded = part.split(u':')
+            start, end = byte_range.split(u'-')
+            segments.append([int(start), int(end), int(downloaded)])
+    except ValueError:
+        logging.warn("decode_segments: bad segment data: %r", data)
+        return None
+    return segments
+
+class HTTPSegment(object):
+    """Transfer for one byte range of a segmented HTTP download.
+
+    The progress is stored in downloader.segments[index], which is a
+    [start, end, downloaded] list.  end is inclusive.  We only count data
+    that httpclient has synced to disk there, since that's what gets saved
+    and resumed from.  unsynced is how much more we've written.
+    """
+    def __init__(self, downloader, index):
+        self.downloader = downloader
+        self.index = index
+        start, end, downloaded = downloader.segments[index]
+        self.segments = downloader.segments
+        self.initial_downloaded = downloaded
+        self.unsynced = 0
+        self.canceled = False
+        self.client = httpclient.grab_url(downloader.url, self.on_finished,
+                self.on_error, write_file=downloader.filename,
+                byte_range=(start + downloaded, end))
+
+    def update_progress(self):
+        """Store how much we've downloaded in the downloader's segment list.
+
+        :returns: current download rate
+        """
+        stats = self.client.get_stats()
+        if stats.status_code != 206:
+            return 0
+        segment = self.downloader.segments[self.index]
+        segment[2] = self.initial_downloaded + stats.synced
+        self.unsynced = stats.decoded - stats.synced
+        return stats.download_rate
+
+    def cancel(self):
+        self.update_progress()
+        self.client.cancel(callback=self.on_canceled)
+        self.canceled = True
+
+    def on_canceled(self):
+        self.downloader.on_segment_canceled(self)
+
+    def on_finished(self, info):
+        if not self.canceled:
+            self.downloader.on_segment_finished(self)
+
+    def on_error(self, error):
+        if not self.canceled:
+            self.update_progress()
+            self.downloader.on_segment_error(self, error)
+
 class HTTPDownloader(BGDownloader):
     CHECK_STATS_TIMEOUT = 1.0
 
@@ -714,17 +976,17 @@ class HTTPDownloader(BGDownloader):
         self.retryDC = None
         self.channelName = None
         self.expectedContentType = expectedContentType
+        self.segments = None
+        # set to True if a server claims to support ranges, but doesn't
+        self.segments_failed = False
         if restore is not None:
-            if not isinstance(restore.get('totalSize', 0), int):
-                # Sometimes restoring old downloaders caused errors
-                # because their totalSize wasn't an int.  (see #3965)
-                restore['totalSize'] = int(restore['totalSize'])
-            self.__dict__.update(restore)
+            self.restore_state(restore)
             self.restartOnError = True
         else:
             BGDownloader.__init__(self, url, dlid)
             self.restartOnError = False
         self.client = None
+        self.segment_transfers = {}
         self.rate = 0
         if self.state == u'downloading':
             self.start_download()
@@ -733,26 +995,191 @@ class HTTPDownloader(BGDownloader):
         else:
             self.update_client()
 
+    def restore_state(self, data):
+        if not isinstance(data.get('totalSize', 0), int):
+            # Sometimes restoring old downloaders caused errors
+            # because their totalSize wasn't an int.  (see #3965)
+            data['totalSize'] = int(data['totalSize'])
+        self.__dict__.update(data)
+        self.segments = decode_segments(data.get('segments'))
+
     def start_new_download(self):
         """Start a download, discarding any existing data"""
         self.currentSize = 0
         self.totalSize = -1
+        self.segments = None
         self.start_download(resume=False)
 
     def start_download(self, resume=True):
         if self.retryDC:
             self.retryDC.cancel()
             self.retryDC = None
+        if self.segments is not None:
+            if resume and self._segments_sanity_check():
+                logging.debug("start_download: %s (resuming %d segments)",
+                              self.url, len(self.segments))
+                self.start_segments()
+                self.update_stats()
+                return
+            self.segments = None
+            self.currentSize = 0
+            resume = False
         if resume:
             resume = self._resume_sanity_check()
 
         logging.debug("start_download: %s", self.url)
 
+        if ((not resume or self.currentSize == 0) and
+                not self.segments_failed and
+                app.config.get(prefs.HTTP_SEGMENTED_DOWNLOADS)):
+            # We're starting from scratch, see if the server lets us
+            # download the file in segments
+            self.client = httpclient.grab_headers(self.url,
+                    self.on_probe_finished, self.on_probe_error)
+        else:
+            self._start_single_download(resume)
+        self.update_stats()
+
+    def _start_single_download(self, resume):
         self.client = httpclient.grab_url(
             self.url, self.on_download_finished, self.on_download_error,
             header_callback=self.on_headers, write_file=self.filename,
             resume=resume)
-        self.update_stats()
+        self._apply_bandwidth_limit()
+
+    def on_probe_finished(self, info):
+        if self.state != u'downloading':
+            return
+        self.client = None
+        total_size = info.get('total-size', -1)
+        accept_ranges = info.get('accept-ranges', '').strip().lower()
+        segment_count = min(app.config.get(prefs.HTTP_DOWNLOAD_SEGMENTS),
+                            total_size // MIN_SEGMENT_SIZE)
+        if info['status'] != 200 or accept_ranges != 'bytes' or \
+                segment_count < 2:
+            self._start_single_download(False)
+            return
+        self.on_headers(info)
+        if self.state != u'downloading':
+            # on_headers() didn't accept the download
+            return
+        try:
+            f = fileutil.open_file(self.filename, 'wb')
+            try:
+                f.truncate(total_size)
+            finally:
+                f.close()
+        except (IOError, OSError), e:
+            logging.warn("Error preallocating %s: %s", self.filename, e)
+            self._start_single_download(False)
+            return
+        self.totalSize = total_size
+        self.currentSize = 0
+        segment_size = total_size // segment_count
+        self.segments = []
+        for i in xrange(segment_count):
+            start = i * segment_size
+            if i < segment_count - 1:
+                end = start + segment_size - 1
+            else:
+                end = total_size - 1
+            self.segments.append([start, end, 0])
+        logging.debug("on_probe_finished: downloading %s in %d segments",
+                      self.url, segment_count)
+        self.start_segments()
+
+    def on_probe_error(self, error):
+        # Let the regular download handle (and report) any problems
+        if self.state != u'downloading':
+            return
+        self.client = None
+        self._start_single_download(False)
+
+    def start_segments(self):
+        for index, (start, end, downloaded) in enumerate(self.segments):
+            if start + downloaded <= end:
+                self.segment_transfers[index] = HTTPSegment(self, index)
+        if not self.segment_transfers:
+            self.on_segments_finished()
+        else:
+            self._apply_bandwidth_limit()
+
+    def cancel_segments(self):
+        for transfer in self.segment_transfers.values():
+            transfer.cancel()
+        self.segment_transfers = {}
+
+    def on_segment_finished(self, transfer):
+        del self.segment_transfers[transfer.index]
+        segment = self.segments[transfer.index]
+        segment[2] = segment[1] - segment[0] + 1
+        if not self.segment_transfers:
+            self.on_segments_finished()
+
+    def on_segment_canceled(self, transfer):
+        # httpclient syncs the file when it closes it, so we can store the
+        # rest of the progress now.  Skip this if we've moved on to a new
+        # set of segments, or restarted this one.
+        if (transfer.segments is not self.segments or
+                transfer.index in self.segment_transfers):
+            return
+        transfer.update_progress()
+        self.currentSize = self._segments_downloaded()
+        self.update_client()
+
+    def on_segments_finished(self):
+        self.currentSize = self.totalSize
+        self.segments = None
+        self.on_download_finished(None)
+
+    def on_segment_error(self, transfer, error):
+        del self.segment_transfers[transfer.index]
+        self.cancel_segments()
+        self.currentSize = self._segments_downloaded()
+        if isinstance(error, httpclient.UnexpectedStatusCode):
+            # The server stopped honoring our ranges.  Start over with a
+            # single connection.
+            logging.warn("Segmented download failed (%s), restarting "
+                         "without segments: %s", error, self.url)
+            self.segments_failed = True
+            self.start_new_download()
+        else:
+            self.on_download_error(error)
+
+    def _apply_bandwidth_limit(self):
+        if self.segment_transfers:
+            clients = [transfer.client
+                       for transfer in self.segment_transfers.values()]
+        elif self.client is not None:
+            clients = [self.client]
+        else:
+            return
+        if self.bandwidth_limit is None:
+            speed = 0
+        else:
+            # split our share evenly between the segments
+            speed = max(1, self.bandwidth_limit // len(clients))
+        for client in clients:
+            client.set_max_recv_speed(speed)
+
+    def _segments_downloaded(self):
+        return sum(downloaded for start, end, downloaded in self.segments)
+
+    def _segments_sanity_check(self):
+        """Check that the data for a segmented download is still around.
+
+        :returns: If we can resume the segments
+        """
+        try:
+            file_size = os.stat(self.filename)[stat.ST_SIZE]
+        except OSError:
+            return False
+        if file_size != self.totalSize:
+            logging.warn("Segmented download file is the wrong size "
+                         "(%s, should be %s).  url: %s, path: %s.",
+                         file_size, self.totalSize, self.url, self.filename)
+            return False
+        return True
 
     def _resume_sanity_check(self):
         """Do sanity checks to test if we should try HTTP Resume.
@@ -790,6 +1217,15 @@ class HTTPDownloader(BGDownloader):
         if self.client is not None:
             self.client.cancel(remove_file=remove_file)
             self.destroy_client()
+        if self.segment_transfers:
+            self.cancel_segments()
+            self.currentSize = self._segments_downloaded()
+        if remove_file and self.segments is not None:
+            self.segments = None
+            try:
+                fileutil.remove(self.filename)
+            except OSError:
+                pass
         # if it's in a retrying state, we want to nix that, too
         if self.retryDC:
             self.retryDC.cancel()
@@ -805,6 +1241,7 @@ class HTTPDownloader(BGDownloader):
                 pass
         self.currentSize = 0
         self.totalSize = -1
+        self.segments = None
 
     def handle_temporary_error(self, short_reason, reason):
         self.cancel_request()
@@ -877,21 +1314,31 @@ class HTTPDownloader(BGDownloader):
     def get_status(self):
         data = BGDownloader.get_status(self)
         data['dlerType'] = 'HTTP'
+        data['segments'] = encode_segments(self.segments)
         return data
 
     def update_stats(self):
         """Update the download rate and eta based on receiving length
         bytes.
         """
-        if self.client is None or self.state != u'downloading':
+        if self.state != u'downloading':
             return
-        stats = self.client.get_stats()
-        if stats.status_code in (200, 206):
-            # Only upload currentSize/rate if we are currently
-            # downloading something.  Don't change them before the
-            # transfer starts, while we are handling redirects, etc.
-            self.currentSize = stats.downloaded + stats.initial_size
-            self.rate = stats.download_rate
+        if self.segment_transfers:
+            self.rate = sum(transfer.update_progress()
+                            for transfer in self.segment_transfers.values())
+            self.currentSize = (self._segments_downloaded() +
+                    sum(transfer.unsynced
+                        for transfer in self.segment_transfers.values()))
+        elif self.client is None:
+            return
+        else:
+            stats = self.client.get_stats()
+            if stats.status_code in (200, 206):
+                # Only upload currentSize/rate if we are currently
+                # downloading something.  Don't change them before the
+                # transfer starts, while we are handling redirects, etc.
+                self.currentSize = stats.downloaded + stats.initial_size
+                self.rate = stats.download_rate
         eventloop.add_timeout(self.CHECK_STATS_TIMEOUT, self.update_stats,
                 'update http downloader stats')
         self.update_client()
@@ -1125,6 +1572,7 @@ class BTDownloader(BGDownloader):
 
             # need to do this for libtorrent > 0.13
             self.torrent.auto_managed(False)
+            self._apply_bandwidth_limit()
         except StandardError:
             self.handle_error(_('BitTorrent failure'),
                               _('BitTorrent failed to startup'))
@@ -1192,6 +1640,14 @@ class BTDownloader(BGDownloader):
         except StandardError:
             logging.exception("Error shutting down torrent")
 
+    def _apply_bandwidth_limit(self):
+        if self.torrent is None:
+            return
+        if self.bandwidth_limit is None:
+            self.torrent.set_download_limit(-1)
+        else:
+            self.torrent.set_download_limit(self.bandwidth_limit)
+
     def _pause_torrent(self):
         try:
             TORRENT_SESSION.remove_torrent(self)
@@ -1234,8 +1690,10 @@ class BTDownloader(BGDownloader):
                       self.leechers,
                       self.currentSize)
 
-    def update_status(self):
-        """
+    def update_status(self, status=None):
+        """Update our status from a libtorrent torrent_status object.  If
+        status is None, we ask the torrent for it.
+
         activity -- string specifying what's currently happening or None for
                 normal operations.
         upRate -- upload rate in B/s
@@ -1249,7 +1707,8 @@ class BTDownloader(BGDownloader):
         leechers -- number of leechers for this torrent
         connecting -- nummber of peers we're connected to
         """
-        status = self.torrent.status()
+        if status is None:
+            status = self.torrent.status()
         self.totalSize = status.total_wanted
         self.rate = status.download_payload_rate
         self.upRate = status.upload_payload_rate
@@ -0,0 +1,242 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2005, 2006, 2007, 2008, 2009, 2010, 2011
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+"""``miro.dl_daemon.protocol`` -- Encode commands sent between Miro and the
+downloader daemon.
+
+Each message is a single frame type byte followed by the payload.  Most
+commands are rare and are just pickled, but the high-frequency ones have a
+compact marshal based encoding:
+
+* BatchUpdateDownloadStatus is sent every second with a status dict for
+  each active download.  We send only the fields that changed since the
+  last status for that dlid.  The payload is
+  ``(command_id, [(dlid, changed, removed), ...], other_args)`` where
+  changed is a dict of new values and removed is a list of keys that are no
+  longer in the status.
+* DownloaderBatchCommand is sent as ``(command_id, args)``.
+
+If a command contains values that marshal can't handle, we fall back to
+pickling it.
+
+Both ends keep the last status they saw for each dlid, so a
+CommandEncoder/CommandDecoder pair is tied to a single connection.
+"""
+
+import cPickle
+import marshal
+from itertools import izip
+
+from miro.dl_daemon import command
+
+FRAME_PICKLE = 'P'
+FRAME_STATUS = 'S'
+FRAME_BATCH_COMMAND = 'B'
+
+# Once a download reaches one of these states we stop remembering its
+# status, the next status for it will be sent in full.
+FORGET_STATES = (u'finished', u'stopped', u'failed')
+
+# marshal silently writes subclasses of these as their base type, so we
+# only use it for values whose types are exactly in this list.
+MARSHAL_TYPES = frozenset([type(None), bool, int, long, float, str,
+    unicode])
+
+# marker for keys that aren't in a dict
+_MISSING = object()
+
+def can_marshal(value):
+    """Check if value can be round-tripped through marshal."""
+    value_type = type(value)
+    if value_type in MARSHAL_TYPES:
+        return True
+    elif value_type in (list, tuple):
+        for child in value:
+            if not can_marshal(child):
+                return False
+        return True
+    elif value_type is dict:
+        for key, child in value.iteritems():
+            if not (can_marshal(key) and can_marshal(child)):
+                return False
+        return True
+    else:
+        return False
+
+def _same_value(old_value, new_value):
+    # 1 == 1.0 == True, so we need to check the type too
+    return (type(old_value) is type(new_value) and old_value == new_value)
+
+def _restore_command(command_class, command_id, args):
+    comm = command_class.__new__(command_class)
+    comm.__setstate__({'id': command_id, 'args': args, 'kws': {},
+        'orig': True})
+    return comm
+
+class ProtocolError(ValueError):
+    """Error decoding a message from the other side of the connection."""
+    pass
+
+class CommandEncoder(object):
+    """Encodes commands sent over a connection."""
+    def __init__(self):
+        # maps dlid -> the last status sent for that download.  Statuses are
+        # stored as (keys, value types, values, simple) tuples, where simple
+        # is True if all values are in MARSHAL_TYPES
+        self.statuses = {}
+
+    def encode(self, comm):
+        """Encode a command.
+
+        :returns: a string to send over the wire.
+        """
+        data = None
+        if type(comm) is command.BatchUpdateDownloadStatus:
+            data = self._encode_status_command(comm)
+        elif type(comm) is command.DownloaderBatchCommand:
+            data = self._encode_batch_command(comm)
+        if data is None:
+            data = FRAME_PICKLE + cPickle.dumps(comm,
+                    cPickle.HIGHEST_PROTOCOL)
+        return data
+
+    def _encode_status_command(self, comm):
+        if comm.kws or not can_marshal(comm.args[1:]):
+            return None
+        deltas = []
+        # statuses from this command, None means we should forget the dlid
+        new_statuses = {}
+        for status in comm.args[0]:
+            if type(status) is not dict:
+                return None
+            keys = status.keys()
+            values = status.values()
+            types = map(type, values)
+            dlid = status.get('dlid')
+            if dlid in new_statuses:
+                old = new_statuses[dlid]
+            else:
+                old = self.statuses.get(dlid)
+            same_layout = (old is not None and old[1] == types and
+                    old[0] == keys)
+            if same_layout and old[3]:
+                # Same keys and value types as a status that we already
+                # checked, so we know we can marshal it.
+                simple = True
+            else:
+                simple = MARSHAL_TYPES.issuperset(types)
+                if not (MARSHAL_TYPES.issuperset(map(type, keys)) and
+                        (simple or can_marshal(status))):
+                    return None
+            if old is None:
+                deltas.append((dlid, status, []))
+            elif same_layout:
+                # The values are in the same order as last time and have the
+                # same types, so we can compare them all in one go.
+                changed = dict((key, value) for key, value, old_value
+                               in izip(keys, values, old[2])
+                               if value != old_value)
+                deltas.append((dlid, changed, []))
+            else:
+                deltas.append(self._calc_delta(dlid,
+                    dict(izip(old[0], old[2])), status))
+            if status.get('state') in FORGET_STATES:
+                new_statuses[dlid] = None
+            else:
+                new_statuses[dlid] = (keys, types, values, simple)
+        # Only remember the statuses once we know we won't fall back to
+        # pickle, otherwise the decoder would get out of sync with us.
+        for dlid, entry in new_statuses.iteritems():
+            if entry is None:
+                self.statuses.pop(dlid, None)
+            else:
+                self.statuses[dlid] = entry
+        return FRAME_STATUS + marshal.dumps((comm.command_id, deltas,
+            comm.args[1:]))
+
+    def _calc_delta(self, dlid, old_status, status):
+        changed = {}
+        old_get = old_status.get
+        for key, value in status.iteritems():
+            if not _same_value(old_get(key, _MISSING), value):
+                changed[key] = value
+        removed = [key for key in old_status if key not in status]
+        return (dlid, changed, removed)
+
+    def _encode_batch_command(self, comm):
+        if comm.kws or not can_marshal(comm.args):
+            return None
+        return FRAME_BATCH_COMMAND + marshal.dumps((comm.command_id,
+            comm.args))
+
+class CommandDecoder(object):
+    """Decodes commands encoded by a CommandEncoder."""
+    def __init__(self):
+        # maps dlid -> the last status received for that download
+        self.statuses = {}
+
+    def decode(self, data):
+        """Decode a string sent from a CommandEncoder
+
+        :raises ProtocolError: if data can't be decoded.
+        :returns: Command object
+        """
+        frame_type, payload = data[:1], data[1:]
+        try:
+            if frame_type == FRAME_PICKLE:
+                return cPickle.loads(payload)
+            elif frame_type == FRAME_STATUS:
+                return self._decode_status_command(payload)
+            elif frame_type == FRAME_BATCH_COMMAND:
+                command_id, args = marshal.loads(payload)
+                return _restore_command(command.DownloaderBatchCommand,
+                        command_id, args)
+        except (cPickle.UnpicklingError, ValueError, EOFError, TypeError,
+                KeyError, IndexError), e:
+            raise ProtocolError("Error decoding %r frame: %s" %
+                    (frame_type, e))
+        raise ProtocolError("Unknown frame type: %r" % frame_type)
+
+    def _decode_status_command(self, payload):
+        command_id, deltas, extra_args = marshal.loads(payload)
+        statuses = []
+        for dlid, changed, removed in deltas:
+            status = self.statuses.get(dlid, {}).copy()
+            status.update(changed)
+            for key in removed:
+                del status[key]
+            if status.get('state') in FORGET_STATES:
+                self.statuses.pop(dlid, None)
+            else:
+                self.statuses[dlid] = status
+            # RemoteDownloader.update_status() changes the dict it gets,
+            # so pass it a copy.
+            statuses.append(status.copy())
+        return _restore_command(command.BatchUpdateDownloadStatus,
+                command_id, (statuses,) + tuple(extra_args))
@@ -51,6 +51,16 @@ URI_PATTERN = re.compile(r'^([^?]*/)?([^/?]*)/*(\?(.*))?$')
 MAX_FILENAME_LENGTH = 100 
 MAX_FILENAME_EXTENSION_LENGTH = 50
 
+# bandwidth priority classes.  When the downstream limit is on, downloads
+# share it in proportion to their class weight, so background downloads
+# (auto-downloads) don't starve the ones the user asked for.
+PRIORITY_BACKGROUND = 0
+PRIORITY_NORMAL = 1
+PRIORITY_WEIGHTS = {
+    PRIORITY_BACKGROUND: 1,
+    PRIORITY_NORMAL: 4,
+}
+
 def fix_file_urls(url):
     """Fix file urls that start with file:// instead of file:///.
 
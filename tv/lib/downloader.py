@@ -37,7 +37,8 @@ from miro.gtcache import gettext as _
 from miro.database import DDBObject, ObjectNotFoundError
 from miro.dl_daemon import daemon, command
 from miro.download_utils import (next_free_filename, get_file_url_path,
-        next_free_directory, filter_directory_name)
+        next_free_directory, filter_directory_name, PRIORITY_BACKGROUND,
+        PRIORITY_NORMAL)
 from miro.util import (get_torrent_info_hash, returns_unicode, check_u,
                        returns_filename, unicodify, check_f, to_uni, is_magnet_uri)
 from miro import app
@@ -540,7 +541,8 @@ class RemoteDownloader(DDBObject):
             self.url = url
             logging.debug("downloading url %s", self.url)
             args = dict(url=self.url, content_type=self.contentType,
-                        channel_name=self.channelName)
+                        channel_name=self.channelName,
+                        priority=self.get_bandwidth_priority())
             app.download_state_manager.add_download(self.dlid, self)
             app.download_state_manager.queue(self.dlid,
                                              app.download_state_manager.RESUME,
@@ -626,7 +628,8 @@ class RemoteDownloader(DDBObject):
         elif self.get_state() in (u'stopped', u'paused', u'offline'):
             if app.download_state_manager.get_download(self.dlid):
                 args = dict(url=self.url, content_type=self.contentType,
-                            channel_name=self.channelName)
+                            channel_name=self.channelName,
+                            priority=self.get_bandwidth_priority())
                 app.download_state_manager.queue(
                     self.dlid,
                     app.download_state_manager.RESUME,
@@ -708,6 +711,15 @@ class RemoteDownloader(DDBObject):
                 check_f(channelName)
             self.channelName = channelName
 
+    def get_bandwidth_priority(self):
+        """Get the priority class the daemon should use when it shares out
+        the downstream limit.  Auto-downloads run in the background.
+        """
+        if self.item_list and all(item.get_auto_downloaded()
+                                  for item in self.item_list):
+            return PRIORITY_BACKGROUND
+        return PRIORITY_NORMAL
+
     def remove(self):
         """Removes downloader from the database and deletes the file.
         """
@@ -909,7 +921,8 @@ class RemoteDownloader(DDBObject):
             if self.contentType ==  u'application/x-magnet':
                 dler_status['url'] = self.url
             dler_status['metainfo'] = self.metainfo
-            args = dict(downloader=dler_status)
+            args = dict(downloader=dler_status,
+                        priority=self.get_bandwidth_priority())
             app.download_state_manager.queue(
                 self.dlid,
                 app.download_state_manager.RESTORE,
@@ -938,7 +951,8 @@ class RemoteDownloader(DDBObject):
         self.manualUpload = True
         if app.download_state_manager.get_download(self.dlid):
             args = dict(url=self.url, content_type=self.contentType,
-                        channel_name=self.channelName)
+                        channel_name=self.channelName,
+                        priority=self.get_bandwidth_priority())
             app.download_state_manager.queue(self.dlid,
                                              app.download_state_manager.RESUME,
                                              args)
@@ -69,7 +69,7 @@ from miro import fileutil
 from miro.plat.utils import filename_to_unicode, make_url_safe, unmake_url_safe
 from miro.plat.filebundle import is_file_bundle
 from miro import filetypes
-from miro.item import FeedParserValues
+from miro.item import FeedParserValues, schedule_feed_expiration
 from miro import searchengines
 from miro import workerprocess
 from miro.clock import clock
@@ -402,6 +402,10 @@ class FeedImpl(DDBObject):
         """
         pass
 
+# maps feed ids to Feed objects that don't have their item counts calculated.
+# See Feed._calc_counts()
+_feeds_needing_counts = {}
+
 class Feed(DDBObject, iconcache.IconCacheOwnerMixin):
     """This class is a magic class that can become any type of feed it wants
 
@@ -467,6 +471,7 @@ class Feed(DDBObject, iconcache.IconCacheOwnerMixin):
         self.inlineSearchTerm = None
         self.type = u'feed'
         self.calc_item_list()
+        _feeds_needing_counts[self.id] = self
 
     def _get_actual_feed(self):
         # first try to load from actualFeed from the DB
@@ -582,9 +587,75 @@ class Feed(DDBObject, iconcache.IconCacheOwnerMixin):
                 '_num_downloaded', '_num_downloading'):
             if cached_count_attr in self.__dict__:
                 del self.__dict__[cached_count_attr]
+        _feeds_needing_counts[self.id] = self
+
+    def _calc_counts(self):
+        """Calculate our item counts.
+
+        We also calculate counts for any other feeds that need them, using
+        a single query.  This way things like the sidebar, which asks every
+        feed for its counts, don't need several queries for each feed.
+        """
+        _feeds_needing_counts[self.id] = self
+        feeds = _feeds_needing_counts.values()
+        _feeds_needing_counts.clear()
+        counts = models.Item.feed_counts([feed.id for feed in feeds])
+        for feed in feeds:
+            (downloaded, downloading, unwatched, available,
+                    auto_pending) = counts.get(feed.id, (0, 0, 0, 0, 0))
+            feed._num_downloaded = downloaded
+            feed._num_downloading = downloading
+            feed._num_unwatched = unwatched
+            feed._num_available = available - auto_pending
+
+    def item_counts(self, state):
+        """Get the counts that an item adds to.
+
+        This is the python version of the feed half of the SQL in
+        Item.feed_counts().
+
+        :param state: value returned by Item.feed_count_state()
+        :returns: (downloaded, downloading, unwatched, available) tuple.
+            available is -1 for items that we're about to auto-download.
+        """
+        (downloaded, downloading, unwatched, maybe_available, creation_time,
+                not_was_downloaded, eligible) = state
+        available = maybe_available and self.last_viewed <= creation_time
+        auto_pending = (self.autoDownloadable and not_was_downloaded and
+                (eligible or self.getEverything))
+        return (int(downloaded), int(downloading), int(unwatched),
+                int(bool(available)) - int(bool(auto_pending)))
+
+    def update_item_counts(self, old_state, new_state):
+        """Adjust our counts after one of our items changed.
+
+        :param old_state: Item.feed_count_state() value that the item was
+            counted with, or None if it wasn't part of this feed
+        :param new_state: Item.feed_count_state() value for the item now,
+            or None if it's no longer part of this feed
+        """
+        if '_num_downloaded' not in self.__dict__:
+            # _calc_counts() will count the item when our counts are needed
+            return
+        deltas = [0, 0, 0, 0]
+        if old_state is not None:
+            for i, count in enumerate(self.item_counts(old_state)):
+                deltas[i] -= count
+        if new_state is not None:
+            for i, count in enumerate(self.item_counts(new_state)):
+                deltas[i] += count
+        self._num_downloaded += deltas[0]
+        self._num_downloading += deltas[1]
+        self._num_unwatched += deltas[2]
+        self._num_available += deltas[3]
 
     def recalc_counts(self):
-        self.invalidate_counts()
+        """Tell the frontend that our item counts changed.
+
+        Items keep our counts up to date as they change (see
+        Item._update_feed_counts()), so we don't need to recalculate them
+        here.
+        """
         self.signal_change(needs_save=False)
         if self.in_folder():
             self.get_folder().signal_change(needs_save=False)
@@ -595,7 +666,7 @@ class Feed(DDBObject, iconcache.IconCacheOwnerMixin):
         try:
             return self._num_downloaded
         except AttributeError:
-            self._num_downloaded = self.downloaded_items.count()
+            self._calc_counts()
             return self._num_downloaded
 
     def num_downloading(self):
@@ -604,7 +675,7 @@ class Feed(DDBObject, iconcache.IconCacheOwnerMixin):
         try:
             return self._num_downloading
         except AttributeError:
-            self._num_downloading = self.downloading_items.count()
+            self._calc_counts()
             return self._num_downloading
 
     def num_unwatched(self):
@@ -613,7 +684,7 @@ class Feed(DDBObject, iconcache.IconCacheOwnerMixin):
         try:
             return self._num_unwatched
         except AttributeError:
-            self._num_unwatched = self.unwatched_items.count()
+            self._calc_counts()
             return self._num_unwatched
 
     def num_available(self):
@@ -622,8 +693,7 @@ class Feed(DDBObject, iconcache.IconCacheOwnerMixin):
         try:
             return self._num_available
         except AttributeError:
-            self._num_available = (self.available_items.count() -
-                    self.auto_pending_items.count())
+            self._calc_counts()
             return self._num_available
 
     def get_viewed(self):
@@ -637,51 +707,35 @@ class Feed(DDBObject, iconcache.IconCacheOwnerMixin):
         # get the list of available items before we reset the time
         available_items = list(self.available_items)
         self.last_viewed = datetime.now()
-        try:
-            del self._num_available
-        except AttributeError:
-            pass
+        self.invalidate_counts()
         if self.in_folder():
             self.get_folder().signal_change()
         self.signal_change()
         for item in available_items:
             item.signal_change(needs_save=False)
 
-    def start_manual_download(self):
-        next_ = None
-        for item in self.items:
-            if item.is_pending_manual_download():
-                if next_ is None:
-                    next_ = item
-                elif item.get_pub_date_parsed() > next_.get_pub_date_parsed():
-                    next_ = item
-        if next_ is not None:
-            next_.download(autodl=False)
-
-    def start_auto_download(self):
-        next = None
-        for item in self.items:
-            if item.is_eligible_for_auto_download():
-                if next is None:
-                    next = item
-                elif item.get_pub_date_parsed() > next.get_pub_date_parsed():
-                    next = item
-        if next is not None:
-            next.download(autodl = True)
+    def get_expire_delta(self):
+        """Get how long watched items in this feed last before expiring.
 
-    def expiring_items(self):
+        Returns a timedelta, or None if items in this feed never expire.
+        """
         # items in watched folders never expire
         if self.is_watched_folder():
-            return []
+            return None
         if self.expire == u'never':
-            return []
+            return None
         elif self.expire == u'system':
             expire_after_x_days = app.config.get(prefs.EXPIRE_AFTER_X_DAYS)
             if expire_after_x_days == -1:
-                return []
-            delta = timedelta(days=expire_after_x_days)
+                return None
+            return timedelta(days=expire_after_x_days)
         else:
-            delta = self.expireTime
+            return self.expireTime
+
+    def expiring_items(self):
+        delta = self.get_expire_delta()
+        if delta is None:
+            return []
         return models.Item.feed_expiring_view(self.id, datetime.now() - delta)
 
     def expire_items(self):
@@ -766,6 +820,8 @@ class Feed(DDBObject, iconcache.IconCacheOwnerMixin):
             self.autoDownloadable = False
         else:
             raise ValueError("Bad auto-download mode: %s" % mode)
+        # which items are auto-pending depends on the mode
+        self.invalidate_counts()
         self.signal_change()
         self.signal_items()
 
@@ -786,6 +842,7 @@ class Feed(DDBObject, iconcache.IconCacheOwnerMixin):
 
         self.signal_change()
         self.signal_items()
+        schedule_feed_expiration(self.id)
 
     def set_max_new(self, max_new):
         """Sets the maxNew attributes. -1 means unlimited.
@@ -1154,6 +1211,7 @@ class Feed(DDBObject, iconcache.IconCacheOwnerMixin):
         if isinstance(self.actualFeed, DirectoryWatchFeedImpl):
             move_items_to = None
         self.cancel_update_events()
+        feedupdate.forget_feed(self)
         if self.download is not None:
             self.download.cancel()
             self.download = None
@@ -1170,6 +1228,7 @@ class Feed(DDBObject, iconcache.IconCacheOwnerMixin):
         finally:
             app.bulk_sql_manager.finish()
         self.remove_icon_cache()
+        _feeds_needing_counts.pop(self.id, None)
         DDBObject.remove(self)
         self.actualFeed.remove()
         if self.in_folder():
@@ -1209,7 +1268,7 @@ class ThrottledUpdateFeedImpl(FeedImpl):
         else:
             if self.updateFreq > 0:
                 feedupdate.schedule_update(self.updateFreq, self.ufeed,
-                        self.update)
+                        self.update, adaptive=True)
 
 class RSSFeedImplBase(ThrottledUpdateFeedImpl):
     """
@@ -1238,10 +1297,13 @@ class RSSFeedImplBase(ThrottledUpdateFeedImpl):
         self.old_items = set(self.items)
 
     def create_items_for_parsed(self, parsed):
-        """Update the feed using parsed XML passed in"""
+        """Update the feed using parsed XML passed in
+
+        Returns the number of new entries.
+        """
         app.bulk_sql_manager.start()
         try:
-            self._create_items_for_parsed(parsed)
+            return self._create_items_for_parsed(parsed)
         finally:
             app.bulk_sql_manager.finish()
 
@@ -1267,6 +1329,7 @@ class RSSFeedImplBase(ThrottledUpdateFeedImpl):
         items_byid = {}
         items_byURLTitle = {}
         items_nokey = []
+        new_count = 0
         for item in self.items:
             rate_limiter.check_for_sleep()
             try:
@@ -1313,6 +1376,8 @@ class RSSFeedImplBase(ThrottledUpdateFeedImpl):
                             pass
             if new and fp_values.first_video_enclosure is not None:
                 self._handle_new_entry(entry, fp_values, channel_title)
+                new_count += 1
+        return new_count
 
     def _allow_feed_to_override_title(self):
         """Should the RSS feed override the default title?
@@ -1436,7 +1501,8 @@ class RSSFeedImpl(RSSFeedImplBase):
         start = clock()
         self.parsed = parsed
         self.remember_old_items()
-        self.create_items_for_parsed(parsed)
+        new_count = self.create_items_for_parsed(parsed)
+        feedupdate.record_update_result(self.ufeed, new_count > 0)
 
         try:
             updateFreq = self.parsed["feed"]["ttl"]
@@ -1499,6 +1565,7 @@ class RSSFeedImpl(RSSFeedImplBase):
         if info.get('status') == 304:
             logging.debug("RSSFeedImpl: _update_callback: "
                           "status 304 (%s)", self.ufeed)
+            feedupdate.record_update_result(self.ufeed, False)
             self.schedule_update_events(-1)
             self.updating = False
             self.ufeed.signal_change()
@@ -2685,13 +2752,6 @@ class HTMLFeedURLParser(HTMLParser):
                                              'application/xml']):
             self.link = urljoin(self.baseurl, attrdict['href'])
 
-def expire_items():
-    try:
-        for feed in Feed.make_view():
-            feed.expire_items()
-    finally:
-        eventloop.add_timeout(300, expire_items, "Expire Items")
-
 def lookup_feed(url, search_term=None):
     try:
         return Feed.get_by_url_and_search(url, search_term)
@@ -31,14 +31,42 @@
 
 Our basic strategy is to limit the number of feeds that are
 simultaniously updating at any given time.  Right now the limit is set
-to 3.
+to 6, with at most 4 updates per host.
+
+Periodic updates are spread out with some random jitter, so that feeds
+don't all end up updating at the same time.  Feeds that don't change for a
+while get updated less often (up to MAX_BACKOFF times their update
+frequency).  As soon as they change again, we go back to the normal
+frequency.
 """
 
 import collections
+import random
+import urlparse
 
 from miro import eventloop
+from miro.clock import clock
+
+MAX_UPDATES = 6
+# feeds from a single host (for example a bunch of video site channels)
+# can't take all the update slots
+MAX_UPDATES_PER_HOST = 4
+# randomly adjust periodic update delays by up to this fraction
+UPDATE_JITTER = 0.1
+# each update that doesn't find anything new multiplies the update delay
+# by BACKOFF_FACTOR, up to MAX_BACKOFF
+BACKOFF_FACTOR = 1.5
+MAX_BACKOFF = 4.0
 
-MAX_UPDATES = 3
+def _host_for_feed(feed):
+    """Get the host to use for per-host limits.
+
+    Returns None for feeds that don't fetch from a remote host.
+    """
+    scheme, host = urlparse.urlparse(feed.get_url())[:2]
+    if scheme not in ('http', 'https') or not host:
+        return None
+    return host.lower()
 
 class FeedUpdateQueue(object):
     def __init__(self):
@@ -46,8 +74,22 @@ class FeedUpdateQueue(object):
         self.timeouts = {}
         self.callback_handles = {}
         self.currently_updating = set()
+        # maps hosts to the number of feeds updating from them
+        self.host_counts = {}
+        # maps feed ids to (host, start time) for feeds that are updating
+        self.update_info = {}
+        # maps feed ids to the multiplier for their update delay
+        self.backoff = {}
+        self.total_wait_time = 0.0
+        self.started_count = 0
+        self.total_update_time = 0.0
+        self.finished_count = 0
 
-    def schedule_update(self, delay, feed, update_callback):
+    def schedule_update(self, delay, feed, update_callback, adaptive=False):
+        if delay > 0:
+            if adaptive:
+                delay *= self.backoff.get(feed.id, 1.0)
+            delay *= random.uniform(1.0 - UPDATE_JITTER, 1.0 + UPDATE_JITTER)
         name = "Feed update (%s)" % feed.get_title()
         self.timeouts[feed.id] = eventloop.add_timeout(delay, self.do_update, 
                 name, args=(feed, update_callback))
@@ -60,31 +102,92 @@ class FeedUpdateQueue(object):
         else:
             timeout.cancel()
 
+    def record_update_result(self, feed, changed):
+        if changed:
+            self.backoff.pop(feed.id, None)
+        else:
+            self.backoff[feed.id] = min(MAX_BACKOFF,
+                    self.backoff.get(feed.id, 1.0) * BACKOFF_FACTOR)
+
+    def forget_feed(self, feed):
+        self.cancel_update(feed)
+        self.backoff.pop(feed.id, None)
+
     def do_update(self, feed, update_callback):
         del self.timeouts[feed.id]
-        self.update_queue.append((feed, update_callback))
+        self.update_queue.append((feed, update_callback, clock()))
         self.run_update_queue()
 
     def update_finished(self, feed):
         for callback_handle in self.callback_handles.pop(feed.id):
             feed.disconnect(callback_handle)
         self.currently_updating.remove(feed)
+        host, start_time = self.update_info.pop(feed.id)
+        if host is not None:
+            self.host_counts[host] -= 1
+            if self.host_counts[host] == 0:
+                del self.host_counts[host]
+        self.total_update_time += clock() - start_time
+        self.finished_count += 1
         # call run_update_queue in an idle to avoid re-updating the feed that
         # just finished.  That could cause weird effects since we are in the
         # update-finished callback right now.  See #16277
         eventloop.add_idle(self.run_update_queue, 'run feed update queue')
 
     def run_update_queue(self):
+        # updates that can't run yet because their host is busy.  They keep
+        # their place at the front of the queue.
+        blocked = collections.deque()
         while (len(self.update_queue) > 0 and 
                len(self.currently_updating) < MAX_UPDATES):
-            feed, update_callback = self.update_queue.popleft()
+            feed, update_callback, queue_time = self.update_queue.popleft()
             if feed in self.currently_updating:
                 continue
+            host = _host_for_feed(feed)
+            if (host is not None and
+                    self.host_counts.get(host, 0) >= MAX_UPDATES_PER_HOST):
+                blocked.append((feed, update_callback, queue_time))
+                continue
             handle = feed.connect('update-finished', self.update_finished)
             handle2 = feed.connect('removed', self.update_finished)
             self.callback_handles[feed.id] = (handle, handle2)
             self.currently_updating.add(feed)
+            if host is not None:
+                self.host_counts[host] = self.host_counts.get(host, 0) + 1
+            now = clock()
+            self.update_info[feed.id] = (host, now)
+            self.total_wait_time += now - queue_time
+            self.started_count += 1
             update_callback()
+        if blocked:
+            blocked.extend(self.update_queue)
+            self.update_queue = blocked
+
+    def get_stats(self):
+        """Get statistics about feed updates.
+
+        Returns a dict with these keys:
+          - scheduled: number of feeds with an update scheduled
+          - queued: number of feeds waiting for an update slot
+          - updating: number of feeds currently updating
+          - average_wait: average seconds feeds waited for an update slot
+          - average_update: average seconds an update took
+        """
+        if self.started_count:
+            average_wait = self.total_wait_time / self.started_count
+        else:
+            average_wait = 0.0
+        if self.finished_count:
+            average_update = self.total_update_time / self.finished_count
+        else:
+            average_update = 0.0
+        return {
+            'scheduled': len(self.timeouts),
+            'queued': len(self.update_queue),
+            'updating': len(self.currently_updating),
+            'average_wait': average_wait,
+            'average_update': average_update,
+        }
 
 global_update_queue = FeedUpdateQueue()
 
@@ -92,8 +195,25 @@ def cancel_update(feed):
     """Cancel any pending updates for feed."""
     global_update_queue.cancel_update(feed)
 
-def schedule_update(delay, feed, update_callback):
+def schedule_update(delay, feed, update_callback, adaptive=False):
     """Schedules a feed to be updated sometime around delay seconds in
     the future.
+
+    If adaptive is True, delay is the feed's normal update frequency and
+    will be increased if recent updates haven't found anything new.
+    """
+    global_update_queue.schedule_update(delay, feed, update_callback,
+            adaptive)
+
+def record_update_result(feed, changed):
+    """Record whether an update found anything new for feed."""
+    global_update_queue.record_update_result(feed, changed)
+
+def forget_feed(feed):
+    """Forget about a feed that's being removed."""
+    global_update_queue.forget_feed(feed)
+
+def get_stats():
+    """Get statistics about feed updates.  See FeedUpdateQueue.get_stats()
     """
-    global_update_queue.schedule_update(delay, feed, update_callback)
+    return global_update_queue.get_stats()
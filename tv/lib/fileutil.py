@@ -74,6 +74,10 @@ def getmtime(path):
     time = max(time, 0) 
     return time
 
+def getsize(path):
+    path = expand_filename(path)
+    return os.path.getsize(path)
+
 def exists(path):
     if not path:
         # DeprecationWarning
@@ -122,22 +126,36 @@ def abspath(path):
     path = collapse_filename(path)
     return path
 
-def copy_with_progress(input_path, output_path, block_size=32*1024):
-    flags = os.O_WRONLY | os.O_CREAT
-    if hasattr(os, 'O_SYNC'):
-        flags |= os.O_SYNC
-    output_fd = os.open(output_path, flags)
-    with file(input_path, 'rb') as input:
-        with os.fdopen(output_fd, 'wb') as output:
-            data = input.read(block_size)
-            while data:
-                output.write(data)
-                result = yield len(data)
-                if result:
-                    # return True to cancel. NB: you should probably remove the
-                    # output file
+# Big blocks keep the per-block Python overhead out of the way; the copy is
+# limited by the disk (usually a slow USB device) rather than by us.
+COPY_BLOCK_SIZE = 1024 * 1024
+
+def copy_with_progress(input_path, output_path, progress_callback=None,
+                       block_size=COPY_BLOCK_SIZE):
+    """Copy input_path to output_path.
+
+    This blocks, so call it from a thread.  progress_callback is called with
+    the number of bytes written after each block; if it returns True the
+    copy is canceled.  The data is synced to disk once, when the whole file
+    has been written.
+
+    :returns: True if the copy finished, False if it was canceled
+    """
+    input_path = expand_filename(input_path)
+    output_path = expand_filename(output_path)
+    buf = bytearray(block_size)
+    with open(input_path, 'rb') as input:
+        with open(output_path, 'wb') as output:
+            while True:
+                count = input.readinto(buf)
+                if not count:
                     break
-                data = input.read(block_size)
+                output.write(buffer(buf, 0, count))
+                if progress_callback and progress_callback(count):
+                    return False
+            output.flush()
+            os.fsync(output.fileno())
+    return True
 
 try:
     samefile = os.path.samefile
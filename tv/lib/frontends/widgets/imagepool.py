@@ -44,7 +44,8 @@ from miro.plat.frontends.widgets import widgetset
 
 broken_image = widgetset.Image(resources.path('images/broken-image.gif'))
 
-CACHE_SIZE = 2000 # number of objects to keep in memory
+# bytes of pixel data to keep in memory for each pool
+CACHE_SIZE = 64 * 1024 * 1024
 
 def resize_image(image, dest_width, dest_height, upsize_threshold=1.5):
     # handle corner case of empty dest
@@ -85,7 +86,13 @@ def resize_one_dimension(image, width_scale, height_scale,
     # okay, give up on scaling and just return the image
     return image
 
+def _pixel_bytes(image):
+    return int(image.width * image.height * 4)
+
 class ImagePool(util.Cache):
+    def get_weight(self, image):
+        return _pixel_bytes(image)
+
     def create_new_value(self, (path, size)):
         try:
             image = widgetset.Image(path)
@@ -98,6 +105,9 @@ class ImagePool(util.Cache):
         return image
 
 class ImageSurfacePool(util.Cache):
+    def get_weight(self, surface):
+        return _pixel_bytes(surface)
+
     def create_new_value(self, (path, size)):
         image = _imagepool.get((path, size))
         return widgetset.ImageSurface(image)
@@ -138,5 +148,18 @@ def get_image_display(path, size=None):
     """
     return widgetset.ImageDisplay(_imagepool.get((path, size)))
 
-# XXX have a way to remove a path from the cache? (re: #16573)
+def invalidate(path):
+    """Forget cached images for path.
+
+    Call this when the file at path changes, so that the next get() loads
+    the new image.
+    """
+    matches_path = lambda key: key[0] == path
+    _imagepool.remove_matching(matches_path)
+    _image_surface_pool.remove_matching(matches_path)
+
+def get_stats():
+    """Get (hits, misses, bytes used) for the image and surface pools."""
+    return [(pool.hits, pool.misses, pool.total_weight)
+            for pool in (_imagepool, _image_surface_pool)]
 
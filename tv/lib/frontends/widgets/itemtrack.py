@@ -45,6 +45,7 @@ from miro import app
 from miro import messages
 from miro import signals
 from miro import search
+from miro.frontends.widgets import imagepool
 from miro.frontends.widgets import itemlist
 from miro.plat.frontends.widgets.threads import call_on_ui_thread
 
@@ -117,6 +118,9 @@ class ItemListTracker(signals.SignalEmitter):
         self.is_tracking = False
         self.search_filter = SearchFilter()
         self.saw_initial_list = False
+        # maps ids -> the latest ItemInfo we've seen from the backend.  We
+        # apply ItemInfoPatches to these.
+        self.current_infos = {}
 
     def connect(self, name, func, *extra_args):
         if not self.is_tracking:
@@ -151,7 +155,8 @@ class ItemListTracker(signals.SignalEmitter):
         self.is_tracking = True
 
     def _send_track_items_message(self):
-        messages.TrackItems(self.type, self.id).send_to_backend()
+        messages.TrackItems(self.type, self.id,
+                send_patches=True).send_to_backend()
 
     def _stop_tracking(self):
         if not self.is_tracking:
@@ -174,6 +179,7 @@ class ItemListTracker(signals.SignalEmitter):
 
     def add_initial_items(self, items):
         self.saw_initial_list = True
+        self.current_infos = dict((i.id, i) for i in items)
         items = self.search_filter.filter_initial_list(items)
         self.emit('items-will-change', items, [], [])
         # call remove all to handle the race described in #16089.  We may get
@@ -189,8 +195,17 @@ class ItemListTracker(signals.SignalEmitter):
             # way, we could get an ItemsChanged message for our old list,
             # before the ItemList message for our new one.
             return
+        message_changed = message.changed + self._apply_patches(
+                message.patches)
+        for info in message.added:
+            self.current_infos[info.id] = info
+        for info in message.changed:
+            self._check_thumbnail(info)
+            self.current_infos[info.id] = info
+        for id_ in message.removed:
+            self.current_infos.pop(id_, None)
         added, changed, removed = self.search_filter.filter_changes(
-                message.added, message.changed, message.removed)
+                message.added, message_changed, message.removed)
         self.emit('items-will-change', added, changed, removed)
         self.item_list.add_items(added)
         self.item_list.update_items(changed)
@@ -199,6 +214,38 @@ class ItemListTracker(signals.SignalEmitter):
         self.emit("items-removed-from-source", message.removed)
         self.emit("items-changed", added, changed, removed)
 
+    def _apply_patches(self, patches):
+        """Apply ItemInfoPatches to our current infos.
+
+        :returns: list of updated ItemInfos
+        """
+        changed = []
+        for patch in patches:
+            try:
+                old_info = self.current_infos[patch.id]
+            except KeyError:
+                # we should always have the info, since the backend only
+                # sends patches for infos that it already sent us.
+                app.widgetapp.handle_soft_failure("ItemListTracker",
+                        "Got patch for unknown item: %s" % patch.id,
+                        with_exception=False)
+                continue
+            info = patch.apply(old_info)
+            self._check_thumbnail(info)
+            self.current_infos[info.id] = info
+            changed.append(info)
+        return changed
+
+    def _check_thumbnail(self, info):
+        """Check if an item switched to a new thumbnail.
+
+        The new file may have replaced one that we have cached images for
+        (for example when a screenshot is re-extracted), so drop those.
+        """
+        old_info = self.current_infos.get(info.id)
+        if old_info is not None and old_info.thumbnail != info.thumbnail:
+            imagepool.invalidate(info.thumbnail)
+
     def set_search(self, query):
         added, removed = self.search_filter.set_search(query)
         self.emit("items-will-change", added, [], removed)
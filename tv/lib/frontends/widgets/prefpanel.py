@@ -643,6 +643,24 @@ class DownloadsPanel(PanelBuilder):
                        create_value_checker(min_=0))
         grid.pack(max_auto)
         grid.pack(max_auto_error, dialogwidgets.ControlGrid.ALIGN_LEFT)
+        grid.end_line(spacing=6)
+
+        max_kbs = sys.maxint / (2**10) # highest value accepted: sys.maxint
+                                       # bits per second in kb/s
+        # This one covers HTTP and torrent downloads together
+        cbx = widgetset.Checkbox(_('Limit total download bandwidth to:'))
+        limit = widgetset.TextEntry()
+        limit.set_width(5)
+        limit_error = build_error_image()
+        attach_boolean(cbx, prefs.LIMIT_DOWNSTREAM, (limit,))
+        attach_integer(limit, prefs.DOWNSTREAM_LIMIT_IN_KBS,
+                       limit_error,
+                       create_value_checker(min_=0, max_=max_kbs))
+
+        grid.pack(cbx)
+        grid.pack(limit)
+        grid.pack_label(_("KB/s"))
+        grid.pack(limit_error)
         grid.end_line(spacing=12)
 
         vbox.pack_start(grid.make_table())
@@ -657,8 +675,6 @@ class DownloadsPanel(PanelBuilder):
         limit = widgetset.TextEntry()
         limit.set_width(5)
         attach_boolean(cbx, prefs.LIMIT_UPSTREAM, (limit,))
-        max_kbs = sys.maxint / (2**10) # highest value accepted: sys.maxint
-                                       # bits per second in kb/s
         limit_error = build_error_image()
         attach_integer(limit, prefs.UPSTREAM_LIMIT_IN_KBS,
                        limit_error,
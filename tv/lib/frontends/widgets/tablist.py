@@ -669,8 +669,15 @@ class HideableTabList(TabList):
             self.expand_after_add_child.add(id_)
 
     def update(self, info):
+        old_info = self.view.model[self.iter_map[info.id]][0]
+        old_name = old_info.name
+        tab_icon = getattr(info, 'tab_icon', None)
+        if tab_icon is not None and tab_icon != getattr(old_info, 'tab_icon',
+                None):
+            # the icon file may have been replaced since we cached images
+            # for it
+            imagepool.invalidate(tab_icon)
         self.init_info(info)
-        old_name = self.view.model[self.iter_map[info.id]][0].name
         self.view.update_tab(self.iter_map[info.id], info)
         if old_name != info.name:
             self.emit('tab-name-changed', old_name, info.name)
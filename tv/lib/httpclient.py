@@ -35,10 +35,12 @@ The main ways this module used is grab_url() and grab_headers().  grab_url
 fetches a HTTP or HTTPS url, while grab_headers only fetches the headers.
 """
 
+import copy
 import logging
 import os
 import stat
 import threading
+import time
 import urllib
 import Queue
 from cStringIO import StringIO
@@ -67,6 +69,16 @@ except:
 
 REDIRECTION_LIMIT = 10
 MAX_AUTH_ATTEMPTS = 5
+# Number of idle easy handles LibCURLManager keeps around for reuse
+HANDLE_POOL_SIZE = 16
+# Limits on the connections libcurl opens to a single host and on how many
+# connections it keeps alive in total.
+MAX_HOST_CONNECTIONS = 8
+MAX_CACHED_CONNECTIONS = 32
+# How often byte range transfers flush their data to disk.  The synced size
+# is what the segmented downloader stores, so that's how much we can lose
+# when we crash.
+SYNC_INTERVAL = 5.0
 
 _logged_noproxy_error = False
 
@@ -203,7 +215,8 @@ class TransferOptions(object):
     """
 
     def __init__(self, url, etag=None, modified=None, resume=False,
-            post_vars=None, post_files=None, write_file=None):
+            post_vars=None, post_files=None, write_file=None,
+            byte_range=None):
         self.url = url
         self.etag = etag
         self.modified = modified
@@ -211,6 +224,7 @@ class TransferOptions(object):
         self.post_vars = post_vars
         self.post_files = post_files
         self.write_file = write_file
+        self.byte_range = byte_range
         self.requires_cookies = False
         self.head_request = False
         self.invalid_url = False
@@ -237,22 +251,23 @@ class TransferOptions(object):
             self.invalid_url = True
             return
 
-    def build_handle(self, out_headers):
-        """Build a libCURL handle.  This should only be called inside the
+    def build_handle(self, handle, out_headers):
+        """Setup a libCURL handle.  This should only be called inside the
         LibCURLManager thread.
+
+        :param handle: a new handle, or one that has been reset
         """
         if self.etag is not None:
             out_headers['etag'] = self.etag
         if self.modified is not None:
             out_headers['If-Modified-Since'] = self.modified
 
-        handle = self._init_handle()
+        self._init_handle(handle)
         self._setup_post(handle, out_headers)
         self._setup_headers(handle, out_headers)
         return handle
 
-    def _init_handle(self):
-        handle = pycurl.Curl()
+    def _init_handle(self, handle):
         handle.setopt(pycurl.USERAGENT, user_agent())
         handle.setopt(pycurl.FOLLOWLOCATION, 1)
         handle.setopt(pycurl.MAXREDIRS, REDIRECTION_LIMIT)
@@ -343,7 +358,15 @@ class CurlTransfer(object):
         self.errback = errback
         self.auth_attempts = {'http': 0, 'proxy': 0}
         self.canceled = False
+        self.cancel_callback = None
         self.last_url = None
+        # Ask for a compressed response and let libcurl decode it as it
+        # comes in.  We don't do this when writing to a file, since resuming
+        # and the size checks there all work with the raw bytes.
+        self.negotiate_encoding = (options.write_file is None and
+                not options._cancel_on_body_data)
+        # bytes/second, 0 means no limit.  See HTTPClient.set_max_recv_speed()
+        self.max_recv_speed = 0
 
         self.stats = TransferStats()
         self._lookup_auth()
@@ -358,6 +381,9 @@ class CurlTransfer(object):
         self.headers_finished = False
         self._filehandle = None
         self.resume_from = 0
+        self.decoded_size = 0
+        self.synced_size = 0
+        self.last_sync = time.time()
         self.out_headers = {}
         self.status_code = None
         self.trying_head_request = False
@@ -380,7 +406,8 @@ class CurlTransfer(object):
                 return
             raise
 
-    def cancel(self, remove_file):
+    def cancel(self, remove_file, callback=None):
+        self.cancel_callback = callback
         curl_manager.remove_transfer(self, remove_file)
         self.canceled = True
 
@@ -455,7 +482,8 @@ class CurlTransfer(object):
         """Build a libCURL handle.  This should only be called inside the
         LibCURLManager thread.
         """
-        self.handle = self.options.build_handle(self.out_headers)
+        self.handle = self.options.build_handle(curl_manager.get_handle(),
+                self.out_headers)
         # don't authenticate SSL certificates see #15180
         self.handle.setopt(pycurl.SSL_VERIFYPEER, 0)
 
@@ -464,20 +492,28 @@ class CurlTransfer(object):
         if self.options._cancel_on_body_data:
             self.handle.setopt(pycurl.WRITEFUNCTION, self._write_func_abort)
         elif self.options.write_file is not None:
-            if not self.saw_head_success:
+            if not self.saw_head_success and self.options.byte_range is None:
                 # try a HEAD request first to see if the request will work.
                 # It avoids the issue of RESUME_FROM being applied to the 
-                # error response.
+                # error response.  Byte range requests skip this, since we
+                # only accept a 206 response for them.
                 self.handle.setopt(pycurl.NOBODY, 1)
                 self.trying_head_request = True
             else:
-                self.handle.setopt(pycurl.URL, self.last_url)
+                if self.last_url is not None:
+                    self.handle.setopt(pycurl.URL, self.last_url)
                 self._open_file()
                 self.handle.setopt(pycurl.WRITEFUNCTION, self._write_file)
         elif self.content_check_callback is not None:
             self.handle.setopt(pycurl.WRITEFUNCTION, self._call_content_check)
         else:
-            self.handle.setopt(pycurl.WRITEFUNCTION, self.buffer.write)
+            self.handle.setopt(pycurl.WRITEFUNCTION, self._write_buffer)
+        if self.negotiate_encoding:
+            # An empty string means every encoding that libcurl supports
+            self.handle.setopt(pycurl.ENCODING, '')
+        if self.max_recv_speed:
+            self.handle.setopt(pycurl.MAX_RECV_SPEED_LARGE,
+                    self.max_recv_speed)
         self.handle.setopt(pycurl.HEADERFUNCTION, self.header_func)
         if self.should_debug_request():
             logging.warn("debugging request: %s", self.options.url)
@@ -486,8 +522,13 @@ class CurlTransfer(object):
 
     def _write_file(self, buf):
         if self.check_response_code(self.status_code):
+            self.decoded_size += len(buf)
             self._filehandle.write(buf)
 
+    def _write_buffer(self, buf):
+        self.decoded_size += len(buf)
+        self.buffer.write(buf)
+
     def _lookup_auth(self):
         """Lookup existing HTTP passwords to use.
 
@@ -526,13 +567,24 @@ class CurlTransfer(object):
                     str(app.config.get(prefs.HTTP_PROXY_AUTHORIZATION_PASSWORD))))
 
     def _call_content_check(self, data):
-        self.buffer.write(data)
+        self._write_buffer(data)
         rv = trap_call('content check callback', self.content_check_callback,
                 self.buffer.getvalue())
         if rv == False or isinstance(rv, Exception):
             curl_manager.remove_transfer(self)
 
     def _open_file(self):
+        if self.options.byte_range is not None:
+            # write the range into the existing file, at its offset
+            start, end = self.options.byte_range
+            self.handle.setopt(pycurl.RANGE, '%d-%d' % (start, end))
+            try:
+                self._filehandle = fileutil.open_file(
+                    self.options.write_file, 'r+b')
+                self._filehandle.seek(start)
+            except IOError:
+                raise WriteError(self.options.write_file)
+            return
         if self.options.resume:
             mode = 'ab'
             try:
@@ -626,6 +678,10 @@ class CurlTransfer(object):
                     args=(self._make_callback_info(),))
 
     def check_response_code(self, code):
+        if self.options.byte_range is not None:
+            # A 200 response means the server is ignoring the range and
+            # sending the whole file.
+            return code == 206
         expected_codes = set([200])
         if self.options.resume:
             expected_codes.add(206)
@@ -658,7 +714,10 @@ class CurlTransfer(object):
         info = self._make_callback_info()
         self.last_url = self.handle.getinfo(pycurl.EFFECTIVE_URL)
         if self.options.write_file is None:
-            if gzip and info.get('content-encoding', '') == 'gzip':
+            # If we negotiated the encoding, libcurl has already decoded the
+            # body.  Otherwise, handle servers that gzip it without asking.
+            if (not self.negotiate_encoding and gzip and
+                    info.get('content-encoding', '') == 'gzip'):
                 try:
                     self.buffer.seek(0)
                     info['body'] = gzip.GzipFile(
@@ -710,6 +769,9 @@ class CurlTransfer(object):
                 fileutil.remove(self.options.write_file)
             except OSError:
                 pass
+        if self.cancel_callback is not None:
+            eventloop.add_idle(self.cancel_callback,
+                    'curl transfer cancel callback')
 
     def find_value_from_header(self, header, target):
         """Finds a value from a response header that uses key=value pairs with
@@ -771,6 +833,15 @@ class CurlTransfer(object):
             # Hack for proxy authentication errors with HTTPS
             self.handle_proxy_auth()
             return
+        elif (code == pycurl.E_BAD_CONTENT_ENCODING and
+                self.negotiate_encoding):
+            # The server used an encoding that libcurl can't decode.  Try
+            # again without asking for any.
+            logging.info("httpclient: bad content encoding for %s, "
+                         "retrying without compression", self.options.url)
+            self.negotiate_encoding = False
+            self._send_new_request()
+            return
         else:
             logging.warn("Unknown network error.  Code: %s", code)
             errstr = handle.errstr()
@@ -794,9 +865,31 @@ class CurlTransfer(object):
 
     def _cleanup_filehandle(self):
         if self._filehandle is not None:
+            if self.options.byte_range is not None:
+                self._sync_file()
+                # the handle may be gone, so we can't call build_stats()
+                new_stats = copy.copy(self.stats)
+                new_stats.synced = self.synced_size
+                self.lock.acquire()
+                try:
+                    self.stats = new_stats
+                finally:
+                    self.lock.release()
             self._filehandle.close()
             self._filehandle = None
 
+    def _sync_file(self):
+        """Flush the data we've written so far to disk."""
+        self.last_sync = time.time()
+        try:
+            self._filehandle.flush()
+            os.fsync(self._filehandle.fileno())
+        except (IOError, OSError), e:
+            logging.warn("httpclient: error syncing %s: %s",
+                         self.options.write_file, e)
+        else:
+            self.synced_size = self.decoded_size
+
     def build_stats(self):
         stats = TransferStats()
         getinfo = self.handle.getinfo # for easy typing
@@ -806,6 +899,8 @@ class CurlTransfer(object):
         stats.upload_total = self.options.post_length
 
         stats.downloaded = int(getinfo(pycurl.SIZE_DOWNLOAD))
+        stats.decoded = self.decoded_size
+        stats.synced = self.synced_size
         stats.uploaded = int(getinfo(pycurl.SIZE_UPLOAD))
         stats.download_rate = int(getinfo(pycurl.SPEED_DOWNLOAD))
         stats.upload_rate = int(getinfo(pycurl.SPEED_UPLOAD))
@@ -815,6 +910,10 @@ class CurlTransfer(object):
         return stats
 
     def update_stats(self):
+        if (self.options.byte_range is not None and
+                self._filehandle is not None and
+                time.time() - self.last_sync >= SYNC_INTERVAL):
+            self._sync_file()
         new_stats = self.build_stats()
         self.lock.acquire()
         try:
@@ -834,7 +933,11 @@ class TransferStats(object):
 
     Attributes:
         status_code -- HTTP status code (or None if we haven't seen one yet)
-        downloaded -- current bytes downloaded
+        downloaded -- current bytes downloaded, as sent over the wire
+        decoded -- current bytes downloaded, after removing any
+            content-encoding
+        synced -- bytes written to disk and synced.  Only tracked for
+            byte range transfers.
         uploaded -- current bytes uploaded
         download_total -- total bytes to download (or -1 if we don't know)
         upload_total -- total bytes to upload (or -1 if we don't know)
@@ -844,11 +947,31 @@ class TransferStats(object):
     """
     def __init__(self):
         self.downloaded = self.download_total = 0
+        self.decoded = self.synced = 0
         self.uploaded = self.upload_total = -1
         self.download_rate = self.upload_rate = 0
         self.initial_size = 0
         self.status_code = None
 
+class ConnectionStats(object):
+    """Holds data about how well LibCURLManager is reusing things.
+
+    Attributes:
+        handles_created -- number of libcurl easy handles created
+        handles_reused -- number of transfers that used a pooled handle
+        transfers -- number of transfers that finished
+        connections_reused -- number of finished transfers that didn't need
+            to open a new connection
+    """
+    def __init__(self):
+        self.handles_created = self.handles_reused = 0
+        self.transfers = self.connections_reused = 0
+
+    def connection_reuse_rate(self):
+        if self.transfers == 0:
+            return 0.0
+        return float(self.connections_reused) / self.transfers
+
 class LibCURLManager(eventloop.SimpleEventLoop):
     """Manage a set of CurlTransfers.
 
@@ -857,16 +980,35 @@ class LibCURLManager(eventloop.SimpleEventLoop):
       - Runs a thread for pycurl to use
       - Manages the libcurl multi object
       - Handles adding/removing CurlTransfers objects
+      - Keeps a pool of easy handles and a CurlShare object, so that DNS
+        lookups, connections and SSL sessions get reused between transfers
     """
 
     def __init__(self):
         eventloop.SimpleEventLoop.__init__(self)
         self.multi = pycurl.CurlMulti()
+        self._setup_multi()
+        self.share = pycurl.CurlShare()
+        self.share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_DNS)
+        self.share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_SSL_SESSION)
+        self.handle_pool = []
+        self.connection_stats = ConnectionStats()
         self.transfer_map = {}
         self.transfers_to_add = Queue.Queue()
         self.transfers_to_remove = Queue.Queue()
+        self.transfers_to_throttle = Queue.Queue()
         self.after_perform_callbacks = []
 
+    def _setup_multi(self):
+        # Older libcurl versions don't have these options.  That's okay, the
+        # limits are just a nicety.
+        for name, value in (('M_MAX_HOST_CONNECTIONS', MAX_HOST_CONNECTIONS),
+                            ('M_MAXCONNECTS', MAX_CACHED_CONNECTIONS)):
+            try:
+                self.multi.setopt(getattr(pycurl, name), value)
+            except (AttributeError, pycurl.error), e:
+                logging.info("httpclient: can't set %s: %s", name, e)
+
     def start(self):
         self.thread = threading.Thread(target=utils.thread_body,
                                        args=[self.loop],
@@ -883,7 +1025,43 @@ class LibCURLManager(eventloop.SimpleEventLoop):
         for transfer in self.transfer_map.values():
             self.multi.remove_handle(transfer.handle)
             transfer.handle.close()
+        for handle in self.handle_pool:
+            handle.close()
+        self.handle_pool = []
         self.multi.close()
+        self.share.close()
+
+    def get_handle(self):
+        """Get a libcurl easy handle to use for a transfer.
+
+        This should only be called inside the LibCURLManager thread.
+        """
+        if self.handle_pool:
+            handle = self.handle_pool.pop()
+            self.connection_stats.handles_reused += 1
+        else:
+            # reset() keeps the share, so we only need to set it up once
+            handle = pycurl.Curl()
+            handle.setopt(pycurl.SHARE, self.share)
+            self.connection_stats.handles_created += 1
+        return handle
+
+    def release_handle(self, handle, transfer):
+        """Take back a handle from a transfer that we're done with.
+
+        Handles go back into the pool unless it's full.  Handles used with
+        cookies don't, since reset() leaves the cookie engine running.
+        """
+        if transfer.handle is handle:
+            # make sure a late cancel() can't touch the handle once another
+            # transfer is using it
+            transfer.handle = None
+        if (len(self.handle_pool) >= HANDLE_POOL_SIZE or
+                transfer.options.requires_cookies):
+            handle.close()
+        else:
+            handle.reset()
+            self.handle_pool.append(handle)
 
     def add_transfer(self, transfer):
         self.transfers_to_add.put(transfer)
@@ -893,6 +1071,10 @@ class LibCURLManager(eventloop.SimpleEventLoop):
         self.transfers_to_remove.put((transfer, remove_file))
         self.wakeup()
 
+    def update_max_recv_speed(self, transfer):
+        self.transfers_to_throttle.put(transfer)
+        self.wakeup()
+
     def call_after_perform(self, callback):
         self.after_perform_callbacks.append(callback)
 
@@ -949,20 +1131,45 @@ class LibCURLManager(eventloop.SimpleEventLoop):
                 del self.transfer_map[transfer.handle]
             except KeyError:
                 continue
-            self.multi.remove_handle(transfer.handle)
+            handle = transfer.handle
+            self.multi.remove_handle(handle)
+            self.release_handle(handle, transfer)
+
+        while True:
+            try:
+                transfer = self.transfers_to_throttle.get_nowait()
+            except Queue.Empty:
+                break
+            # If the transfer isn't running, the new speed gets picked up
+            # the next time build_handle() is called.
+            if self.transfer_map.get(transfer.handle) is transfer:
+                transfer.handle.setopt(pycurl.MAX_RECV_SPEED_LARGE,
+                        transfer.max_recv_speed)
 
     def check_finished(self):
         queued, finished, errors = self.multi.info_read()
         for handle in finished:
             try:
-                self.pop_transfer(handle).on_finished()
+                transfer = self.pop_transfer(handle)
+                self.update_connection_stats(handle)
+                transfer.on_finished()
             except StandardError:
                 logging.stacktrace("Error calling on_finished()")
+            else:
+                self.release_handle(handle, transfer)
         for handle, code, message in errors:
             try:
-                self.pop_transfer(handle).on_error(code, handle)
+                transfer = self.pop_transfer(handle)
+                transfer.on_error(code, handle)
             except StandardError:
                 logging.stacktrace("Error calling on_error()")
+            else:
+                self.release_handle(handle, transfer)
+
+    def update_connection_stats(self, handle):
+        self.connection_stats.transfers += 1
+        if handle.getinfo(pycurl.NUM_CONNECTS) == 0:
+            self.connection_stats.connections_reused += 1
 
     def pop_transfer(self, handle):
         transfer = self.transfer_map.pop(handle)
@@ -979,8 +1186,22 @@ class HTTPClient(object):
     def __init__(self, transfer):
         self.transfer = transfer
 
-    def cancel(self, remove_file=False):
-        self.transfer.cancel(remove_file)
+    def cancel(self, remove_file=False, callback=None):
+        """Stop the transfer.
+
+        :param remove_file: remove the file we were writing to
+        :param callback: function to call once the transfer has been
+            removed and its file closed
+        """
+        self.transfer.cancel(remove_file, callback)
+
+    def set_max_recv_speed(self, speed):
+        """Limit how fast we download.
+
+        :param speed: max download rate in bytes/second, 0 means no limit
+        """
+        self.transfer.max_recv_speed = speed
+        curl_manager.update_max_recv_speed(self.transfer)
 
     def get_stats(self):
         """Get the current download/upload stats
@@ -1001,7 +1222,7 @@ def sanitize_url(url):
 def grab_url(url, callback, errback, header_callback=None,
         content_check_callback=None, write_file=None, etag=None, modified=None,
         default_mime_type=None, resume=False, post_vars=None,
-        post_files=None):
+        post_files=None, byte_range=None):
     """Quick way to download a network resource
 
     grab_url is a simple interface to the HTTPClient class.
@@ -1022,6 +1243,9 @@ def grab_url(url, callback, errback, header_callback=None,
     :param post_vars: dictionary of variables to send as POST data
     :param post_files: files to send as POST data (see
         xhtmltools.multipart_encode for the format)
+    :param byte_range: (start, end) tuple.  If given, write_file must already
+        exist.  We request bytes start through end (inclusive) and write them
+        into write_file at offset start.
 
     The callback will be passed a dictionary that contains all the HTTP
     headers, as well as the following keys:
@@ -1045,7 +1269,7 @@ def grab_url(url, callback, errback, header_callback=None,
         return _grab_file_url(url, callback, errback, default_mime_type)
     else:
         options = TransferOptions(url, etag, modified, resume, post_vars,
-                post_files, write_file)
+                post_files, write_file, byte_range)
         transfer = CurlTransfer(options, callback, errback, header_callback,
                 content_check_callback)
         transfer.start()
@@ -28,20 +28,95 @@
 # statement from all source files in the program, then also delete it here.
 
 import os
+import re
 import logging
 import collections
+import hashlib
 
 from miro import httpclient
 from miro import eventloop
 from miro.database import DDBObject, ObjectNotFoundError
 from miro.download_utils import next_free_filename, get_file_url_path
 from miro.util import unicodify
-from miro.plat.utils import unicode_to_filename
+from miro.plat.utils import unicode_to_filename, filename_to_unicode
 from miro import app
+from miro import models
 from miro import prefs
 from miro import fileutil
 
-RUNNING_MAX = 3
+# extensions that we keep when naming files in the icon cache
+_EXTENSION_RE = re.compile(r'^\.[A-Za-z0-9]{1,5}$')
+
+def _hash_file(path):
+    """Get a hex SHA1 digest of a file's contents."""
+    hasher = hashlib.sha1()
+    f = fileutil.open_file(path, 'rb')
+    try:
+        while True:
+            data = f.read(65536)
+            if not data:
+                break
+            hasher.update(data)
+    finally:
+        f.close()
+    return hasher.hexdigest()
+
+def _store_file(tmp_filename, name_hint):
+    """Move a downloaded file into the icon cache directory.
+
+    Files are named after the SHA1 of their contents, so identical icons
+    downloaded for different objects (or from different URLs) end up
+    sharing a single file.
+
+    :param tmp_filename: path to the downloaded data
+    :param name_hint: filename from the HTTP response, used for the extension
+    :returns: path of the file in the cache, or None if we couldn't store it
+    """
+    cachedir = app.config.get(prefs.ICON_CACHE_DIRECTORY)
+    ext = os.path.splitext(name_hint or '')[1]
+    if not _EXTENSION_RE.match(ext):
+        ext = ''
+    try:
+        filename = os.path.join(cachedir, _hash_file(tmp_filename) +
+                str(ext))
+    except IOError:
+        logging.warn("iconcache: error reading %r", tmp_filename)
+        _remove_file(tmp_filename)
+        return None
+    if fileutil.exists(filename):
+        # we already have this file
+        _remove_file(tmp_filename)
+        return filename
+    try:
+        fileutil.rename(tmp_filename, filename)
+    except (IOError, OSError):
+        logging.exception("iconcache: fileutil.rename failed")
+        _remove_file(tmp_filename)
+        return None
+    return filename
+
+def _remove_file(filename):
+    try:
+        fileutil.remove(filename)
+    except OSError:
+        pass
+
+# maps URLs that are being downloaded to the IconCache objects waiting for
+# that download to finish
+_downloads_in_progress = {}
+
+def _finish_download(url, filename, etag=None, modified=None):
+    """Pass the result of a download to the IconCache objects waiting on it.
+
+    If the download failed, filename should be None.
+    """
+    for icon_cache in _downloads_in_progress.pop(url, ()):
+        if icon_cache.removed:
+            continue
+        if filename is None:
+            icon_cache.update_failed(url)
+        else:
+            icon_cache.use_file(url, filename, etag, modified)
 
 class IconCacheUpdater:
     def __init__(self):
@@ -56,7 +131,7 @@ class IconCacheUpdater:
             if (item.filename and fileutil.access(item.filename, os.R_OK)
                    and item.url == item.dbItem.get_thumbnail_url()):
                 is_vital = False
-        if self.running_count < RUNNING_MAX:
+        if self.running_count < app.config.get(prefs.MAX_ICON_DOWNLOADS):
             eventloop.add_idle(item.request_icon, "Icon Request")
             self.running_count += 1
         else:
@@ -117,6 +192,25 @@ class IconCache(DDBObject):
     def all_filenames(cls):
         return [r[0] for r in cls.select(["filename"], 'filename IS NOT NULL')]
 
+    @classmethod
+    def filename_users_view(cls, filename, exclude_id=None):
+        """IconCache objects using filename, except the one with exclude_id.
+        """
+        return cls.make_view('filename=? AND id != ?',
+                (filename_to_unicode(filename), exclude_id))
+
+    def find_cached_file(self, url):
+        """Find a file that another IconCache downloaded for url.
+
+        Returns the filename or None.
+        """
+        for filename, in IconCache.select(['filename'],
+                'url=? AND filename IS NOT NULL AND id != ?',
+                (url, self.id)):
+            if fileutil.access(filename, os.R_OK):
+                return filename
+        return None
+
     def icon_changed(self, needs_save=True):
         self.signal_change(needs_save=needs_save)
         if hasattr(self.dbItem, 'icon_changed'):
@@ -126,13 +220,18 @@ class IconCache(DDBObject):
 
     def remove(self):
         self.removed = True
-        if self.filename:
-            self.remove_file(self.filename)
         DDBObject.remove(self)
 
-    def reset(self):
+    def removed_from_db(self):
+        DDBObject.removed_from_db(self)
+        # Wait until our row is deleted to release our file.  Inside a
+        # BulkSQLManager region, this happens after all the other removed
+        # IconCaches are deleted, so they won't keep the file alive.
         if self.filename:
-            self.remove_file(self.filename)
+            self.release_file(self.filename)
+
+    def reset(self):
+        filename = self.filename
         self.filename = None
         self.url = None
         self.etag = None
@@ -141,128 +240,91 @@ class IconCache(DDBObject):
         self.updating = False
         self.needsUpdate = False
         self.icon_changed()
+        if filename:
+            self.release_file(filename)
 
     def remove_file(self, filename):
-        try:
-            fileutil.remove(filename)
-        except OSError:
-            pass
+        _remove_file(filename)
 
-    def error_callback(self, url, error=None):
-        self.dbItem.confirm_db_thread()
+    def release_file(self, filename):
+        """Remove a file we no longer use, unless another IconCache
+        shares it.
+        """
+        if IconCache.filename_users_view(filename, self.id).count() == 0:
+            self.remove_file(filename)
 
-        if self.removed:
-            icon_cache_updater.update_finished()
-            return
+    def error_callback(self, url, error=None, tmp_filename=None):
+        self.dbItem.confirm_db_thread()
+        if tmp_filename is not None:
+            self.remove_file(tmp_filename)
+        _finish_download(url, None)
+        if not self.removed:
+            self.update_failed(url)
+        icon_cache_updater.update_finished()
 
+    def update_failed(self, url):
+        """Handle an update that failed to download url."""
         # Don't clear the cache on an error.
         if self.url != url:
             self.url = url
             self.etag = None
             self.modified = None
             self.icon_changed()
+        self.update_done()
+
+    def update_done(self):
         self.updating = False
         if self.needsUpdate:
             self.needsUpdate = False
             self.request_update(True)
-        icon_cache_updater.update_finished()
-
-    def update_icon_cache(self, url, info):
-        self.dbItem.confirm_db_thread()
 
-        if self.removed:
-            icon_cache_updater.update_finished()
-            return
+    def use_file(self, url, filename, etag, modified):
+        """Start using a file in the icon cache for url."""
+        old_filename = self.filename
+        self.filename = filename
+        self.url = url
+        self.etag = etag
+        self.modified = modified
+        self.icon_changed()
+        if old_filename and old_filename != filename:
+            self.release_file(old_filename)
+        self.update_done()
 
-        needs_save = False
-        needsChange = False
+    def update_icon_cache(self, url, info, tmp_filename):
+        self.dbItem.confirm_db_thread()
 
         if info == None or (info['status'] != 304 and info['status'] != 200):
-            self.error_callback(url, "bad response")
+            self.error_callback(url, "bad response", tmp_filename)
             return
-        try:
+        if info['status'] == 304:
             # Our cache is good.  Hooray!
-            if info['status'] == 304:
-                return
-
-            needsChange = True
-
-            # We have to update it, and if we can't write to the file, we
-            # should pick a new filename.
-            if ((self.filename and
-                 not fileutil.access(self.filename, os.R_OK | os.W_OK))):
-                self.filename = None
-
-            cachedir = app.config.get(prefs.ICON_CACHE_DIRECTORY)
-            try:
-                fileutil.makedirs(cachedir)
-            except OSError:
-                pass
-
-            try:
-                # Write to a temp file.
-                if self.filename:
-                    tmp_filename = self.filename + ".part"
-                else:
-                    tmp_filename = os.path.join(cachedir, info["filename"]) + ".part"
-                tmp_filename, output = next_free_filename(tmp_filename)
-                output.write(info["body"])
-                output.close()
-            except IOError:
-                self.remove_file(tmp_filename)
-                return
-            except ValueError:
-                logging.warn('update_icon_cache: next_free_filename failed '
-                             '#1, candidate = %r', tmp_filename)
-                return
-
-            filename = unicode(info["filename"])
-            filename = unicode_to_filename(filename, cachedir)
-            filename = os.path.join(cachedir, filename)
-            needs_save = True
-            try:
-                filename, fp = next_free_filename(filename)
-            except ValueError:
-                logging.warn('update_icon_cache: next_free_filename failed '
-                             '#2, candidate = %r', filename)
-                return
-
+            self.remove_file(tmp_filename)
             if self.filename:
-                filename = self.filename
-                self.filename = None
-                self.remove_file(filename)
+                _finish_download(url, self.filename, self.etag,
+                        self.modified)
+            else:
+                _finish_download(url, None)
+            if not self.removed:
+                self.update_done()
+            icon_cache_updater.update_finished()
+            return
 
-            # we need to move the file here--so we close the file
-            # pointer and then move the file.
-            fp.close()
-            try:
-                self.remove_file(filename)
-                fileutil.rename(tmp_filename, filename)
-            except (IOError, OSError):
-                logging.exception("iconcache: fileutil.move failed")
-                filename = None
-
-            self.filename = filename
-
-            etag = unicodify(info.get("etag"))
-            modified = unicodify(info.get("modified"))
-
-            if self.etag != etag:
-                needs_save = True
-                self.etag = etag
-            if self.modified != modified:
-                needs_save = True
-                self.modified = modified
-            if self.url != url:
-                needs_save = True
-                self.url = url
+        etag = unicodify(info.get("etag"))
+        modified = unicodify(info.get("modified"))
+        if self.removed and not _downloads_in_progress.get(url):
+            # nobody wants this file anymore
+            self.remove_file(tmp_filename)
+            filename = None
+        else:
+            filename = _store_file(tmp_filename, info.get("filename"))
+        try:
+            _finish_download(url, filename, etag, modified)
+            if not self.removed:
+                if filename is None:
+                    self.update_failed(url)
+                else:
+                    self.use_file(url, filename, etag, modified)
         finally:
-            if needsChange:
-                self.icon_changed(needs_save=needs_save)
-            self.updating = False
-            if self.needsUpdate:
-                self.needsUpdate = False
-                self.request_update(True)
             icon_cache_updater.update_finished()
 
     def request_icon(self):
@@ -294,9 +356,41 @@ class IconCache(DDBObject):
             self.error_callback(url)
             return
 
+        # Share the file if another object already downloaded this URL
+        filename = self.find_cached_file(url)
+        if filename is not None:
+            self.use_file(url, filename, None, None)
+            icon_cache_updater.update_finished()
+            return
+
+        # If the URL is already being downloaded, wait for that download
+        # rather than starting another one.  We don't need an update slot
+        # while we wait.
+        if url in _downloads_in_progress:
+            _downloads_in_progress[url].append(self)
+            icon_cache_updater.update_finished()
+            return
+
+        cachedir = app.config.get(prefs.ICON_CACHE_DIRECTORY)
+        try:
+            fileutil.makedirs(cachedir)
+        except OSError:
+            pass
+        try:
+            tmp_filename, fp = next_free_filename(os.path.join(cachedir,
+                'download.part'))
+        except ValueError:
+            logging.warn('request_icon: next_free_filename failed')
+            self.error_callback(url)
+            return
+        fp.close()
+
         # Last try, get the icon from HTTP.
-        httpclient.grab_url(url, lambda info: self.update_icon_cache(url, info),
-                lambda error: self.error_callback(url, error))
+        _downloads_in_progress[url] = []
+        httpclient.grab_url(url,
+                lambda info: self.update_icon_cache(url, info, tmp_filename),
+                lambda error: self.error_callback(url, error, tmp_filename),
+                write_file=tmp_filename)
 
     def request_update(self, is_vital=False):
         if hasattr(self, "updating") and hasattr(self, "dbItem"):
@@ -323,6 +417,60 @@ class IconCache(DDBObject):
         else:
             return self.filename
 
+def _set_shared_filename(icon_cache_id, filename):
+    try:
+        icon_cache = IconCache.get_by_id(icon_cache_id)
+    except ObjectNotFoundError:
+        return
+    icon_cache.filename = filename
+    for klass in (models.Item, models.Feed, models.ChannelGuide):
+        for owner in klass.make_view('icon_cache_id=?', (icon_cache_id,)):
+            icon_cache.dbItem = owner
+            icon_cache.icon_changed()
+            return
+    icon_cache.signal_change()
+
+def collapse_duplicate_files():
+    """Make IconCache objects with identical files share a single file.
+
+    Older versions saved a separate file for each IconCache object, even when
+    many of them downloaded the same icon.  This is a generator that yields
+    between steps, so that it can be used in an idle iterator.
+    """
+    # maps filenames to the ids of the IconCache objects using them
+    users = {}
+    for icon_cache_id, filename in IconCache.select(['id', 'filename'],
+            'filename IS NOT NULL'):
+        users.setdefault(filename, []).append(icon_cache_id)
+    yield None
+
+    # only files with the same size can have the same contents
+    by_size = {}
+    for filename in users:
+        try:
+            size = fileutil.getsize(filename)
+        except OSError:
+            continue
+        by_size.setdefault(size, []).append(filename)
+    yield None
+
+    for filenames in by_size.itervalues():
+        if len(filenames) < 2:
+            continue
+        by_hash = {}
+        for filename in filenames:
+            try:
+                by_hash.setdefault(_hash_file(filename), []).append(filename)
+            except IOError:
+                pass
+        for same_files in by_hash.itervalues():
+            keep = same_files[0]
+            for filename in same_files[1:]:
+                for icon_cache_id in users[filename]:
+                    _set_shared_filename(icon_cache_id, keep)
+                _remove_file(filename)
+        yield None
+
 def make_icon_cache(obj):
     if obj.icon_cache_id is not None:
         try:
@@ -31,6 +31,7 @@
 """
 
 from datetime import datetime, timedelta
+import heapq
 import locale
 import os.path
 import traceback
@@ -364,6 +365,9 @@ class Item(DDBObject, iconcache.IconCacheOwnerMixin, metadata.Store):
     def setup_new(self, fp_values, linkNumber=0, feed_id=None, parent_id=None,
             eligibleForAutoDownload=True, channel_title=None):
         metadata.Store.setup_new(self)
+        # we haven't been counted towards any feed yet.  See
+        # _update_feed_counts()
+        self._counted_state = None
         self.is_file_item = False
         self.feed_id = feed_id
         self.parent_id = parent_id
@@ -415,10 +419,15 @@ class Item(DDBObject, iconcache.IconCacheOwnerMixin, metadata.Store):
 
     def after_setup_new(self):
         app.item_info_cache.item_created(self)
+        self._update_feed_counts()
 
     def signal_change(self, needs_save=True):
         app.item_info_cache.item_changed(self)
+        if _expire_scheduler is not None:
+            _expire_scheduler.item_changed(self)
         DDBObject.signal_change(self, needs_save)
+        if not self.in_db_init:
+            self._update_feed_counts()
 
     @classmethod
     def auto_pending_view(cls):
@@ -628,6 +637,95 @@ class Item(DDBObject, iconcache.IconCacheOwnerMixin, metadata.Store):
                 (feed_id,),
                 joins={'feed': 'item.feed_id=feed.id'})
 
+    @classmethod
+    def feed_counts(cls, feed_ids):
+        """Count items for several feeds using a single query.
+
+        This calculates the same counts as feed_downloaded_view(),
+        feed_downloading_view(), feed_unwatched_view(),
+        feed_available_view() and feed_auto_pending_view().
+
+        :returns: dict mapping feed ids to (downloaded, downloading,
+            unwatched, available, auto_pending) tuples.  Feeds without any
+            items won't be in the dict.
+        """
+        columns = ['item.feed_id',
+                "SUM(is_file_item OR rd.state in ('finished', 'uploading', "
+                "'uploading-paused'))",
+                "SUM(rd.state in ('downloading', 'uploading') AND "
+                "rd.main_item_id=item.id)",
+                "SUM(not seen AND file_type in ('audio', 'video') AND "
+                "(is_file_item OR rd.state in ('finished', 'uploading', "
+                "'uploading-paused')))",
+                "SUM(NOT autoDownloaded AND downloadedTime IS NULL AND "
+                "NOT is_file_item AND feed.last_viewed <= item.creationTime)",
+                "SUM(feed.autoDownloadable AND NOT item.was_downloaded AND "
+                "(item.eligibleForAutoDownload OR feed.getEverything))",
+        ]
+        joins = {'remote_downloader AS rd': 'item.downloader_id=rd.id',
+                'feed': 'item.feed_id=feed.id'}
+        counts = {}
+        feed_ids = list(feed_ids)
+        # stay well under SQLite's limit on the number of query parameters
+        for start in xrange(0, len(feed_ids), 500):
+            chunk = feed_ids[start:start+500]
+            where = 'item.feed_id IN (%s)' % ', '.join('?' * len(chunk))
+            for row in cls.select(columns, where, chunk, convert=False,
+                    joins=joins, group_by='item.feed_id'):
+                # SUM() returns NULL if all of the rows are NULL
+                counts[row[0]] = tuple(int(count or 0) for count in row[1:])
+        return counts
+
+    def feed_count_state(self):
+        """Get the values that decide which feed counts we're part of.
+
+        This is the python version of the item half of the SQL in
+        feed_counts().  Feed.item_counts() combines it with the feed half.
+
+        NB. don't change this without also changing feed_counts()!
+        """
+        downloader_state = self.downloader_state()
+        downloaded = bool(self.is_file_item or downloader_state in (
+            'finished', 'uploading', 'uploading-paused'))
+        downloading = (downloader_state in ('downloading', 'uploading') and
+                self.downloader.main_item_id == self.id)
+        unwatched = (downloaded and not self.seen and
+                self.file_type in ('audio', 'video'))
+        maybe_available = (not self.autoDownloaded and
+                self.downloadedTime is None and not self.is_file_item)
+        return (downloaded, downloading, unwatched, maybe_available,
+                self.creationTime, not self.was_downloaded,
+                bool(self.eligibleForAutoDownload))
+
+    def _update_feed_counts(self, removed=False):
+        """Update our feed's item counts after we changed.
+
+        We remember the state that we last counted towards our feed, so we
+        can just add or subtract 1 from each count that changed.  If we
+        don't know it (for example, we were just restored from the DB), the
+        feed has to recalculate its counts with feed_counts().
+        """
+        if removed or self.feed_id is None:
+            new_state = None
+        else:
+            new_state = (self.feed_id, self.feed_count_state())
+        try:
+            old_state = self._counted_state
+        except AttributeError:
+            if self.feed_id is not None:
+                _invalidate_feed_counts(self.feed_id)
+        else:
+            if old_state is not None and new_state is not None and (
+                    old_state[0] == new_state[0]):
+                _update_item_counts(old_state[0], old_state[1],
+                        new_state[1])
+            else:
+                if old_state is not None:
+                    _update_item_counts(old_state[0], old_state[1], None)
+                if new_state is not None:
+                    _update_item_counts(new_state[0], None, new_state[1])
+        self._counted_state = new_state
+
     @classmethod
     def feed_unwatched_view(cls, feed_id):
         return cls.make_view("feed_id=? AND not seen AND "
@@ -1060,6 +1158,10 @@ class Item(DDBObject, iconcache.IconCacheOwnerMixin, metadata.Store):
     def set_feed(self, feed_id):
         """Moves this item to another feed.
         """
+        if not hasattr(self, '_counted_state') and self.feed_id is not None:
+            # we don't know what we counted towards our old feed, see
+            # _update_feed_counts()
+            _invalidate_feed_counts(self.feed_id)
         self.feed_id = feed_id
         # _feed is created by get_feed which caches the result
         if hasattr(self, "_feed"):
@@ -1983,6 +2085,7 @@ class Item(DDBObject, iconcache.IconCacheOwnerMixin, metadata.Store):
         # need to call this after DDBObject.remove(), so that the item info is
         # there for ItemInfoFetcher to see.
         app.item_info_cache.item_removed(self)
+        self._update_feed_counts(removed=True)
 
     def setup_links(self):
         self.split_item()
@@ -2306,6 +2409,20 @@ def filename_to_title(filename):
 def fp_values_for_file(filename, title=None, description=None):
     return FileFeedParserValues(filename, title, description)
 
+def _invalidate_feed_counts(feed_id):
+    try:
+        feed = models.Feed.get_by_id(feed_id)
+    except ObjectNotFoundError:
+        return
+    feed.invalidate_counts()
+
+def _update_item_counts(feed_id, old_state, new_state):
+    try:
+        feed = models.Feed.get_by_id(feed_id)
+    except ObjectNotFoundError:
+        return
+    feed.update_item_counts(old_state, new_state)
+
 @eventloop.idle_iterator
 def update_incomplete_movie_data():
     """Finds local Items that have not been examined by MDP, and queues them.
@@ -2377,6 +2494,157 @@ class DeletedFileChecker(object):
             if self.items_to_check:
                 self._ensure_run_checks_scheduled()
 
+class ExpireScheduler(object):
+    """Expires watched items when their feed's expiration time is up.
+
+    Expiration times are kept in a heap so that we only wake up when the next
+    item is actually ready to expire, rather than periodically checking every
+    feed.  Entries are validated when they come off the heap, so items that
+    get kept, unwatched or removed can simply be left in there.
+    """
+    def __init__(self):
+        # heap of (expire_time, item_id, key) tuples, where key is the
+        # (watchedTime, feed_id) that expire_time was calculated from
+        self.heap = []
+        # maps item ids to their latest entry.  Heap entries that aren't the
+        # latest entry for their item are stale.
+        self.scheduled = {}
+        self.timeout = None
+        self.timeout_time = None
+        self.started = False
+        self.config_handle = None
+
+    def start(self):
+        """Start expiring items."""
+        self.started = True
+        self.config_handle = app.backend_config_watcher.connect("changed",
+                self.on_config_change)
+        self.schedule_all()
+
+    def stop(self):
+        self.started = False
+        if self.config_handle is not None:
+            app.backend_config_watcher.disconnect(self.config_handle)
+            self.config_handle = None
+        self._cancel_timeout()
+        self.heap = []
+        self.scheduled = {}
+
+    def on_config_change(self, obj, key, value):
+        if key == prefs.EXPIRE_AFTER_X_DAYS.key:
+            self.schedule_all()
+
+    def item_changed(self, item):
+        """Schedule an item after its watchedTime, keep or feed changed."""
+        if (not self.started or item.keep or item.watchedTime is None or
+                item.feed_id is None):
+            # items without a feed (for example children of container
+            # items) never expire, see _schedule_rows()
+            return
+        key = (item.watchedTime, item.feed_id)
+        entry = self.scheduled.get(item.id)
+        if entry is not None and entry[2] == key:
+            return
+        try:
+            delta = models.Feed.get_by_id(item.feed_id).get_expire_delta()
+        except ObjectNotFoundError:
+            return
+        self._schedule(item.id, key, delta)
+        self._update_timeout()
+
+    def schedule_all(self):
+        """Rebuild the schedule for all watched items."""
+        if not self.started:
+            return
+        self.heap = []
+        self.scheduled = {}
+        self._schedule_rows(Item.select(['id', 'watchedTime', 'feed_id'],
+            'watchedTime IS NOT NULL AND NOT keep'))
+
+    def schedule_feed(self, feed_id):
+        """Reschedule items in a feed after its expiration settings change.
+        """
+        if not self.started:
+            return
+        self._schedule_rows(Item.select(['id', 'watchedTime', 'feed_id'],
+            'watchedTime IS NOT NULL AND NOT keep AND feed_id=?',
+            (feed_id,)))
+
+    def _schedule_rows(self, rows):
+        feed_deltas = {}
+        for item_id, watched_time, feed_id in rows:
+            if feed_id not in feed_deltas:
+                try:
+                    feed = models.Feed.get_by_id(feed_id)
+                except ObjectNotFoundError:
+                    feed_deltas[feed_id] = None
+                else:
+                    feed_deltas[feed_id] = feed.get_expire_delta()
+            self._schedule(item_id, (watched_time, feed_id),
+                    feed_deltas[feed_id])
+        self._update_timeout()
+
+    def _schedule(self, item_id, key, delta):
+        if delta is None:
+            self.scheduled[item_id] = (None, item_id, key)
+        else:
+            entry = (key[0] + delta, item_id, key)
+            self.scheduled[item_id] = entry
+            heapq.heappush(self.heap, entry)
+
+    def _cancel_timeout(self):
+        if self.timeout is not None:
+            self.timeout.cancel()
+            self.timeout = self.timeout_time = None
+
+    def _update_timeout(self):
+        # don't wake up for stale entries
+        while self.heap and (self.scheduled.get(self.heap[0][1]) is not
+                self.heap[0]):
+            heapq.heappop(self.heap)
+        if not self.heap:
+            self._cancel_timeout()
+            return
+        next_time = self.heap[0][0]
+        if next_time == self.timeout_time:
+            return
+        self._cancel_timeout()
+        delta = next_time - datetime.now()
+        delay = max(0, delta.days * 86400 + delta.seconds +
+                delta.microseconds / 1000000.0)
+        self.timeout = eventloop.add_timeout(delay, self.expire_items,
+                "Expire Items")
+        self.timeout_time = next_time
+
+    def expire_items(self):
+        """Expire all items whose expiration time has passed."""
+        self.timeout = self.timeout_time = None
+        now = datetime.now()
+        while self.heap and self.heap[0][0] <= now:
+            entry = heapq.heappop(self.heap)
+            expire_time, item_id, key = entry
+            if self.scheduled.get(item_id) is not entry:
+                continue # stale entry
+            del self.scheduled[item_id]
+            try:
+                item = Item.get_by_id(item_id)
+            except ObjectNotFoundError:
+                continue
+            if item.keep or (item.watchedTime, item.feed_id) != key:
+                # kept, or changed in a way that item_changed() will handle
+                continue
+            try:
+                delta = models.Feed.get_by_id(item.feed_id).get_expire_delta()
+            except ObjectNotFoundError:
+                continue
+            if delta is None or key[0] + delta > now:
+                # the feed's expiration settings changed since we scheduled
+                # the item
+                self._schedule(item_id, key, delta)
+                continue
+            item.expire()
+        self._update_timeout()
+
 class DeviceItem(metadata.Store):
     """
     An item which lives on a device.  There's a separate, per-device JSON
@@ -2581,6 +2849,19 @@ def setup_deleted_checker():
 def start_deleted_checker():
     _deleted_file_checker.start_checks()
 
+_expire_scheduler = None
+
+def setup_expire_scheduler():
+    global _expire_scheduler
+    _expire_scheduler = ExpireScheduler()
+
+def start_expire_scheduler():
+    _expire_scheduler.start()
+
+def schedule_feed_expiration(feed_id):
+    if _expire_scheduler is not None:
+        _expire_scheduler.schedule_feed(feed_id)
+
 def fix_non_container_parents():
     """Make sure all items referenced by parent_id have isContainerItem set
 
@@ -42,24 +42,270 @@ Miro is running and between runs.  This results in 2 speedups:
     need to build IconCache objects and Feed objects in order to create
     ItemInfos).
 
-The general strategy is to just dumbly pickle the data and if we notice any
-errors, or if the DB version changes, throw away the cache and rebuild.  We
+The general strategy is to just dumbly serialize the data and if we notice
+any errors, or if the DB version changes, throw away the cache and rebuild.
+ItemInfoCache.codec_class picks the format we store the data in (see
+PackedInfoCodec and PickleInfoCodec).  We
 use a lot of direct SQL queries in this code, borrowing app.db's cursor.  This
 is slightly naughty, but results in fast peformance.
 """
 
 import cPickle
+import datetime
 import itertools
 import logging
+import marshal
+import operator
 
 from miro import app
 from miro import dbupgradeprogress
 from miro import eventloop
 from miro import itemsource
+from miro import messages
 from miro import models
 from miro import schema
 from miro import signals
 
+class PickleInfoCodec(object):
+    """Store ItemInfos as pickles.
+
+    This is simple and handles any ItemInfo, but unpickling means calling
+    ItemInfo.__setstate__() and storing the attribute names for every row.
+    """
+    name = 'pickle'
+    # everything goes in the pickle, so we can't update stats separately
+    STATS_FIELDS = ()
+
+    def info_to_blob(self, info):
+        return buffer(cPickle.dumps(info))
+
+    def stats_to_blob(self, info):
+        return None
+
+    def blob_to_info(self, blob, stats_blob, interned):
+        return cPickle.loads(str(blob))
+
+class PackedInfoCodec(object):
+    """Store ItemInfos in a compact marshal-based format.
+
+    Each row stores a tuple with these values:
+
+    - values for the attributes in FIELDS, in order.  Attribute names aren't
+      stored, so loading them is just a dict(zip()) call.
+    - dict mapping attribute names to encoded values for attributes that
+      marshal can't handle (datetimes, children, ...).  These are usually
+      None, so they usually aren't stored at all.
+    - dict for any attributes not in FIELDS
+    - description and description_stripped, marshalled into a string.  We
+      don't unmarshal them until they're needed (see
+      ItemInfo.decode_description()).  Most infos never have their
+      description shown, and search_terms is stored, so searching doesn't
+      need them either.  If marshal can't handle them, they get stored with
+      the extras.
+
+    The attributes in STATS_FIELDS are stored separately, in the stats
+    column (see stats_to_blob()).  These change every time a download
+    makes progress, and ItemInfoCache can update just them for those
+    changes.
+
+    Strings for attributes in INTERNED_FIELDS are shared between ItemInfos
+    when we load them, since many items have the same feed name, artist, etc.
+
+    Change name if you change the format or FIELDS, this will force the cache
+    to be rebuilt.
+    """
+    name = 'packed4'
+
+    FIELDS = (
+        'id', 'name', 'title_tag', 'feed_id', 'feed_name', 'feed_url',
+        'search_terms', 'state', 'size', 'duration', 'resume_time',
+        'permalink', 'commentslink', 'payment_link', 'has_shareable_url',
+        'can_be_saved', 'pending_manual_dl', 'pending_auto_dl', 'item_viewed', 'downloaded',
+        'is_external', 'video_watched', 'video_path', 'thumbnail',
+        'thumbnail_url', 'file_format', 'license', 'file_url',
+        'is_container_item', 'is_file_item', 'is_playable', 'file_type',
+        'subtitle_encoding', 'media_type_checked', 'seeding_status',
+        'mime_type', 'remote', 'source_type',
+        'play_count', 'skip_count', 'auto_rating', 'is_playing', 'album',
+        'album_artist', 'artist', 'track', 'album_tracks', 'year', 'genre',
+        'rating', 'cover_art', 'has_drm', 'show', 'episode_id',
+        'episode_number', 'season_number', 'kind', 'metadata_version',
+        'mdp_state', 'name_sort_key', 'album_sort_key', 'artist_sort_key',
+        'album_artist_sort_key', 'description_oneline', 'display_date',
+        'display_duration', 'display_duration_short', 'display_size',
+        'display_date_added', 'display_last_played', 'display_track',
+        'display_year', 'display_drm', 'display_kind',
+    )
+    STATS_FIELDS = (
+        'download_info', 'leechers', 'seeders', 'up_rate', 'down_rate',
+        'up_total', 'down_total', 'up_down_ratio', 'display_torrent_details',
+        'display_eta', 'display_rate',
+    )
+    DATETIME_FIELDS = (
+        'release_date', 'date_added', 'last_played', 'last_watched',
+        'downloaded_time', 'expiration_date',
+    )
+    OBJECT_FIELDS = ('children',)
+    INTERNED_FIELDS = (
+        'feed_name', 'feed_url', 'state', 'file_format', 'license',
+        'file_type', 'mime_type', 'source_type', 'album', 'album_artist',
+        'artist', 'genre', 'show', 'kind', 'display_date',
+        'display_date_added', 'display_last_played', 'display_year',
+        'display_kind',
+    )
+    # attributes that we don't store at all
+    SKIPPED_FIELDS = ('device', 'description', 'description_stripped',
+            '_description_data')
+    KNOWN_FIELDS = frozenset(FIELDS + STATS_FIELDS + DATETIME_FIELDS +
+            OBJECT_FIELDS + SKIPPED_FIELDS)
+
+    _get_fields = staticmethod(operator.itemgetter(*FIELDS))
+    _get_stats_fields = staticmethod(operator.itemgetter(*STATS_FIELDS))
+    MARSHAL_TYPES = frozenset([type(None), bool, int, long, float, str,
+        unicode, list, tuple])
+
+    # tags for encoded values
+    DATETIME = 0
+    PICKLE = 1
+    DOWNLOAD_INFO = 2
+    DOWNLOAD_INFO_CLASSES = {
+        messages.DownloadInfo: 'DownloadInfo',
+        messages.PendingDownloadInfo: 'PendingDownloadInfo',
+    }
+
+    def info_to_blob(self, info):
+        d = info.__dict__
+        special = {}
+        for name in self.DATETIME_FIELDS:
+            value = d.get(name)
+            if value is not None:
+                special[name] = self._encode_special(value)
+        for name in self.OBJECT_FIELDS:
+            value = d.get(name)
+            if value:
+                special[name] = self._encode_special(value)
+        try:
+            values = self._get_fields(d)
+        except KeyError:
+            values = tuple(map(d.get, self.FIELDS))
+        extras = dict((name, d[name])
+                for name in set(d) - self.KNOWN_FIELDS)
+        description = self._description_data(info, extras)
+        if not (self._can_marshal(values) and
+                self._can_marshal(extras.values())):
+            # Some value that marshal can't handle.  Check things one by one
+            # to find it.
+            values = self._move_to_special(self.FIELDS, values, special,
+                    extras)
+        return buffer(marshal.dumps((values, special, extras, description)))
+
+    def _description_data(self, info, extras):
+        try:
+            # info loaded from the cache that hasn't decoded its description
+            return info.__dict__['_description_data']
+        except KeyError:
+            pass
+        values = (info.description, info.description_stripped)
+        if self._can_marshal(values):
+            return marshal.dumps(values)
+        else:
+            extras['description'], extras['description_stripped'] = values
+            return None
+
+    def stats_to_blob(self, info):
+        d = info.__dict__
+        special = {}
+        try:
+            values = self._get_stats_fields(d)
+        except KeyError:
+            values = tuple(map(d.get, self.STATS_FIELDS))
+        if not self._can_marshal(values):
+            # usually this is just download_info
+            values = self._move_to_special(self.STATS_FIELDS, values,
+                    special, {})
+        return buffer(marshal.dumps((values, special)))
+
+    def _move_to_special(self, names, values, special, extras):
+        values = list(values)
+        for i, value in enumerate(values):
+            if not self._can_marshal((value,)):
+                special[names[i]] = self._encode_special(value)
+                values[i] = None
+        for name, value in extras.items():
+            if not self._can_marshal((value,)):
+                special[name] = self._encode_special(value)
+                del extras[name]
+        return tuple(values)
+
+    def _can_marshal(self, values):
+        """Check if marshal can store a sequence of values.
+
+        Note that marshal happily stores subclasses of str and unicode, but
+        doesn't load them correctly, so we check for the exact types.
+        """
+        types = set(map(type, values))
+        if not types.issubset(self.MARSHAL_TYPES):
+            return False
+        if list in types or tuple in types:
+            for value in values:
+                if (type(value) in (list, tuple) and
+                        not self._can_marshal(value)):
+                    return False
+        return True
+
+    def _encode_special(self, value):
+        if type(value) is datetime.datetime and value.tzinfo is None:
+            return (self.DATETIME, value.year, value.month, value.day,
+                    value.hour, value.minute, value.second,
+                    value.microsecond)
+        elif (type(value) in self.DOWNLOAD_INFO_CLASSES and
+                self._can_marshal(value.__dict__.values())):
+            # download_info changes all the time, so it's worth keeping it
+            # smaller than a pickle
+            return (self.DOWNLOAD_INFO,
+                    self.DOWNLOAD_INFO_CLASSES[type(value)], value.__dict__)
+        else:
+            return (self.PICKLE, cPickle.dumps(value,
+                cPickle.HIGHEST_PROTOCOL))
+
+    def _decode_special(self, encoded):
+        if encoded[0] == self.DATETIME:
+            return datetime.datetime(*encoded[1:])
+        elif encoded[0] == self.DOWNLOAD_INFO:
+            download_info_class = getattr(messages, encoded[1])
+            download_info = download_info_class.__new__(download_info_class)
+            download_info.__dict__ = encoded[2]
+            return download_info
+        else:
+            return cPickle.loads(encoded[1])
+
+    def blob_to_info(self, blob, stats_blob, interned):
+        values, special, extras, description = marshal.loads(str(blob))
+        d = dict(itertools.izip(self.FIELDS, values))
+        d.update(extras)
+        if description is not None:
+            d['_description_data'] = description
+        for name in self.DATETIME_FIELDS:
+            d[name] = None
+        d['children'] = []
+        d['device'] = None
+        if stats_blob is not None:
+            stats_values, stats_special = marshal.loads(str(stats_blob))
+            d.update(itertools.izip(self.STATS_FIELDS, stats_values))
+            special.update(stats_special)
+        else:
+            for name in self.STATS_FIELDS:
+                d[name] = None
+        for name, encoded in special.iteritems():
+            d[name] = self._decode_special(encoded)
+        for name in self.INTERNED_FIELDS:
+            value = d[name]
+            if type(value) is unicode:
+                d[name] = interned.setdefault(value, value)
+        info = messages.ItemInfo.__new__(messages.ItemInfo)
+        info.__dict__ = d
+        return info
+
 class ItemInfoCache(signals.SignalEmitter):
     """ItemInfoCache stores the latest ItemInfo objects for each item
 
@@ -80,9 +326,13 @@ class ItemInfoCache(signals.SignalEmitter):
     # how often should we save cache data to the DB? (in seconds)
     SAVE_INTERVAL = 30
     VERSION_KEY = 'item_info_cache_db_version'
+    # how we serialize ItemInfos.  Changing this changes version(), so the
+    # cache will be rebuilt.
+    codec_class = PackedInfoCodec
 
     def __init__(self):
         signals.SignalEmitter.__init__(self)
+        self.codec = self.codec_class()
         self.create_signal('added')
         self.create_signal('changed')
         self.create_signal('removed')
@@ -113,14 +363,17 @@ class ItemInfoCache(signals.SignalEmitter):
         self.loaded = True
 
     def version(self):
-        return "%s-%s" % (schema.VERSION,
-                          itemsource.DatabaseItemSource.VERSION)
+        return "%s-%s-%s" % (schema.VERSION,
+                             itemsource.DatabaseItemSource.VERSION,
+                             self.codec.name)
 
     def _info_to_blob(self, info):
-        return buffer(cPickle.dumps(info))
+        return self.codec.info_to_blob(info)
 
-    def _blob_to_info(self, blob):
-        info = cPickle.loads(str(blob))
+    def _blob_to_info(self, blob, stats_blob=None, interned=None):
+        if interned is None:
+            interned = {}
+        info = self.codec.blob_to_info(blob, stats_blob, interned)
         # Download stats are no longer valid, reset them
         info.leechers = None
         info.seeders = None
@@ -139,9 +392,13 @@ class ItemInfoCache(signals.SignalEmitter):
         saved_db_version = app.db.get_variable(self.VERSION_KEY)
         if saved_db_version == self.version():
             quick_load_values = {}
-            app.db.cursor.execute("SELECT id, pickle FROM item_info_cache")
+            # share equal strings between the ItemInfos we load
+            interned = {}
+            app.db.cursor.execute("SELECT id, pickle, stats "
+                    "FROM item_info_cache")
             for row in app.db.cursor:
-                quick_load_values[row[0]] = self._blob_to_info(row[1])
+                quick_load_values[row[0]] = self._blob_to_info(row[1],
+                        row[2], interned)
             # double check that we have the right number of rows
             if len(quick_load_values) == self._db_item_count():
                 self.id_to_info = quick_load_values
@@ -173,6 +430,8 @@ class ItemInfoCache(signals.SignalEmitter):
     def _reset_changes(self):
         self._infos_added = {}
         self._infos_changed = {}
+        # infos where only the attributes in codec.STATS_FIELDS changed
+        self._stats_changed = {}
         self._infos_deleted = set()
 
     def save(self):
@@ -180,6 +439,7 @@ class ItemInfoCache(signals.SignalEmitter):
         try:
             self._run_inserts()
             self._run_updates()
+            self._run_stats_updates()
             self._run_deletes()
         except StandardError:
             app.db.cursor.execute("ROLLBACK TRANSACTION")
@@ -191,17 +451,27 @@ class ItemInfoCache(signals.SignalEmitter):
     def _run_inserts(self):
         if not self._infos_added:
             return
-        sql = "INSERT INTO item_info_cache (id, pickle) VALUES (?, ?)"
-        values = ((id, self._info_to_blob(info)) for (id,
+        sql = ("INSERT INTO item_info_cache (id, pickle, stats) "
+               "VALUES (?, ?, ?)")
+        values = ((id, self._info_to_blob(info),
+            self.codec.stats_to_blob(info)) for (id,
             info) in self._infos_added.iteritems())
         app.db.cursor.executemany(sql, values)
 
     def _run_updates(self):
         if not self._infos_changed:
             return
-        sql = "UPDATE item_info_cache SET PICKLE=? WHERE id=?"
-        values = ((self._info_to_blob(info), id) for (id, info) in
-                self._infos_changed.iteritems())
+        sql = "UPDATE item_info_cache SET PICKLE=?, stats=? WHERE id=?"
+        values = ((self._info_to_blob(info), self.codec.stats_to_blob(info),
+            id) for (id, info) in self._infos_changed.iteritems())
+        app.db.cursor.executemany(sql, values)
+
+    def _run_stats_updates(self):
+        if not self._stats_changed:
+            return
+        sql = "UPDATE item_info_cache SET stats=? WHERE id=?"
+        values = ((self.codec.stats_to_blob(info), id) for (id, info) in
+                self._stats_changed.iteritems())
         app.db.cursor.executemany(sql, values)
 
     def _run_deletes(self):
@@ -250,15 +520,38 @@ class ItemInfoCache(signals.SignalEmitter):
             # signal_change() called inside setup_new(), just ignor it
             return
         info = itemsource.DatabaseItemSource._item_info_for(item)
+        old_info = self.id_to_info[item.id]
         self.id_to_info[item.id] = info
         if item.id in self._infos_added:
             # no need to update if we insert the new values
             self._infos_added[item.id] = info
-        else:
+        elif (item.id in self._infos_changed or
+                not self._only_stats_changed(old_info, info)):
             self._infos_changed[item.id] = info
+            self._stats_changed.pop(item.id, None)
+        else:
+            # Most changes are download progress updates.  For those we only
+            # need to rewrite the stats.
+            self._stats_changed[item.id] = info
         self.schedule_save_to_db()
         self.emit("changed", info)
 
+    def _only_stats_changed(self, old_info, new_info):
+        stats_fields = self.codec.STATS_FIELDS
+        # make old_info have the same attributes as new_info
+        old_info.decode_description()
+        old_dict = old_info.__dict__
+        new_dict = new_info.__dict__
+        if not stats_fields or len(old_dict) != len(new_dict):
+            return False
+        try:
+            for name, value in new_dict.iteritems():
+                if name not in stats_fields and old_dict[name] != value:
+                    return False
+        except KeyError:
+            return False
+        return True
+
     def item_removed(self, item):
         if not self.loaded:
             # Item.remove() called in Item.setup_restored() while we were
@@ -274,6 +567,7 @@ class ItemInfoCache(signals.SignalEmitter):
                           item.id)
             return
 
+        self._stats_changed.pop(item.id, None)
         if item.id in self._infos_added:
             del self._infos_added[item.id]
             # no need to delete if we don't add the row in the 1st place
@@ -289,4 +583,5 @@ class ItemInfoCache(signals.SignalEmitter):
 def create_sql():
     """Get the SQL needed to create the tables we need for the ItemInfo cache
     """
-    return "CREATE TABLE item_info_cache(id INTEGER PRIMARY KEY, pickle BLOB)"
+    return ("CREATE TABLE item_info_cache"
+            "(id INTEGER PRIMARY KEY, pickle BLOB, stats BLOB)")
@@ -55,7 +55,9 @@ MAX_SESSION = 2147483647
 
 import mdns
 from const import *
-from subr import (encode_response, decode_response, split_url_path, atoi,
+from subr import (encode_response, encode_fragment, encode_item,
+                  EncodedFragment, decode_response, decode_listing,
+                  iter_decode, DmapContainer, split_url_path, atoi,
                   atol, StreamObj, ChunkedStreamObj, find_daap_tag,
                   find_daap_listitems)
 
@@ -123,6 +125,14 @@ class DaapTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
         self.session_lock = threading.Lock()
         self.debug = False
         self.log_message_callback = None
+        # Encoded listing replies, (playlist, meta, delta, encoding) ->
+        # (revision, StreamObj).  Only the current revision is kept.
+        self.listing_cache = dict()
+        self.listing_cache_lock = threading.Lock()
+        # Our revision numbers start again every time the server does, so
+        # give the database a new persistent id each time too.  That way
+        # a client can tell whether its old revision still means anything.
+        self.db_persistent_id = random.randint(1, 2 ** 63)
 
     # New functions in subclass.  Note: we can separate some of these out
     # into separate libraries but not now.
@@ -190,6 +200,23 @@ class DaapTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
     def handle_error(self, request, client_address):
         pass
 
+    def get_cached_listing(self, key, revision):
+        with self.listing_cache_lock:
+            try:
+                cached_revision, blob = self.listing_cache[key]
+            except KeyError:
+                return None
+            if cached_revision != revision:
+                return None
+            return blob
+
+    def cache_listing(self, key, revision, blob):
+        with self.listing_cache_lock:
+            for k in self.listing_cache.keys():
+                if self.listing_cache[k][0] != revision:
+                    del self.listing_cache[k]
+            self.listing_cache[key] = (revision, blob)
+
     def del_session(self, s):
         # maybe the guy tried to trick us by running /logout with no active
         # conn.
@@ -234,7 +261,11 @@ class DaapHttpRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
 
     def do_send_reply(self, rcode, reply, content_type=DEFAULT_CONTENT_TYPE,
                       content_encoding=None, extra_headers=[]):
-        blob = encode_response(reply, content_encoding=content_encoding)
+        # Handlers may hand back an already encoded (possibly cached) reply.
+        if isinstance(reply, StreamObj):
+            blob = reply
+        else:
+            blob = encode_response(reply, content_encoding=content_encoding)
         try:
             self.send_response(rcode)
             self.send_header('Content-type', content_type)
@@ -416,7 +447,8 @@ class DaapHttpRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
             npl = 1 + len([p for p in playlists.values() if p['valid']])
             db.append(('mlit', [
                                 ('miid', 1),    # Item ID
-                                ('mper', 1),    # Persistent ID
+                                # Persistent ID
+                                ('mper', self.server.db_persistent_id),
                                 ('minm', name), # Name
                                 ('mimc', count),# Total count
                                 # Playlist is always non-zero because of
@@ -545,57 +577,41 @@ class DaapHttpRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         backend_id = playlist_id
         if backend_id == 2:
             backend_id = None
-        items = self.server.backend.get_items(playlist_id=backend_id)
-        itemlist = []
-        deleted = []
         try:
             meta = query['meta']
         except KeyError:
             meta = DEFAULT_DAAP_META
         revision, delta = self.get_revision(query) 
         meta_list = [m.strip() for m in meta.split(',')]
-        # NB: mikd must be the first guy in the listing.
-        # GRR stupid Rhythmbox!  The meta reply must appear in order otherwise
-        # it doesn't work!
-        for k in items.keys():
-            itemprop = items[k]
-            if itemprop['revision'] <= delta:
-                continue
-            if itemprop['valid']:
-                item = []
-                for m in meta_list:
-                    if m in itemprop.keys():
-                        try:
-                            code = dmap_consts_rmap[m]
-                        except KeyError:
-                            continue
-                        if itemprop[m] is not None:
-                            attribute = (code, itemprop[m])
-                            item.append(attribute)
-                itemlist.append(('mlit', [       # Listing item
-                                      # item kind - seems OK to hardcode this.
-                                          ('mikd', DAAP_ITEMKIND_AUDIO),
-                                         ] + item
-                           )) 
-            else:
-                deleted.append(('miid', k))
+        content_encoding = self.reply_encoding()
+        # The backend hands us the listing already encoded, and the whole
+        # reply only changes when the backend revision does, so clients
+        # polling the same listing get it straight out of the cache.
+        (current_revision, nfiles, itemlist,
+         deleted) = self.server.backend.get_item_listing(backend_id,
+                                                         meta_list, delta)
+        key = (playlist_id, tuple(meta_list), delta, content_encoding)
+        blob = self.server.get_cached_listing(key, current_revision)
+        if blob is not None:
+            return (DAAP_OK, blob, [])
 
         tag = 'apso' if playlist_id else 'adbs'
-        nfiles = len(itemlist)
         update = 1 if delta else 0
-        reply = []
         content = [                          # Container type
                         ('mstt', DAAP_OK),   # Status: OK
                         ('muty', update),    # Update type
                         ('mtco', nfiles),    # Specified total count
                         ('mrco', nfiles),    # Returned count
-                        ('mlcl', itemlist)
+                        ('mlcl', [itemlist])
                   ]
         if deleted:
-            content.append(('mudl', deleted))    # Itemlist deleted
+            # Itemlist deleted
+            content.append(('mudl', [('miid', k) for k in deleted]))
 
         reply = [(tag, content)]
-        return (DAAP_OK, reply, [])
+        blob = encode_response(reply, content_encoding=content_encoding)
+        self.server.cache_listing(key, current_revision, blob)
+        return (DAAP_OK, blob, [])
 
     def do_database_items(self, path, query):
         db_id = int(path[1])
@@ -843,6 +859,7 @@ class DaapClient(object):
         self.session = None
         self.headers = dict()
         self.old_revision = self.revision = 1
+        self.db_persistent_id = None
         self.supports_update = False
         if self.gzip:
            self.headers['Accept-encoding'] = 'gzip, identity'
@@ -901,6 +918,7 @@ class DaapClient(object):
         db = find_daap_tag('mlit', db_list)
         self.db_id = find_daap_tag('miid', db)
         self.db_name = find_daap_tag('minm', db)
+        self.db_persistent_id = find_daap_tag('mper', db)
 
     def handle_update(self, data):
         revision = find_daap_tag('musr', decode_response(data))
@@ -908,49 +926,12 @@ class DaapClient(object):
         self.revision = revision
 
     def handle_playlist(self, data, meta):
-        r = decode_response(data)
-        listing = find_daap_tag('mlcl', r)
-        deleted = find_daap_tag('mudl', r)
-        playlist_dict = dict()
-        deleted_list = []
         meta_list = [m.strip() for m in meta.split(',')]
-        if listing is not None:
-            for item in find_daap_listitems(listing):
-                playlist_id = find_daap_tag('miid', item)
-                playlist_dict[playlist_id] = dict()
-                for m in meta_list:
-                    try:
-                        playlist_dict[playlist_id][m] = find_daap_tag(
-                                                    dmap_consts_rmap[m], item)
-                    except KeyError:
-                        continue
-        if deleted is not None:
-            for item_id in find_daap_listitems(deleted):
-                deleted_list.append(item_id)
-
-        self.daap_playlists = (playlist_dict, deleted_list)
+        self.daap_playlists = decode_listing(data, meta_list)
 
     def handle_items(self, data, playlist_id, meta):
-        r = decode_response(data)
-        listing = find_daap_tag('mlcl', r)
-        deleted = find_daap_tag('mudl', r)
         meta_list = [m.strip() for m in meta.split(',')]
-        itemdict = dict()
-        deleted_list = []
-        if listing is not None:
-            for item in find_daap_listitems(listing):
-                itemid = find_daap_tag('miid', item)
-                itemdict[itemid] = dict()
-                for m in meta_list:
-                    try:
-                        itemdict[itemid][m] = find_daap_tag(
-                                              dmap_consts_rmap[m], item)
-                    except KeyError:
-                        continue
-        if deleted is not None:
-            for item_id in find_daap_listitems(deleted):
-                deleted_list.append(item_id)
-        self.daap_items = itemdict, deleted_list
+        self.daap_items = decode_listing(data, meta_list)
 
     def sessionize(self, request, query):
         if not self.session:
@@ -1014,6 +995,14 @@ class DaapClient(object):
             query += [('delta', self.old_revision)]
         return query
 
+    def resume(self, revision):
+        """Make the following requests with update=True only return what
+        changed since revision, e.g. one we were at in an earlier session.
+        Only meaningful if the database persistent id is the same as it
+        was back then.
+        """
+        self.old_revision = revision
+
     def update(self):
         if not self.supports_update:
             return
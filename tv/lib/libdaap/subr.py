@@ -58,7 +58,8 @@ fmts = {
 
 class StreamObj(object):
     """
-       Data object for encoding HTTP responses.  Use once then dispose.
+       Data object for encoding HTTP responses.  Unlike ChunkedStreamObj
+       this may be sent more than once, so it is safe to cache.
     """
     def __init__(self, data, content_encoding=None):
         self.content_encoding = content_encoding
@@ -232,6 +233,72 @@ def find_daap_tag(searchtag, data):
     except (RuntimeError, ValueError):
         return None
 
+# code (4 bytes), length (4 bytes), network byte order.
+_header = struct.Struct('!4sI')
+_value_structs = dict((typ, struct.Struct('!' + fmt))
+                      for typ, (fmt, size) in fmts.items()
+                      if size and typ != DMAP_TYPE_LIST)
+_header_value_structs = dict((typ, struct.Struct('!4sI' + fmt))
+                             for typ, (fmt, size) in fmts.items()
+                             if size and typ != DMAP_TYPE_LIST)
+
+# What a decoder may throw when the other end sends garbage.
+DECODE_ERRORS = (struct.error, KeyError, ValueError)
+
+class DmapContainer(object):
+    """
+       A list container in an encoded reply.  Its contents get decoded as
+       they are iterated over, so big listings can be walked without
+       building the whole reply in memory.
+    """
+    def __init__(self, data, start, end):
+        self.data = data
+        self.start = start
+        self.end = end
+
+    def __iter__(self):
+        return iter_decode(self.data, self.start, self.end, lazy=True)
+
+    def __len__(self):
+        return self.end - self.start
+
+def iter_decode(reply, start=0, end=None, lazy=False):
+    """
+       iter_decode(reply, start, end, lazy) -> iterator of (code, value)
+
+       Decode the tags of reply between offsets start and end as they are
+       parsed.  The data is read in place by offset so the remainder of the
+       buffer never gets copied.  List containers are decoded into lists,
+       or if lazy is set returned as DmapContainer objects.
+
+       Raises one of DECODE_ERRORS if the data is malformed.
+    """
+    if end is None:
+        end = len(reply)
+    headersize = _header.size
+    offset = start
+    while offset < end:
+        code, size = _header.unpack_from(reply, offset)
+        offset += headersize
+        if offset + size > end:
+            raise ValueError('tag %r overruns its container' % code)
+        realname, realtype = dmap_consts[code]
+        if realtype == DMAP_TYPE_LIST:
+            if lazy:
+                value = DmapContainer(reply, offset, offset + size)
+            else:
+                value = list(iter_decode(reply, offset, offset + size))
+        elif realtype == DMAP_TYPE_STRING:
+            # the size for string is the size specified by the server.
+            value = reply[offset:offset + size]
+        else:
+            value_struct = _value_structs[realtype]
+            if value_struct.size != size:
+                raise ValueError('bad size %d for tag %r' % (size, code))
+            (value, ) = value_struct.unpack_from(reply, offset)
+        offset += size
+        yield code, value
+
 def decode_response(reply):
     """
        decode_response(reply) -> reply
@@ -244,37 +311,131 @@ def decode_response(reply):
     """
     # This must be wrapped around a try ... except block in case the other
     # end lies to us about the size of the individual items.
-    decoded = []
     try:
-        while reply:
-            headerfmt = '!4sI'
-            headersize = struct.calcsize(headerfmt)
-            code, size = struct.unpack(headerfmt, reply[:headersize])
-            reply = reply[headersize:]
-            realname, realtype = dmap_consts[code]
-            realfmt, realsize = fmts[realtype]
-            # XXX check size == realsize
-            if realtype == DMAP_TYPE_LIST:
-                decoded.append((code,
-                                decode_response(reply[:size])))
-                # next guy
-                reply = reply[size:]
+        return list(iter_decode(reply))
+    except DECODE_ERRORS:
+        return [(-1, [])]
+
+def decode_listing(reply, meta_list):
+    """
+       decode_listing(reply, meta_list) -> (listing, deleted)
+
+       Decode a listing reply (items or playlists).  listing maps the id of
+       each listed item to a dict of the attributes named in meta_list,
+       deleted is a list of the deleted ids.  The reply is walked one item
+       at a time rather than decoded up front.
+    """
+    codes = []
+    for m in meta_list:
+        try:
+            codes.append((m, dmap_consts_rmap[m]))
+        except KeyError:
+            continue
+    listing = dict()
+    deleted = []
+    try:
+        for tag, container in iter_decode(reply, lazy=True):
+            if not isinstance(container, DmapContainer):
                 continue
-            if realtype == DMAP_TYPE_STRING:
-                # overwrite the size for string with the size specified
-                # by the server.
-                realfmt = str(size) + realfmt 
+            for tag, value in container:
+                if tag == 'mlcl':
+                    for item_tag, item in value:
+                        if item_tag != 'mlit':
+                            continue
+                        attributes = dict()
+                        # If there are multiple only first one counts.
+                        for code, attribute in item:
+                            attributes.setdefault(code, attribute)
+                        listing[attributes.get('miid')] = dict(
+                          (m, attributes.get(code)) for m, code in codes)
+                elif tag == 'mudl':
+                    for item_tag, item_id in value:
+                        if item_tag == 'miid':
+                            deleted.append(item_id)
+    except DECODE_ERRORS:
+        return dict(), []
+    return listing, deleted
+
+class EncodedFragment(str):
+    """
+       Already encoded DMAP data.  encode_response() copies these to the
+       output as-is when it finds one in a list container, which lets the
+       caller keep the encoding of things that rarely change (e.g. the
+       listing items) around between requests.
+    """
+    pass
+
+def _encode_parts(reply, parts):
+    # Append the encoded reply to parts and return the number of bytes
+    # added.  Containers get a placeholder header which is patched with the
+    # length once the contents have been written.
+    total = 0
+    for entry in reply:
+        if isinstance(entry, EncodedFragment):
+            parts.append(entry)
+            total += len(entry)
+            continue
+        code, value = entry
+        nam, typ = dmap_consts[code]
+        if typ == DMAP_TYPE_LIST:
+            index = len(parts)
+            parts.append(None)
+            size = _encode_parts(value, parts)
+            parts[index] = _header.pack(code, size)
+            total += _header.size + size
+        elif typ == DMAP_TYPE_STRING:
+            # This ensures we always get a string type even if we are lame
+            # and passed a unicode in.
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
             else:
-                if realsize != size:
-                    raise ValueError
-                realfmt = '!' + realfmt
-            realfmtsize = struct.calcsize(realfmt)
-            (value, ) = struct.unpack(realfmt, reply[:realfmtsize])
-            decoded.append((code, value))
-            reply = reply[realfmtsize:]
-        return decoded
-    except (struct.error, KeyError, ValueError), e:
-        return [(-1, [])]
+                value = str(buffer(value))
+            parts.append(_header.pack(code, len(value)))
+            parts.append(value)
+            total += _header.size + len(value)
+        else:
+            header_value_struct = _header_value_structs[typ]
+            try:
+                parts.append(header_value_struct.pack(
+                  code, header_value_struct.size - _header.size, value))
+            except struct.error:
+                # This pack did not work.  Let's ignore it
+                continue
+            total += header_value_struct.size
+    return total
+
+def encode_fragment(reply):
+    """
+       encode_fragment(reply) -> EncodedFragment
+
+       Like encode_response() but returns the raw encoded data, suitable
+       for embedding into a later reply.
+    """
+    parts = []
+    _encode_parts(reply, parts)
+    return EncodedFragment(''.join(parts))
+
+def encode_item(itemprop, meta_list):
+    """
+       encode_item(itemprop, meta_list) -> EncodedFragment
+
+       Encode a listing item ('mlit') containing the attributes of itemprop
+       which are requested in meta_list, in meta_list order.
+    """
+    # NB: mikd must be the first guy in the listing.
+    # GRR stupid Rhythmbox!  The meta reply must appear in order otherwise
+    # it doesn't work!
+    # item kind - seems OK to hardcode this.
+    item = [('mikd', DAAP_ITEMKIND_AUDIO)]
+    for m in meta_list:
+        if m in itemprop:
+            try:
+                code = dmap_consts_rmap[m]
+            except KeyError:
+                continue
+            if itemprop[m] is not None:
+                item.append((code, itemprop[m]))
+    return encode_fragment([('mlit', item)])
 
 def encode_response(reply, content_encoding=None):
     """
@@ -285,41 +446,15 @@ def encode_response(reply, content_encoding=None):
        to send over the wire.
 
        DMAP_TYPE_LIST should have a value of list containing other response
-       codes.
+       codes, or EncodedFragment objects.
 
        content_encoding: specify content encoding.  Right now we only support
        gzip.
     """
-    blob = ''
-    subblob = ''
+    parts = []
     try:
-        for code, value in reply:
-            nam, typ = dmap_consts[code]
-            fmt, size = fmts[typ]
-            if typ == DMAP_TYPE_LIST:
-                # list container - override the value and the size.  Set
-                # value to '' to append nothingness but tack on the subblob at 
-                # the end. 
-                subblob = str(encode_response(value))
-                size = len(subblob)
-                value = ''
-            if typ == DMAP_TYPE_STRING:
-                fmt = str(len(value)) + fmt
-                size = len(value)
-                # This ensures we always get a string type even if we are lame
-                # and passed a unicode in.
-                value = str(buffer(value))
-            # code (4 bytes), length (4 bytes), data (variable), network byte
-            # order
-            fmt = '!4sI' + fmt
-            # XXX slow - should bunch up
-            try:
-                blob += struct.pack(fmt, code, size, value)
-            except struct.error:
-                # This pack did not work.  Let's ignore it
-                pass
-            blob += subblob
-        blob = StreamObj(blob, content_encoding=content_encoding)
+        _encode_parts(reply, parts)
+        blob = StreamObj(''.join(parts), content_encoding=content_encoding)
     except ValueError:
         # This is probably a file.  Just pass up to the
         # caller and let the caller deal with it.
@@ -342,10 +342,14 @@ class WatchedFolderTracker(ViewTracker):
 class SourceTrackerBase(ViewTracker):
     # we only deal with ItemInfo objects, so we don't need to create anything
     info_factory = lambda self, info: info
+    # can we send ItemInfoPatch objects for changed items?
+    patches_supported = True
 
     def __init__(self):
         ViewTracker.__init__(self)
         self.sent_initial_list = False
+        # set to True by the message handler if the frontend wants patches
+        self.send_patches = False
 
     def get_sources(self):
         return [self.source]
@@ -365,12 +369,43 @@ class SourceTrackerBase(ViewTracker):
         messages.ItemList(self.type, self.id, infos).send_to_frontend()
         self.sent_initial_list = True
 
-    def make_changed_message(self, added, changed, removed):
+    def make_changed_message(self, added, changed, removed, patches=None):
         return messages.ItemsChanged(self.type, self.id, added, changed,
-                                     removed)
+                                     removed, patches)
 
     def send_messages(self):
-        ViewTracker.send_messages(self)
+        if not self.send_patches:
+            ViewTracker.send_messages(self)
+            return
+        added = self._make_added_list(self._get_added_objects())
+        changed, patches = self._make_patch_list(self.changed.values())
+        removed = self._make_removed_list(self.removed)
+        if added or changed or patches or removed:
+            self.make_changed_message(added, changed, removed,
+                    patches).send_to_frontend()
+        self.reset_changes()
+
+    def _make_patch_list(self, changed):
+        """Version of _make_changed_list() that creates ItemInfoPatches.
+
+        :returns: (changed_infos, patches).  changed_infos contains infos
+        that we haven't sent before, so we can't make a patch for them.
+        """
+        changed_infos = []
+        patches = []
+        for obj in changed:
+            info = self.info_factory(obj)
+            try:
+                last_sent = self._last_sent_info[obj.id]
+            except KeyError:
+                changed_infos.append(info)
+            else:
+                patch = messages.ItemInfoPatch.calc(last_sent, info)
+                if patch is None:
+                    continue
+                patches.append(patch)
+            self._last_sent_info[obj.id] = info
+        return changed_infos, patches
 
 class DatabaseSourceTrackerBase(SourceTrackerBase):
 
@@ -550,6 +585,8 @@ class GuideSidebarTracker(DatabaseSourceTrackerBase):
 
 class SharingItemTracker(SourceTrackerBase):
     type = u'sharing'
+    # we always send changes for sharing items (see _make_changed_list())
+    patches_supported = False
     def __init__(self, share):
         share_id = share.tracker_id
         self.id = share
@@ -857,7 +894,11 @@ class BackendMessageHandler(messages.MessageHandler):
                 feed_ = feed.Feed.get_by_id(message.id)
             except database.ObjectNotFoundError:
                 feed_ = ChannelFolder.get_by_id(message.id)
-            feed_.mark_as_viewed()
+            app.bulk_sql_manager.start()
+            try:
+                feed_.mark_as_viewed()
+            finally:
+                app.bulk_sql_manager.finish()
         except database.ObjectNotFoundError:
             logging.warning("handle_mark_feed_seen: can't find feed by id %s",
                             message.id)
@@ -866,11 +907,17 @@ class BackendMessageHandler(messages.MessageHandler):
         itemsource.get_handler(message.info).mark_watched(message.info)
 
     def handle_set_items_watched(self, message):
-        for info in message.info_list:
-            if message.watched:
-                itemsource.get_handler(info).mark_watched(info)
-            else:
-                itemsource.get_handler(info).mark_unwatched(info)
+        # use the BulkSQLManager so that the view trackers check all the
+        # changed items at once.
+        app.bulk_sql_manager.start()
+        try:
+            for info in message.info_list:
+                if message.watched:
+                    itemsource.get_handler(info).mark_watched(info)
+                else:
+                    itemsource.get_handler(info).mark_unwatched(info)
+        finally:
+            app.bulk_sql_manager.finish()
 
     def handle_mark_item_unwatched(self, message):
         itemsource.get_handler(message.info).mark_unwatched(message.info)
@@ -1348,6 +1395,8 @@ New ids: %s""", playlist_item_ids, message.item_ids)
             if item_tracker is None:
                 # message type was wrong
                 return
+            item_tracker.send_patches = (message.send_patches and
+                    item_tracker.patches_supported)
             self.item_trackers[key] = item_tracker
         else:
             item_tracker = self.item_trackers[key]
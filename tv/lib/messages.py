@@ -41,6 +41,8 @@ This module defines the messages that are passed between the two threads.
 
 import copy
 import logging
+import marshal
+import threading
 
 from miro.gtcache import gettext as _
 from miro.folder import ChannelFolder, PlaylistFolder
@@ -146,10 +148,16 @@ class TrackItems(BackendMessage):
 
     id should be the id of a feed/playlist. For new, downloading and library
     it is ignored.
+
+    If send_patches is True, the ItemsChanged messages may use ItemInfoPatch
+    objects for changed items instead of sending the whole ItemInfo.  The
+    frontend must then keep the last ItemInfo it got for each item to apply
+    them to.
     """
-    def __init__(self, typ, id_):
+    def __init__(self, typ, id_, send_patches=False):
         self.type = typ
         self.id = id_
+        self.send_patches = send_patches
 
 class TrackItemsManually(BackendMessage):
     """Track a manually specified list of items.
@@ -167,6 +175,7 @@ class TrackItemsManually(BackendMessage):
         self.id = id_
         self.infos_to_track = infos_to_track
         self.type = 'manual'
+        self.send_patches = False
 
 class StopTrackingItems(BackendMessage):
     """Stop tracking items for a feed.
@@ -1181,11 +1190,45 @@ class ItemInfo(object):
     """
 
     html_stripper = util.HTMLStripper()
+    # ItemInfos are shared between the frontend and backend threads, so
+    # decode_description() holds a lock.
+    _description_lock = threading.Lock()
 
     def __repr__(self):
         return "<ItemInfo %r>" % self.id
 
+    def __getattr__(self, name):
+        # ItemInfoCache can leave the description encoded until we need it.
+        # __getattr__ only gets called for attributes that aren't set, so this
+        # doesn't slow down other attribute access.
+        if (name in ('description', 'description_stripped') and
+                '_description_data' in self.__dict__):
+            self.decode_description()
+            return self.__dict__[name]
+        raise AttributeError(name)
+
+    def decode_description(self):
+        """Decode the description if ItemInfoCache left it encoded.
+
+        description_stripped gets set before description, and
+        _description_data is removed last.  So other threads either see the
+        encoded data or both attributes.
+        """
+        if '_description_data' not in self.__dict__:
+            return
+        ItemInfo._description_lock.acquire()
+        try:
+            d = self.__dict__
+            if '_description_data' in d:
+                description, stripped = marshal.loads(d['_description_data'])
+                d['description_stripped'] = stripped
+                d['description'] = description
+                del d['_description_data']
+        finally:
+            ItemInfo._description_lock.release()
+
     def __getstate__(self):
+        self.decode_description()
         d = self.__dict__.copy()
         d['device'] = None
         del d['description_stripped']
@@ -1274,6 +1317,59 @@ class ItemInfo(object):
              "ratio": self.up_down_ratio})
         return details
 
+class ItemInfoPatch(object):
+    """Describes the attributes of an ItemInfo that changed.
+
+    For most item changes, only a few attributes change (for example download
+    rates), so sending these is much cheaper than sending the entire
+    ItemInfo.
+
+    :param id: id of the item
+    :param changes: dict mapping attribute names to their new values
+    :param removed: list of attribute names that were removed
+    """
+    def __init__(self, id_, changes, removed):
+        self.id = id_
+        self.changes = changes
+        self.removed = removed
+
+    @classmethod
+    def calc(cls, old_info, new_info):
+        """Make a patch that changes old_info to new_info.
+
+        :returns: ItemInfoPatch, or None if the 2 ItemInfos are the same
+        """
+        old_info.decode_description()
+        new_info.decode_description()
+        old_dict = old_info.__dict__
+        new_dict = new_info.__dict__
+        if old_dict == new_dict:
+            return None
+        missing = object()
+        changes = dict((name, value) for name, value in new_dict.iteritems()
+                if old_dict.get(name, missing) != value)
+        removed = [name for name in old_dict if name not in new_dict]
+        return cls(new_info.id, changes, removed)
+
+    def apply(self, info):
+        """Apply this patch to an ItemInfo.
+
+        info is left alone, since other code (including the backend) may be
+        holding a reference to it.
+
+        :returns: new ItemInfo with our changes
+        """
+        new_dict = info.__dict__.copy()
+        for name in self.removed:
+            new_dict.pop(name, None)
+        new_dict.update(self.changes)
+        new_info = ItemInfo.__new__(ItemInfo)
+        new_info.__dict__ = new_dict
+        return new_info
+
+    def __repr__(self):
+        return "<ItemInfoPatch %r %s>" % (self.id, self.changes.keys())
+
 class DownloadInfo(object):
     """Tracks the download state of an item.
 
@@ -1460,18 +1556,24 @@ class ItemsChanged(FrontendMessage):
                   The order will be the order they were added.
     :param changed: set containing an ItemInfo for each changed item.
     :param removed: set containing ids for each item that was removed
+    :param patches: list of ItemInfoPatch objects for changed items.  These
+                    are only sent if the TrackItems message set send_patches.
     """
-    def __init__(self, typ, id_, added, changed, removed):
+    def __init__(self, typ, id_, added, changed, removed, patches=None):
         self.type = typ
         self.id = id_
         self.added = added
         self.changed = changed
         self.removed = removed
+        if patches is None:
+            patches = []
+        self.patches = patches
 
     def __str__(self):
         return ('<miro.messages.ItemsChanged %s:%s '
-    '(%d added, %d changed, %d removed)>') % (self.type, self.id,
-    len(self.added), len(self.changed), len(self.removed))
+    '(%d added, %d changed, %d patched, %d removed)>') % (self.type, self.id,
+    len(self.added), len(self.changed), len(self.patches),
+    len(self.removed))
 
 class WatchedFolderList(FrontendMessage):
     """Sends the frontend the initial list of watched folders.
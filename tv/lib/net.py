@@ -37,6 +37,7 @@ This class also defines the base Exception classes used by httpclient.
 
 """
 
+import collections
 import errno
 import logging
 import socket
@@ -115,40 +116,93 @@ def trap_call(object, function, *args, **kwargs):
 
 class NetworkBuffer(object):
     """Responsible for storing incomming network data and doing some basic
-    parsing of it.  I think this is about as fast as we can do things in pure
-    python, someday we may want to make it C...
+    parsing of it.
+
+    Data is kept as a deque of the chunks passed to addData(), plus an
+    offset into the first chunk.  Reads only copy the bytes they return, so
+    reading a large stream in small pieces stays linear.
     """
     def __init__(self):
-        self.chunks = []
+        self.chunks = collections.deque()
         self.length = 0
+        # offset of the first unread byte in chunks[0]
+        self._offset = 0
+        # number of unread bytes that we know don't contain a newline
+        self._scanned = 0
 
     def addData(self, data):
-        self.chunks.append(data)
-        self.length += len(data)
-
-    def _mergeChunks(self):
-        self.chunks = [''.join(self.chunks)]
+        if data:
+            self.chunks.append(data)
+            self.length += len(data)
 
     def has_data(self):
         return self.length > 0
 
     def discard_data(self):
-        self.chunks = []
+        self.chunks.clear()
         self.length = 0
+        self._offset = 0
+        self._scanned = 0
+
+    def _consume(self, count):
+        """Drop count bytes from the front of the buffer."""
+        self.length -= count
+        self._scanned = max(0, self._scanned - count)
+        while count > 0:
+            available = len(self.chunks[0]) - self._offset
+            if count < available:
+                self._offset += count
+                return
+            self.chunks.popleft()
+            self._offset = 0
+            count -= available
 
     def read(self, size=None):
         """Read at most size bytes from the data that has been added to the
         buffer.  """
 
-        self._mergeChunks()
-        if size is not None:
-            rv = self.chunks[0][:size]
-            self.chunks[0] = self.chunks[0][len(rv):]
-        else:
-            rv = self.chunks[0]
-            self.chunks = []
-        self.length -= len(rv)
-        return rv
+        if size is None or size > self.length:
+            size = self.length
+        if size <= 0:
+            return ''
+        first = self.chunks[0]
+        if self._offset + size <= len(first):
+            # fast path: the data is all in the first chunk
+            if self._offset == 0 and size == len(first):
+                rv = first
+            else:
+                rv = first[self._offset:self._offset+size]
+            self._consume(size)
+            return rv
+        pieces = []
+        remaining = size
+        offset = self._offset
+        for chunk in self.chunks:
+            piece = chunk[offset:offset+remaining]
+            pieces.append(piece)
+            remaining -= len(piece)
+            offset = 0
+            if remaining == 0:
+                break
+        self._consume(size)
+        return ''.join(pieces)
+
+    def readinto(self, buf):
+        """Like a file readinto().  Copy data into buf, which must be a
+        bytearray.
+
+        :returns: the number of bytes copied
+        """
+        size = min(len(buf), self.length)
+        pos = 0
+        while pos < size:
+            chunk = self.chunks[0]
+            count = min(len(chunk) - self._offset, size - pos)
+            # buffer() lets us copy out of chunk without slicing it first
+            buf[pos:pos+count] = buffer(chunk, self._offset, count)
+            self._consume(count)
+            pos += count
+        return size
 
     def readline(self):
         """Like a file readline, with several difference:  
@@ -157,28 +211,50 @@ class NetworkBuffer(object):
         * Both "\r\n" and "\n" act as a line ender
         """
 
-        self._mergeChunks()
-        split = self.chunks[0].split("\n", 1)
-        if len(split) == 2:
-            self.chunks[0] = split[1]
-            self.length = len(self.chunks[0])
-            if split[0].endswith("\r"):
-                return split[0][:-1]
-            else:
-                return split[0]
-        else:
-            return None
+        pos = 0
+        offset = self._offset
+        for chunk in self.chunks:
+            chunk_length = len(chunk) - offset
+            if pos + chunk_length > self._scanned:
+                search_start = offset + max(0, self._scanned - pos)
+                index = chunk.find("\n", search_start)
+                if index >= 0:
+                    line = self.read(pos + index - offset)
+                    self._consume(1)
+                    if line.endswith("\r"):
+                        return line[:-1]
+                    else:
+                        return line
+            pos += chunk_length
+            offset = 0
+        # Remember that we've searched all the data, so that the next call
+        # only needs to look at data added after this one.
+        self._scanned = self.length
+        return None
 
     def unread(self, data):
         """Put back read data.  This make is like the data was never read at
         all.
         """
-        self.chunks.insert(0, data)
+        if not data:
+            return
+        if self._offset:
+            self.chunks[0] = self.chunks[0][self._offset:]
+            self._offset = 0
+        self.chunks.appendleft(data)
         self.length += len(data)
+        self._scanned = 0
 
     def getValue(self):
-        self._mergeChunks()
-        return self.chunks[0]
+        if len(self.chunks) > 1 or self._offset:
+            self.chunks[0] = self.chunks[0][self._offset:]
+            self._offset = 0
+            value = ''.join(self.chunks)
+            self.chunks = collections.deque([value])
+        if self.chunks:
+            return self.chunks[0]
+        else:
+            return ''
 
 class _Packet(object):
     """A packet of data for the AsyncSocket class
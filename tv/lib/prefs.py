@@ -71,6 +71,8 @@ UPSTREAM_LIMIT_IN_KBS       = Pref(key='upstreamLimitInKBS',    default=12,    p
 UPSTREAM_TORRENT_LIMIT      = Pref(key='upstreamTorrentLimit',  default=10,    platformSpecific=False)
 LIMIT_DOWNSTREAM_BT         = Pref(key='limitDownstreamBT',     default=False, platformSpecific=False)
 DOWNSTREAM_BT_LIMIT_IN_KBS  = Pref(key='downstreamBTLimitInKBS', default=200,   platformSpecific=False)
+LIMIT_DOWNSTREAM            = Pref(key='limitDownstream',       default=False, platformSpecific=False)
+DOWNSTREAM_LIMIT_IN_KBS     = Pref(key='downstreamLimitInKBS',  default=500,   platformSpecific=False)
 LIMIT_CONNECTIONS_BT        = Pref(key='limitConnectionsBT',     default=False, platformSpecific=False)
 CONNECTION_LIMIT_BT_NUM     = Pref(key='connectionLimitBTNum', default=100,   platformSpecific=False)
 PRESERVE_DISK_SPACE         = Pref(key='preserveDiskSpace',     default=True,  platformSpecific=False)
@@ -79,6 +81,8 @@ EXPIRE_AFTER_X_DAYS         = Pref(key='expireAfterXDays',      default=6,     p
                                    possible_values=[1,3,6,10,30,-1], failsafe_value=-1)
 DOWNLOADS_TARGET            = Pref(key='DownloadsTarget',       default=4,     platformSpecific=False) # max auto downloads
 MAX_MANUAL_DOWNLOADS        = Pref(key='MaxManualDownloads',    default=5,    platformSpecific=False)
+HTTP_SEGMENTED_DOWNLOADS    = Pref(key='httpSegmentedDownloads', default=False, platformSpecific=False)
+HTTP_DOWNLOAD_SEGMENTS      = Pref(key='httpDownloadSegments',  default=4,     platformSpecific=False)
 VOLUME_LEVEL                = Pref(key='VolumeLevel',           default=1.0,   platformSpecific=False)
 BT_MIN_PORT                 = Pref(key='BitTorrentMinPort',     default=8500,  platformSpecific=False)
 BT_MAX_PORT                 = Pref(key='BitTorrentMaxPort',     default=8600,  platformSpecific=False)
@@ -110,6 +114,8 @@ SUBTITLE_FONT               = Pref(key='subtitleFont',          default=None,  p
 # language setting: "system" uses system default; all other languages are overrides
 LANGUAGE                    = Pref(key='language',              default="system", platformSpecific=False)
 MAX_CONCURRENT_CONVERSIONS  = Pref(key='maxConcurrentConversions', default=1, platformSpecific=False)
+WORKER_PROCESS_COUNT        = Pref(key='workerProcessCount',    default=2, platformSpecific=False)
+MAX_ICON_DOWNLOADS          = Pref(key='maxIconDownloads',      default=6, platformSpecific=False)
 SHOW_UNKNOWN_DEVICES        = Pref(key='showUnknownDevices',    default=False, platformSpecific=False)
 SHARE_MEDIA                 = Pref(key='ShareMedia',            default=False, platformSpecific=False)
 SHARE_DISCOVERABLE          = Pref(key='ShareDiscoverable',     default=True, platformSpecific=False)
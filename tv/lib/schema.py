@@ -817,7 +817,7 @@ class ViewStateSchema(DDBObjectSchema):
         return None
 
 
-VERSION = 165
+VERSION = 168
 
 object_schemas = [
     IconCacheSchema, ItemSchema, FeedSchema,
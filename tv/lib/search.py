@@ -31,9 +31,11 @@
 
 To make incremental search fast, we index the N-grams for each item.
 """
+import bisect
 import collections
 import os
 import re
+from array import array
 
 from miro import ngrams
 from miro.plat.utils import filename_to_unicode
@@ -141,6 +143,23 @@ def _ngrams_for_item(item_info):
 
     return ngrams.breakup_list(item_info.search_terms, NGRAM_MIN, NGRAM_MAX)
 
+def _terms_text(item_info):
+    """Join an ItemInfo's search terms into a string to match against.
+
+    An N-gram is in _ngrams_for_item() exactly when it's a substring of one
+    of the search terms.  Terms never contain spaces, so we can check that
+    with a substring test on this string and skip calculating the N-grams.
+    """
+    return u' '.join(item_info.search_terms)
+
+def _contains_ngrams(terms_text, grams):
+    """Check if all N-grams in grams are in the string from _terms_text().
+    """
+    for gram in grams:
+        if u' ' in gram or gram not in terms_text:
+            return False
+    return True
+
 def item_matches(item_info, search_text):
     """Test if a single ItemInfo matches a search
 
@@ -150,13 +169,13 @@ def item_matches(item_info, search_text):
     :returns: True if the item matches the search string
     """
     parsed_search = _get_boolean_search(search_text)
-    item_ngrams = _ngrams_for_item(item_info)
+    terms_text = _terms_text(item_info)
 
     for term in parsed_search.positive_terms:
-        if not set(_ngrams_for_term(term)).issubset(item_ngrams):
+        if not _contains_ngrams(terms_text, _ngrams_for_term(term)):
             return False
     for term in parsed_search.negative_terms:
-        if set(_ngrams_for_term(term)).issubset(item_ngrams):
+        if _contains_ngrams(terms_text, _ngrams_for_term(term)):
             return False
     return True
 
@@ -176,25 +195,162 @@ def list_matches(item_infos, search_text):
         positive_set |= set(_ngrams_for_term(term))
     for term in parsed_search.negative_terms:
         negative_set |= set(_ngrams_for_term(term))
+    positive_grams = list(positive_set)
+    # N-grams with spaces never match, so they can't exclude anything
+    negative_grams = [gram for gram in negative_set if u' ' not in gram]
 
     for info in item_infos:
-        item_ngrams_set = set(_ngrams_for_item(info))
-        match = positive_set.issubset(item_ngrams_set)
-        if match and negative_set:
-            match = negative_set.isdisjoint(item_ngrams_set)
+        terms_text = _terms_text(info)
+        match = _contains_ngrams(terms_text, positive_grams)
+        if match and negative_grams:
+            for gram in negative_grams:
+                if gram in terms_text:
+                    match = False
+                    break
 
         if match:
             yield info
 
-class ItemSearcher(object):
-    """Index Item objects so that they can be searched quickly """
+class SetNgramIndex(object):
+    """Map N-grams to the ids of items that contain them using python sets.
 
+    This is fast to update, but uses a lot of memory for large libraries.
+    """
     def __init__(self):
         # map N-grams -> set of item ids
         self._ngram_map = collections.defaultdict(set)
         # map item id -> list of N-grams
         self._item_ngrams = {}
 
+    def add(self, item_id, item_ngrams):
+        for ngram in item_ngrams:
+            self._ngram_map[ngram].add(item_id)
+        self._item_ngrams[item_id] = item_ngrams
+
+    def remove(self, item_id):
+        for ngram in self._item_ngrams.pop(item_id):
+            self._ngram_map[ngram].discard(item_id)
+
+    def lookup(self, grams):
+        """Get the set of item ids that contain all of grams."""
+        # note that we need to copy the value from _ngram_map.  We don't want
+        # our calls to intersection_update to change it.
+        rv = set(self._ngram_map.get(grams[0], ()))
+        for gram in grams[1:]:
+            rv.intersection_update(self._ngram_map.get(gram, ()))
+        return rv
+
+    def all_ids(self):
+        return self._item_ngrams.keys()
+
+class ArrayNgramIndex(object):
+    """Map N-grams to the ids of items that contain them using arrays.
+
+    N-grams are interned to integer ids.  For each N-gram id we store a
+    sorted array of item ids (the posting list) and for each item we store an
+    array of its N-gram ids.  This uses much less memory than SetNgramIndex,
+    and lookups intersect the posting lists by galloping through them.
+
+    Interned N-grams are never forgotten, but the number of distinct N-grams
+    grows much slower than the number of items.
+    """
+    def __init__(self):
+        # map N-gram -> N-gram id
+        self._ngram_ids = {}
+        # list indexed by N-gram id, sorted array of item ids
+        self._postings = []
+        # map item id -> array of N-gram ids
+        self._item_ngrams = {}
+
+    def _intern(self, ngram):
+        try:
+            return self._ngram_ids[ngram]
+        except KeyError:
+            ngram_id = len(self._postings)
+            self._ngram_ids[ngram] = ngram_id
+            self._postings.append(array('i'))
+            return ngram_id
+
+    def add(self, item_id, item_ngrams):
+        ngram_ids = array('i', sorted(set(self._intern(ngram)
+            for ngram in item_ngrams)))
+        for ngram_id in ngram_ids:
+            posting = self._postings[ngram_id]
+            if not posting or posting[-1] < item_id:
+                # common case: new items have the highest ids
+                posting.append(item_id)
+            else:
+                posting.insert(bisect.bisect_left(posting, item_id), item_id)
+        self._item_ngrams[item_id] = ngram_ids
+
+    def remove(self, item_id):
+        for ngram_id in self._item_ngrams.pop(item_id):
+            posting = self._postings[ngram_id]
+            pos = bisect.bisect_left(posting, item_id)
+            if pos < len(posting) and posting[pos] == item_id:
+                del posting[pos]
+
+    def lookup(self, grams):
+        """Get the set of item ids that contain all of grams."""
+        postings = []
+        for gram in grams:
+            try:
+                postings.append(self._postings[self._ngram_ids[gram]])
+            except KeyError:
+                return set()
+        postings.sort(key=len)
+        matches = postings[0]
+        for posting in postings[1:]:
+            if not matches:
+                break
+            matches = _intersect_sorted(matches, posting)
+        return set(matches)
+
+    def all_ids(self):
+        return self._item_ngrams.keys()
+
+def _gallop(seq, value, start):
+    """Find the first index >= start where seq[index] >= value.
+
+    We check positions start, start+1, start+3, start+7, ... until we pass
+    value, then do a binary search inside the last step.  This makes
+    intersecting a short list with a long one cost much less than walking the
+    long one.
+    """
+    end = len(seq)
+    lo = hi = start
+    step = 1
+    while hi < end and seq[hi] < value:
+        lo = hi + 1
+        hi = lo + step
+        step *= 2
+    return bisect.bisect_left(seq, value, lo, min(hi, end))
+
+def _intersect_sorted(small, large):
+    """Intersect 2 sorted arrays of ids, small should be the shorter one."""
+    rv = array('i')
+    pos = 0
+    end = len(large)
+    for value in small:
+        pos = _gallop(large, value, pos)
+        if pos >= end:
+            break
+        if large[pos] == value:
+            rv.append(value)
+            pos += 1
+    return rv
+
+class ItemSearcher(object):
+    """Index Item objects so that they can be searched quickly
+
+    :param index_class: class used to store the N-gram index.  Either
+        SetNgramIndex (the default) or ArrayNgramIndex, which uses much less
+        memory for large lists.
+    """
+
+    def __init__(self, index_class=SetNgramIndex):
+        self._index = index_class()
+
     def add_item(self, item_info):
         """Add an item info to the index."""
         self._add_item(item_info)
@@ -215,23 +371,13 @@ class ItemSearcher(object):
         self._remove_item(item_id)
 
     def _add_item(self, item_info):
-        item_ngrams = _ngrams_for_item(item_info)
-        for ngram in item_ngrams:
-            self._ngram_map[ngram].add(item_info.id)
-        self._item_ngrams[item_info.id] = item_ngrams
+        self._index.add(item_info.id, _ngrams_for_item(item_info))
 
     def _remove_item(self, item_id):
-        for ngram in self._item_ngrams.pop(item_id):
-            self._ngram_map[ngram].discard(item_id)
+        self._index.remove(item_id)
 
     def _term_search(self, term):
-        grams = _ngrams_for_term(term)
-        # note that we need to copy the value from _ngram_map.  We don't want
-        # our calls to intersection_update to change it.
-        rv = set(self._ngram_map[grams[0]])
-        for gram in grams[1:]:
-            rv.intersection_update(self._ngram_map[gram])
-        return rv
+        return self._index.lookup(_ngrams_for_term(term))
 
     def search(self, search_text):
         """Search through the index items.
@@ -253,7 +399,7 @@ class ItemSearcher(object):
             for term in positive_terms[1:]:
                 matching_ids.intersection_update(self._term_search(term))
         else:
-            matching_ids = set(self._item_ngrams.keys())
+            matching_ids = set(self._index.all_ids())
 
         for term in negative_terms:
             matching_ids.difference_update(self._term_search(term))
@@ -26,6 +26,7 @@
 # this exception statement from your version. If you delete this exception
 # statement from all source files in the program, then also delete it here.
 
+import cPickle
 import errno
 import logging
 import os
@@ -552,6 +553,93 @@ class SharingTracker(object):
 # (recall that the callback runs in the eventloop, we are already in the 
 # eventloop so this could not have happened prior to handle_item_list()
 # being called).
+class SharingCatalog(object):
+    """The raw listings of a remote share as of some revision.  It is saved
+    between connections so that the share can be shown straight away and,
+    if the server still counts revisions the same way, only what changed
+    since has to be fetched.
+    """
+    VERSION = 1
+    FIELDS = ('db_id', 'db_persistent_id', 'revision', 'address',
+              'base_playlist', 'playlists', 'items', 'playlist_items')
+
+    def __init__(self, path):
+        self.path = path
+        self.reset()
+
+    def reset(self):
+        self.db_id = self.db_persistent_id = self.revision = None
+        self.address = None
+        self.base_playlist = None
+        self.playlists = dict()         # playlist id -> raw playlist
+        self.items = dict()             # item id -> raw base playlist item
+        self.playlist_items = dict()    # playlist id -> set of item ids
+
+    def load(self):
+        try:
+            f = open(self.path, 'rb')
+        except IOError:
+            return False
+        try:
+            try:
+                data = cPickle.load(f)
+            finally:
+                f.close()
+            if data['version'] != self.VERSION:
+                return False
+            for name in self.FIELDS:
+                setattr(self, name, data[name])
+        except (StandardError, cPickle.UnpicklingError), e:
+            logging.warn('Error loading sharing catalog %s: %s', self.path, e)
+            self.reset()
+            return False
+        return True
+
+    def save(self):
+        data = dict((name, getattr(self, name)) for name in self.FIELDS)
+        data['version'] = self.VERSION
+        tmp_path = self.path + '.tmp'
+        try:
+            directory = os.path.dirname(self.path)
+            if not os.path.exists(directory):
+                fileutil.makedirs(directory)
+            f = open(tmp_path, 'wb')
+            try:
+                cPickle.dump(data, f, cPickle.HIGHEST_PROTOCOL)
+            finally:
+                f.close()
+            # Windows won't rename over an existing file.
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError), e:
+            logging.warn('Error saving sharing catalog %s: %s', self.path, e)
+
+    def can_resume(self, client):
+        """Can we ask client for just the changes since our revision?"""
+        return (self.revision is not None and
+                client.supports_update and
+                client.db_persistent_id is not None and
+                client.db_id == self.db_id and
+                client.db_persistent_id == self.db_persistent_id and
+                self.revision <= client.revision)
+
+    def update_playlists(self, playlists, deleted):
+        for k in deleted:
+            self.playlists.pop(k, None)
+            self.playlist_items.pop(k, None)
+        self.playlists.update(playlists)
+
+    def update_items(self, playlist_id, items, deleted):
+        if playlist_id == self.base_playlist:
+            for k in deleted:
+                self.items.pop(k, None)
+            self.items.update(items)
+        else:
+            item_ids = self.playlist_items.setdefault(playlist_id, set())
+            item_ids.difference_update(deleted)
+            item_ids.update(items)
+
 #
 # The SharingItemTrackerImpl() object is designed to be persistent until
 # disconnection happens.  If you click on a tab that's already connected,
@@ -577,6 +665,11 @@ class SharingItemTrackerImpl(signals.SignalEmitter):
         self.info_cache = dict()
         self.playlists = dict()
         self.base_playlist = None    # Temporary
+        self.showed_catalog = False
+        catalog_name = md5(repr((share.name, share.host,
+                                 share.port))).hexdigest()
+        self.catalog = SharingCatalog(os.path.join(
+          app.config.get(prefs.SUPPORT_DIRECTORY), 'sharing', catalog_name))
         self.share.is_updating = True
         message = messages.TabsChanged('connect', [], [self.share], [])
         message.send_to_frontend()
@@ -610,7 +703,15 @@ class SharingItemTrackerImpl(signals.SignalEmitter):
         return succeeded
 
     def runloop(self):
-        success = self.run(self.client_connect, self.client_connect_callback,
+        # If we have seen this share before, show what it had back then
+        # while we connect, then bring it up to date like an update would.
+        connect_callback = self.client_connect_callback
+        if self.catalog.load():
+            if self.run(self.setup_catalog_items,
+                        self.client_connect_callback,
+                        self.setup_catalog_items_error_callback):
+                connect_callback = self.client_update_callback
+        success = self.run(self.client_connect, connect_callback,
                            self.client_connect_error_callback)
         # If server does not support update, then we short circuit since
         # the loop becomes useless.  There is nothing wait for being updated.
@@ -623,7 +724,7 @@ class SharingItemTrackerImpl(signals.SignalEmitter):
             if not success:
                 break
 
-    def sharing_item(self, rawitem):
+    def sharing_item(self, rawitem, client):
         kwargs = dict()
         for k in rawitem.keys():
             try:
@@ -655,11 +756,11 @@ class SharingItemTrackerImpl(signals.SignalEmitter):
            pass
 
         kwargs['file_type'] = file_type
-        kwargs['video_path'] = self.client.daap_get_file_request(
+        kwargs['video_path'] = client.daap_get_file_request(
                                    kwargs['id'],
                                    kwargs['file_format'])
-        kwargs['host'] = self.client.host
-        kwargs['port'] = self.client.port
+        kwargs['host'] = client.host
+        kwargs['port'] = client.port
         kwargs['address'] = self.address
         kwargs['file_type'] = file_type
 
@@ -709,11 +810,33 @@ class SharingItemTrackerImpl(signals.SignalEmitter):
         self.address = address
         return self.setup_items()
 
+    def setup_catalog_items(self):
+        # The items can't be played until we have connected and have a
+        # session to put in their paths: the update after connecting
+        # replaces all of them.
+        catalog = self.catalog
+        client = libdaap.make_daap_client(self.share.host, self.share.port)
+        client.db_id = catalog.db_id
+        try:
+            self.address = catalog.address
+            self.base_playlist = catalog.base_playlist
+            if not self.base_playlist:
+                raise ValueError('Cannot find base playlist')
+            returned_playlist_items, returned_playlists = self.build_items(
+              client, catalog.playlists, catalog.items,
+              catalog.playlist_items, update=False)
+        except StandardError:
+            catalog.reset()
+            self.base_playlist = None
+            raise
+        self.showed_catalog = True
+        return returned_playlist_items, returned_playlists, [], dict()
+
+    def setup_catalog_items_error_callback(self, unused):
+        pass
+
     # See use of self.client in client_update().
     def setup_items(self, update=False):
-        name = self.share.name
-        host = self.share.host
-        port = self.share.port
         try:
             client = self.client
         except AttributeError:
@@ -726,23 +849,20 @@ class SharingItemTrackerImpl(signals.SignalEmitter):
         # out that way, and call the error callback.
         if not client.databases(update=update):
             raise IOError('Cannot get database')
+        # When first connecting, if we have the share from last time ask
+        # for the changes since then rather than the whole lot.  Otherwise
+        # we get full listings and work out what went away ourselves.
+        catalog = self.catalog
+        resume = not update and catalog.can_resume(client)
+        if resume:
+            logging.debug('resuming %s from revision %s', self.share.name,
+                          catalog.revision)
+            client.resume(catalog.revision)
+        delta = update or resume
         deleted_items = dict()
-        playlists, deleted_playlists = client.playlists(update=update)
+        playlists, deleted_playlists = client.playlists(update=delta)
         if playlists is None:
             raise IOError('Cannot get playlist')
-        returned_playlists = dict()
-        video_tab_id = unicode(md5(repr((name,
-                                         host,
-                                         port, u'video'))).hexdigest())
-        audio_tab_id = unicode(md5(repr((name,
-                                         host,
-                                         port, u'audio'))).hexdigest())
-        playlist_tab_id = unicode(md5(repr((name,
-                                            host,
-                                            port, u'playlist'))).hexdigest())
-        podcast_tab_id = unicode(md5(repr((name,
-                                           host,
-                                           port, u'podcast'))).hexdigest())
         for k in playlists.keys():
             # Clean the playlist: remove NUL characters.
             for k_ in playlists[k]:
@@ -754,11 +874,107 @@ class SharingItemTrackerImpl(signals.SignalEmitter):
             if playlists[k].has_key('daap.baseplaylist'):
                 is_base_playlist = playlists[k]['daap.baseplaylist']
             if is_base_playlist:
-                if not update and self.base_playlist:
+                if (not update and self.base_playlist and
+                  self.base_playlist != k and not self.showed_catalog):
                     logging.debug('WARNING: more than one base playlist found')
                 if update and self.base_playlist != k:
                     logging.debug('WARNING: base playlistid changed in update')
                 self.base_playlist = k
+        if not delta:
+            deleted_playlists = [k for k in catalog.playlists
+                                 if k not in playlists]
+        catalog.update_playlists(playlists, deleted_playlists)
+
+        # Maybe we have looped through here without a base playlist.  Then
+        # the server is broken?
+        if not self.base_playlist:
+            raise ValueError('Cannot find base playlist')
+        catalog.base_playlist = self.base_playlist
+
+        items, deleted = client.items(playlist_id=self.base_playlist,
+                                  meta=DAAP_META, update=delta)
+        if items is None:
+            raise ValueError('Cannot find items in base playlist')
+        for itemkey in items.keys():
+            # Clean it of NUL
+            for k in items[itemkey]:
+                if isinstance(items[itemkey][k], str):
+                    tmp = items[itemkey][k]
+                    items[itemkey][k] = tmp.replace('\x00', '')
+        if not delta:
+            deleted = [k for k in catalog.items if k not in items]
+        catalog.update_items(self.base_playlist, items, deleted)
+
+        deleted_items[self.base_playlist] = deleted
+        # Make sure that we ditch stuff from the in-house video, music,
+        # playlist and podcast tabs too.
+        #
+        # The callback will filter out irrelevant items, so we can just
+        # add these as we please, it's easier that way to than figure out
+        # the exact set.
+        for p in SharingItemTrackerImpl.fake_playlists:
+            deleted_items[p] = deleted
+
+        playlist_items = dict()
+        for k in playlists.keys():
+            if k == self.base_playlist:
+                continue
+            listed, deleted = client.items(playlist_id=k, meta=DAAP_META,
+                                           update=delta)
+            if listed is None:
+                raise ValueError('Cannot find items for playlist %d' % k)
+            if not delta:
+                deleted = [i for i in catalog.playlist_items.get(k, ())
+                           if i not in listed]
+            catalog.update_items(k, listed, deleted)
+            deleted_items[k] = deleted
+            playlist_items[k] = listed.keys()
+
+        catalog.db_id = client.db_id
+        catalog.db_persistent_id = client.db_persistent_id
+        catalog.revision = client.revision
+        catalog.address = self.address
+        catalog.save()
+
+        # Updates only pass on what changed.  But the first time we connect
+        # send everything: if we showed the saved catalog, its items need
+        # their paths redone for this session.
+        if update:
+            returned_playlist_items, returned_playlists = self.build_items(
+              client, playlists, items, playlist_items, update=True)
+        else:
+            returned_playlist_items, returned_playlists = self.build_items(
+              client, catalog.playlists, catalog.items,
+              catalog.playlist_items, update=self.showed_catalog)
+        # We don't append these items directly to the object and let
+        # the success callback to do it to prevent race.
+        return (returned_playlist_items, returned_playlists,
+                deleted_playlists, deleted_items)
+
+    def build_items(self, client, playlists, items, playlist_item_ids,
+                    update):
+        """Make the SharingInfos and SharingItems for raw playlists, raw
+        base playlist items and the item ids in the other playlists.  The
+        fake playlists are only made when update is False.
+        """
+        name = self.share.name
+        host = self.share.host
+        port = self.share.port
+        returned_playlists = dict()
+        video_tab_id = unicode(md5(repr((name,
+                                         host,
+                                         port, u'video'))).hexdigest())
+        audio_tab_id = unicode(md5(repr((name,
+                                         host,
+                                         port, u'audio'))).hexdigest())
+        playlist_tab_id = unicode(md5(repr((name,
+                                            host,
+                                            port, u'playlist'))).hexdigest())
+        podcast_tab_id = unicode(md5(repr((name,
+                                           host,
+                                           port, u'podcast'))).hexdigest())
+        for k in playlists.keys():
+            is_base_playlist = k == self.base_playlist
             # This isn't the playlist id of the remote share, this is the
             # playlist id we use internally.
             # XXX is there anything better we can do than repr()?
@@ -823,26 +1039,6 @@ class SharingItemTrackerImpl(signals.SignalEmitter):
             returned_playlists['playlist'] = playlist_folder_info
             returned_playlists['podcast'] = podcast_folder_info
 
-        # Maybe we have looped through here without a base playlist.  Then
-        # the server is broken?
-        if not self.base_playlist:
-            raise ValueError('Cannot find base playlist')
-
-        items, deleted = client.items(playlist_id=self.base_playlist,
-                                  meta=DAAP_META, update=update)
-        if items is None:
-            raise ValueError('Cannot find items in base playlist')
-
-        deleted_items[self.base_playlist] = deleted
-        # Make sure that we ditch stuff from the in-house video, music,
-        # playlist and podcast tabs too.
-        #
-        # The callback will filter out irrelevant items, so we can just
-        # add these as we please, it's easier that way to than figure out
-        # the exact set.
-        for p in SharingItemTrackerImpl.fake_playlists:
-            deleted_items[p] = deleted
-
         itemdict = dict()
         returned_playlist_items = dict()
         returned_items = dict()
@@ -850,12 +1046,7 @@ class SharingItemTrackerImpl(signals.SignalEmitter):
         audio_items = dict()
         sharing_item_meth = self.sharing_item
         for itemkey in items.keys():
-            # Clean it of NUL
-            for k in items[itemkey]:
-                if isinstance(items[itemkey][k], str):
-                    tmp = items[itemkey][k]
-                    items[itemkey][k] = tmp.replace('\x00', '')
-            item = sharing_item_meth(items[itemkey])
+            item = sharing_item_meth(items[itemkey], client)
             itemdict[itemkey] = item
             returned_items[itemkey] = item
             if item.file_type == u'video':
@@ -877,14 +1068,15 @@ class SharingItemTrackerImpl(signals.SignalEmitter):
             if k == self.base_playlist:
                 continue
             returned_items = dict()
-            items, deleted = client.items(playlist_id=k, meta=DAAP_META,
-                                               update=update)
-            if items is None:
-                raise ValueError('Cannot find items for playlist %d' % k)
-            deleted_items[k] = deleted
-            for itemkey in items.keys():
-                item = itemdict[itemkey]
-                returned_items[itemkey] = itemdict[itemkey]
+            for itemkey in playlist_item_ids.get(k, ()):
+                try:
+                    item = itemdict[itemkey]
+                except KeyError:
+                    # The item itself didn't change in this update.
+                    item = sharing_item_meth(self.catalog.items[itemkey],
+                                             client)
+                    itemdict[itemkey] = item
+                returned_items[itemkey] = item
                 try:
                     key = 'com.apple.itunes.is-podcast-playlist'
                     if playlists[k].has_key(key) and playlists[k][key]:
@@ -898,10 +1090,7 @@ class SharingItemTrackerImpl(signals.SignalEmitter):
         returned_playlist_items['podcast'] = podcast_items
         returned_playlist_items['playlist'] = playlist_items
 
-        # We don't append these items directly to the object and let
-        # the success callback to do it to prevent race.
-        return (returned_playlist_items, returned_playlists,
-                deleted_playlists, deleted_items)
+        return returned_playlist_items, returned_playlists
 
     # If we are disconnecting, then, disconnect() sets the self.client
     # to None before actually running the client.disconnect() routine.
@@ -1150,6 +1339,12 @@ class SharingManagerBackend(object):
         self.daap_playlists = dict()    # Playlist, in daap format
         self.playlist_item_map = dict() # Playlist -> item mapping
         self.deleted_item_map = dict()  # Playlist -> deleted item mapping
+        # Encoded daap items: meta -> item id -> fragment.  Dropped when
+        # the item changes.
+        self.item_fragments = dict()
+        # Encoded item listings for the current revision:
+        # (playlist id, meta, delta) -> listing, see get_item_listing().
+        self.item_listings = dict()
         self.in_shutdown = False
         self.config_handle = app.backend_config_watcher.connect('changed',
                              self.on_config_changed)
@@ -1191,6 +1386,7 @@ class SharingManagerBackend(object):
                 self.make_item_dict(message.items)
                 for d in deleted:
                     self.daapitems[d] = self.deleted_item()
+                    self.forget_item_fragments(d)
 
     def handle_items_changed(self, message):
         # If items are changed, overwrite with a recreated entry.  This
@@ -1211,6 +1407,7 @@ class SharingManagerBackend(object):
                 try:
                     if message.id is None:
                         self.daapitems[itemid] = self.deleted_item()
+                        self.forget_item_fragments(itemid)
                 except KeyError:
                     pass
             if message.id is not None:
@@ -1251,10 +1448,16 @@ class SharingManagerBackend(object):
     def deleted_item(self):
         return dict(revision=self.revision, valid=False)
 
+    # At this point: item_lock acquired
+    def forget_item_fragments(self, item_id):
+        for fragments in self.item_fragments.itervalues():
+            fragments.pop(item_id, None)
+
     # At this point: item_lock acquired
     def update_revision(self, directed=None):
         self.revision += 1
         self.directed = directed
+        self.item_listings.clear()
         self.revision_cv.notify_all()
 
     def make_daap_playlists(self, items, typ):
@@ -1661,46 +1864,66 @@ class SharingManagerBackend(object):
         return item.feed_id and is_feed and not item.is_file_item
 
     def get_items(self, playlist_id=None):
-        # Easy: just return
         with self.item_lock:
-            items = dict()
-            if not playlist_id:
-                for k in self.daapitems.keys():
-                    item = self.daapitems[k]
-                    valid = item['valid']
-                    if valid:
-                        mk = item['com.apple.itunes.mediakind']
-                        ik = item['org.participatoryculture.miro.itemkind']
-                        podcast = ik and (ik & MIRO_ITEMKIND_PODCAST)
-                        include_if_podcast = (podcast and
-                          SharingManagerBackend.SHARE_FEED in self.share_types)
-                    if (not valid or
-                      mk in self.share_types and 
-                      (not podcast or include_if_podcast)):
-                        items[k] = item
-                    else:
-                        items[k] = self.deleted_item()
-                return items
-            # XXX Somehow cache this?
-            playlist = dict()
-            if self.playlist_item_map.has_key(playlist_id):
-                for x in self.daapitems.keys():
-                    item = self.daapitems[x]
-                    valid = item['valid']
-                    if valid:
-                        mk = item['com.apple.itunes.mediakind']
-                        ik = item['org.participatoryculture.miro.itemkind']
-                        podcast = ik and (ik & MIRO_ITEMKIND_PODCAST)
-                        include_if_podcast = (podcast and
-                          SharingManagerBackend.SHARE_FEED in self.share_types)
-                    if (x in self.playlist_item_map[playlist_id] and
-                      (not valid or
-                       mk in self.share_types and
-                       (not podcast or include_if_podcast))):
-                        playlist[x] = item
-                    else:
-                        playlist[x] = self.deleted_item()
-            return playlist
+            return self._get_items(playlist_id)
+
+    # At this point: item_lock acquired
+    def _get_items(self, playlist_id):
+        items = dict()
+        if playlist_id and playlist_id not in self.playlist_item_map:
+            return items
+        if playlist_id:
+            in_playlist = set(self.playlist_item_map[playlist_id])
+        share_feed = SharingManagerBackend.SHARE_FEED in self.share_types
+        for k, item in self.daapitems.iteritems():
+            valid = item['valid']
+            if valid:
+                mk = item['com.apple.itunes.mediakind']
+                ik = item['org.participatoryculture.miro.itemkind']
+                podcast = ik and (ik & MIRO_ITEMKIND_PODCAST)
+                include_if_podcast = podcast and share_feed
+            if ((not playlist_id or k in in_playlist) and
+              (not valid or
+               mk in self.share_types and
+               (not podcast or include_if_podcast))):
+                items[k] = item
+            else:
+                items[k] = self.deleted_item()
+        return items
+
+    def get_item_listing(self, playlist_id, meta_list, delta):
+        """Returns (revision, count, encoded items, deleted item ids) for
+        the items of playlist_id (None for the whole library) changed since
+        revision delta.  The listing is built from per-item fragments which
+        stay encoded until the item changes, and is kept until the next
+        revision bump.
+        """
+        meta = tuple(meta_list)
+        key = (playlist_id, meta, delta)
+        with self.item_lock:
+            try:
+                return self.item_listings[key]
+            except KeyError:
+                pass
+            fragments = self.item_fragments.setdefault(meta, dict())
+            encoded = []
+            deleted = []
+            for k, itemprop in self._get_items(playlist_id).iteritems():
+                if itemprop['revision'] <= delta:
+                    continue
+                if not itemprop['valid']:
+                    deleted.append(k)
+                    continue
+                try:
+                    fragment = fragments[k]
+                except KeyError:
+                    fragment = libdaap.encode_item(itemprop, meta_list)
+                    fragments[k] = fragment
+                encoded.append(fragment)
+            listing = (self.revision, len(encoded),
+                       libdaap.EncodedFragment(''.join(encoded)), deleted)
+            self.item_listings[key] = listing
+            return listing
 
     def make_item_dict(self, items):
         # See the daap_rmapping/daap_mapping for a list of mappings that
@@ -1790,6 +2013,7 @@ class SharingManagerBackend(object):
             itemprop['valid'] = True
 
             self.daapitems[item.id] = itemprop
+            self.forget_item_fragments(item.id)
 
     def finished_callback(self, session):
         # Like shutdown but only shuts down one of the sessions.  No need to
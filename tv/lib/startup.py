@@ -269,6 +269,7 @@ def finish_startup(obj, thread):
     database.set_thread(thread)
     logging.info("Installing deleted file checker...")
     item.setup_deleted_checker()
+    item.setup_expire_scheduler()
     logging.info("Restoring database...")
     start = time.time()
     app.db = storedatabase.LiveStorage()
@@ -418,7 +419,7 @@ def on_frontend_started():
     logging.info("Starting auto downloader...")
     autodler.start_downloader()
     yield None
-    feed.expire_items()
+    item.start_expire_scheduler()
     yield None
     commandline.startup()
     yield None
@@ -544,6 +545,10 @@ def clear_icon_cache_orphans():
                 "db object: %s", ','.join(removed_objs))
     yield None
 
+    # make IconCache objects with identical icons share a single file
+    for dummy in iconcache.collapse_duplicate_files():
+        yield None
+
     # delete files in the icon cache directory that don't belong to IconCache
     # objects.
 
@@ -107,6 +107,17 @@ _sqlite_type_map = {
         schema.SchemaStringSet: 'text',
 }
 
+# SchemaItem subclasses whose python values compare the same way as the
+# values we store in sqlite.  See comparable_columns()
+_sql_comparable_types = (
+        schema.SchemaBool,
+        schema.SchemaFloat,
+        schema.SchemaString,
+        schema.SchemaURL,
+        schema.SchemaInt,
+        schema.SchemaDateTime,
+)
+
 VERSION_KEY = "Democracy Version"
 
 def split_values_for_sqlite(value_list):
@@ -159,13 +170,16 @@ class LiveStorage:
         self._schema_version = schema_version
         self._schema_map = {}
         self._schema_column_map = {}
+        self._table_schema_map = {}
         self._all_schemas = []
         self._object_map = {} # maps object id -> DDBObjects in memory
-        self._ids_loaded = set()
+        # maps table names -> set of ids loaded into memory
+        self._ids_loaded = {}
         self._statements_in_transaction = []
         eventloop.connect("event-finished", self.on_event_finished)
         for oschema in object_schemas:
             self._all_schemas.append(oschema)
+            self._table_schema_map[oschema.table_name] = oschema
             for klass in oschema.ddb_object_classes():
                 self._schema_map[klass] = oschema
                 for field_name, schema_item in oschema.fields:
@@ -401,21 +415,28 @@ class LiveStorage:
         name TEXT PRIMARY KEY NOT NULL,
         serialized_value BLOB NOT NULL);""")
 
+    def _ids_loaded_for_table(self, table_name):
+        try:
+            return self._ids_loaded[table_name]
+        except KeyError:
+            self._ids_loaded[table_name] = set()
+            return self._ids_loaded[table_name]
+
     def remember_object(self, obj):
-        key = (obj.id, app.db.table_name(obj.__class__))
-        self._object_map[key] = obj
-        self._ids_loaded.add(key)
+        table_name = app.db.table_name(obj.__class__)
+        self._object_map[(obj.id, table_name)] = obj
+        self._ids_loaded_for_table(table_name).add(obj.id)
 
     def forget_object(self, obj):
-        key = (obj.id, app.db.table_name(obj.__class__))
+        table_name = app.db.table_name(obj.__class__)
         try:
-            del self._object_map[key]
+            del self._object_map[(obj.id, table_name)]
         except KeyError:
             details = ('storedatabase.forget_object: '
                        'key error in forget_object: %s (obj: %s)' %
                        (obj.id, obj))
             logging.error(details)
-        self._ids_loaded.discard(key)
+        self._ids_loaded_for_table(table_name).discard(obj.id)
 
     def _insert_sql_for_schema(self, obj_schema):
         return "INSERT INTO %s (%s) VALUES(%s)" % (obj_schema.table_name,
@@ -555,6 +576,14 @@ class LiveStorage:
         """
         return self._object_map[(id_, app.db.table_name(klass))]
 
+    def get_obj_by_table(self, id_, table_name):
+        """Get a DDBObject using its table name rather than its class.
+
+        Like get_obj_by_id(), this raises a KeyError if the object isn't
+        loaded.
+        """
+        return self._object_map[(id_, table_name)]
+
     def id_alive(self, id_, klass):
         """Check if an id exists and is loaded in the database."""
         return (id_, app.db.table_name(klass)) in self._object_map
@@ -562,10 +591,26 @@ class LiveStorage:
     def table_name(self, klass):
         return self._schema_map[klass].table_name
 
+    def table_columns(self, table_name):
+        """Get the set of column names for a table."""
+        oschema = self._table_schema_map[table_name]
+        return set(name for name, schema_item in oschema.fields)
+
+    def comparable_columns(self, table_name):
+        """Get the columns of a table that can be checked in memory.
+
+        These are the columns where comparing the DDBObject attribute in
+        python gives the same result as comparing the column in SQL.
+        """
+        oschema = self._table_schema_map[table_name]
+        return set(name for name, schema_item in oschema.fields
+                if isinstance(schema_item, _sql_comparable_types))
+
     def object_from_class_table(self, obj, klass):
         return self._schema_map[klass] is self._schema_map[obj.__class__]
 
-    def _get_query_bottom(self, table_name, where, joins, order_by, limit):
+    def _get_query_bottom(self, table_name, where, joins, order_by, limit,
+            group_by=None):
         sql = StringIO()
         sql.write("FROM %s\n" % table_name)
         if joins is not None:
@@ -573,6 +618,8 @@ class LiveStorage:
                 sql.write('LEFT JOIN %s ON %s\n' % (join_table, join_where))
         if where is not None:
             sql.write("WHERE %s" % where)
+        if group_by is not None:
+            sql.write(" GROUP BY %s" % group_by)
         if order_by is not None:
             sql.write(" ORDER BY %s" % order_by)
         if limit is not None:
@@ -598,8 +645,11 @@ class LiveStorage:
 
         :returns: True iff we needed to load objects
         """
-        unrestored_ids = set(id_list).difference(
-          i for i, unused in self._ids_loaded)
+        # Only look at the ids we were passed, so that the cost of this
+        # method depends on the size of id_list rather than the number of
+        # objects in memory.
+        loaded = self._ids_loaded_for_table(self.table_name(klass))
+        unrestored_ids = set(i for i in id_list if i not in loaded)
         if unrestored_ids:
             # restore any objects that we don't already have in memory.
             schema = self._schema_map[klass]
@@ -690,12 +740,12 @@ class LiveStorage:
         self._execute(sql.getvalue(), values, is_update=True)
 
     def select(self, klass, columns, where, values, joins=None, limit=None,
-            convert=True):
+            convert=True, group_by=None):
         schema = self._schema_map[klass]
         sql = StringIO()
         sql.write('SELECT %s ' % ', '.join(columns))
         sql.write(self._get_query_bottom(schema.table_name, where, joins, None,
-            limit))
+            limit, group_by))
         results = self._execute(sql.getvalue(), values)
         if not convert:
             return results
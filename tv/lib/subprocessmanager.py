@@ -297,7 +297,9 @@ class SubprocessManager(object):
         up.
 
         We will install a MessageHandler for message_base_class that sends
-        them to the subprocess.
+        them to the subprocess.  If message_base_class is None, then no
+        handler is installed, use send_message() to send messages.  This is
+        useful when several SubprocessManagers handle the same messages.
 
         responder will receive callbacks when the subprocess sends messages.
 
@@ -306,7 +308,8 @@ class SubprocessManager(object):
         """
         if handler_args is None:
             handler_args = ()
-        message_base_class.install_handler(self)
+        if message_base_class is not None:
+            message_base_class.install_handler(self)
         self.responder = responder
         self.handler_class = handler_class
         self.handler_args = handler_args
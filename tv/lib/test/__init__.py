@@ -60,6 +60,8 @@ from miro.test.httpclienttest import *
 from miro.test.httpdownloadertest import *
 from miro.test.httpauthtoolstest import *
 from miro.test.feedtest import *
+from miro.test.feedupdatetest import *
+from miro.test.autodlertest import *
 from miro.test.feedparsertest import *
 from miro.test.parseurltest import *
 from miro.test.utiltest import *
@@ -69,6 +71,7 @@ from miro.test.messagetest import *
 from miro.test.strippertest import *
 from miro.test.xhtmltest import *
 from miro.test.iconcachetest import *
+from miro.test.sharingtest import *
 from miro.test.databasetest import *
 from miro.test.itemtest import *
 from miro.test.filetypestest import *
@@ -77,6 +80,7 @@ from miro.test.searchtest import *
 from miro.test.infolisttest import *
 from miro.test.fileobjecttest import *
 from miro.test.fastresumetest import *
+from miro.test.daemonprotocoltest import *
 from miro.test.widgetstateconstantstest import *
 from miro.test.metadatatest import *
 from miro.test.tableselectiontest import *
@@ -86,6 +90,7 @@ from miro.test.subprocesstest import *
 from miro.test.itemfiltertest import *
 from miro.test.extensiontest import *
 from miro.test.idleiteratetest import *
+from miro.test.imagepooltest import *
 
 # platform specific tests
 
@@ -0,0 +1,69 @@
+from datetime import datetime, timedelta
+
+from miro import app
+from miro import autodler
+from miro import prefs
+from miro.feed import Feed
+from miro.item import Item, FeedParserValues
+from miro.singleclick import _build_entry
+from miro.test.framework import MiroTestCase
+
+class ManualDownloaderTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.feed1 = Feed(u'http://example.com/feed1')
+        self.feed2 = Feed(u'http://example.com/feed2')
+        self.now = datetime.now()
+        self.items1 = [self.make_pending_item(self.feed1, i)
+                for i in xrange(3)]
+        self.items2 = [self.make_pending_item(self.feed2, 0)]
+        self.started = []
+        self.old_download = Item.download
+        def download(item, autodl=False):
+            self.started.append(item)
+            item.pendingManualDL = False
+            item.signal_change()
+        Item.download = download
+        self.old_max_manual = app.config.get(prefs.MAX_MANUAL_DOWNLOADS)
+        app.config.set(prefs.MAX_MANUAL_DOWNLOADS, 10)
+        self.downloader = autodler.Downloader(False)
+
+    def tearDown(self):
+        Item.download = self.old_download
+        app.config.set(prefs.MAX_MANUAL_DOWNLOADS, self.old_max_manual)
+        MiroTestCase.tearDown(self)
+
+    def make_pending_item(self, feed, days_old):
+        url = u'%s/%d.mp4' % (feed.get_url(), days_old)
+        item = Item(FeedParserValues(_build_entry(url, 'video/x-unknown')),
+                feed_id=feed.id)
+        item.releaseDateObj = self.now - timedelta(days=days_old)
+        item.pendingManualDL = True
+        item.signal_change()
+        return item
+
+    def test_order(self):
+        # feeds should take turns, and the newest item in each feed should
+        # start first
+        self.downloader.start_downloads_idle()
+        self.assertEquals(self.started, [self.items1[0], self.items2[0],
+            self.items1[1], self.items1[2]])
+        self.assertEquals(self.downloader.pending_count, 0)
+
+    def test_running_count(self):
+        # feeds with fewer running downloads should go first
+        self.downloader.running_on_add(None, self.items1[0])
+        self.downloader.start_downloads_idle()
+        self.assertEquals(self.started[0], self.items2[0])
+
+    def test_release_date_changed(self):
+        self.items1[2].releaseDateObj = self.now + timedelta(days=1)
+        self.items1[2].signal_change()
+        self.downloader.start_downloads_idle()
+        self.assertEquals(self.started[0], self.items1[2])
+
+    def test_max_downloads(self):
+        self.downloader.MAX = 1
+        self.downloader.running_on_add(None, self.items1[0])
+        self.downloader.start_downloads_idle()
+        self.assertEquals(self.started, [])
@@ -0,0 +1,149 @@
+import datetime
+
+from miro.dl_daemon import command
+from miro.dl_daemon import protocol
+from miro.test.framework import MiroTestCase
+
+class FakeUnicode(unicode):
+    pass
+
+class DaemonProtocolTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.encoder = protocol.CommandEncoder()
+        self.decoder = protocol.CommandDecoder()
+
+    def make_status(self, dlid, **kwargs):
+        status = {
+            'dlid': dlid,
+            'url': u'http://example.com/%s.torrent' % dlid,
+            'state': u'downloading',
+            'totalSize': 1000,
+            'currentSize': 100,
+            'eta': 50,
+            'rate': 12.5,
+            'filename': '/tmp/%s.part' % dlid,
+            'startTime': 12345.0,
+            'dlerType': 'BitTorrent',
+            'activity': None,
+        }
+        status.update(kwargs)
+        return status
+
+    def round_trip(self, comm):
+        data = self.encoder.encode(comm)
+        return data, self.decoder.decode(data)
+
+    def check_status_command(self, statuses, *args):
+        comm = command.BatchUpdateDownloadStatus(None, statuses, *args)
+        data, decoded = self.round_trip(comm)
+        self.assert_(isinstance(decoded, command.BatchUpdateDownloadStatus))
+        self.assertEquals(decoded.command_id, comm.command_id)
+        self.assertEquals(decoded.args, comm.args)
+        for sent, received in zip(statuses, decoded.args[0]):
+            for key in sent:
+                self.assertEquals(type(sent[key]), type(received[key]))
+        return data
+
+    def test_status_deltas(self):
+        statuses = [self.make_status(u'dl%d' % i) for i in xrange(10)]
+        first = self.check_status_command(statuses, False)
+        self.assertEquals(first[0], protocol.FRAME_STATUS)
+        statuses = [self.make_status(u'dl%d' % i, currentSize=200, rate=1.5)
+                for i in xrange(10)]
+        second = self.check_status_command(statuses, True)
+        # only the changed fields should be sent the second time
+        self.assert_(len(second) < len(first) / 2)
+        # don't confuse values that are equal but of different types
+        statuses = [self.make_status(u'dl%d' % i, currentSize=200.0,
+            rate=1.5) for i in xrange(10)]
+        self.check_status_command(statuses, True)
+
+    def test_status_command_without_cmd_done(self):
+        self.check_status_command([self.make_status(u'dl')])
+
+    def test_added_and_removed_keys(self):
+        self.check_status_command([self.make_status(u'dl',
+            metainfo='torrent-data')], False)
+        self.check_status_command([self.make_status(u'dl',
+            seeders=4)], False)
+        self.check_status_command([self.make_status(u'dl')], False)
+
+    def test_same_dlid_twice(self):
+        self.check_status_command([self.make_status(u'dl')], False)
+        self.check_status_command([
+            self.make_status(u'dl', state=u'finished'),
+            self.make_status(u'dl', state=u'uploading'),
+            self.make_status(u'dl', state=u'uploading', currentSize=1000),
+            ], False)
+        self.check_status_command([self.make_status(u'dl', eta=0)], False)
+
+    def test_forget_finished(self):
+        self.check_status_command([self.make_status(u'dl'),
+            self.make_status(u'dl2')], False)
+        self.check_status_command([self.make_status(u'dl',
+            state=u'stopped')], False)
+        self.assertEquals(self.encoder.statuses.keys(), [u'dl2'])
+        self.assertEquals(self.decoder.statuses.keys(), [u'dl2'])
+
+    def test_decoded_status_is_a_copy(self):
+        self.check_status_command([self.make_status(u'dl')], False)
+        comm = command.BatchUpdateDownloadStatus(None,
+                [self.make_status(u'dl', eta=5)], False)
+        data, decoded = self.round_trip(comm)
+        # RemoteDownloader.update_status() changes the dicts it gets
+        decoded.args[0][0]['url'] = u'changed'
+        self.check_status_command([self.make_status(u'dl', eta=6)], False)
+
+    def test_pickle_fallback(self):
+        self.check_status_command([self.make_status(u'dl')], False)
+        statuses = [self.make_status(u'dl', channelName=FakeUnicode(u'a'))]
+        data = self.check_status_command(statuses, False)
+        self.assertEquals(data[0], protocol.FRAME_PICKLE)
+        # the pickled status shouldn't change the last status that we
+        # calculate deltas against
+        keys, types, values, simple = self.encoder.statuses[u'dl']
+        self.assertEquals(dict(zip(keys, values)), self.make_status(u'dl'))
+        self.assertEquals(self.decoder.statuses[u'dl'],
+                self.make_status(u'dl'))
+        self.check_status_command([self.make_status(u'dl', eta=1)], False)
+        status = self.make_status(u'dl')
+        status[FakeUnicode(u'key')] = 1
+        data = self.check_status_command([status], False)
+        self.assertEquals(data[0], protocol.FRAME_PICKLE)
+
+    def test_batch_command(self):
+        commands = {
+            u'dl1': (command.DownloaderBatchCommand.STOP,
+                {'upload': False, 'delete': True}),
+            u'dl2': (command.DownloaderBatchCommand.RESUME,
+                {'url': u'http://example.com/', 'content_type': None,
+                    'channel_name': u'chan'}),
+        }
+        comm = command.DownloaderBatchCommand(None, commands)
+        data, decoded = self.round_trip(comm)
+        self.assertEquals(data[0], protocol.FRAME_BATCH_COMMAND)
+        self.assert_(isinstance(decoded, command.DownloaderBatchCommand))
+        self.assertEquals(decoded.command_id, comm.command_id)
+        self.assertEquals(decoded.args, comm.args)
+
+        commands[u'dl3'] = (command.DownloaderBatchCommand.RESTORE,
+                {'downloader': {'startTime': datetime.datetime.now()}})
+        comm = command.DownloaderBatchCommand(None, commands)
+        data, decoded = self.round_trip(comm)
+        self.assertEquals(data[0], protocol.FRAME_PICKLE)
+        self.assertEquals(decoded.args, comm.args)
+
+    def test_other_commands(self):
+        comm = command.UpdateConfigCommand(None, 'key', 'value')
+        data, decoded = self.round_trip(comm)
+        self.assertEquals(data[0], protocol.FRAME_PICKLE)
+        self.assert_(isinstance(decoded, command.UpdateConfigCommand))
+        self.assertEquals(decoded.args, comm.args)
+
+    def test_bad_data(self):
+        self.assertRaises(protocol.ProtocolError, self.decoder.decode, 'X')
+        self.assertRaises(protocol.ProtocolError, self.decoder.decode,
+                protocol.FRAME_STATUS + 'garbage')
+        self.assertRaises(protocol.ProtocolError, self.decoder.decode,
+                protocol.FRAME_PICKLE + 'garbage')
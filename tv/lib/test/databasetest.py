@@ -7,6 +7,7 @@ from miro import databaselog
 from miro import item
 from miro import feed
 from miro import schema
+from miro import viewpredicate
 
 class DatabaseTestCase(MiroTestCase):
     def setUp(self):
@@ -146,6 +147,51 @@ class ViewTrackerTest(DatabaseTestCase):
         self.assertEquals(self.remove_callbacks, [self.i2])
         self.assertEquals(self.change_callbacks, [self.i1])
 
+    def test_bulk_changes_coalesced(self):
+        self.setup_view(item.Item.make_view("feed.userTitle='booya'",
+                joins={'feed': 'feed.id=item.feed_id'}))
+        self.tracker.set_bulk_mode(True)
+        bulk_added = []
+        bulk_changed = []
+        self.tracker.connect('bulk-added',
+                lambda tracker, objs: bulk_added.append(objs))
+        self.tracker.connect('bulk-changed',
+                lambda tracker, objs: bulk_changed.append(objs))
+        app.bulk_sql_manager.start()
+        self.i1.set_title(u"new title")
+        self.i1.set_title(u"newer title")
+        self.feed2.set_title(u"booya")
+        self.i3.signal_change()
+        # nothing should happen until we finish
+        self.assertEquals(bulk_added, [])
+        self.assertEquals(bulk_changed, [])
+        app.bulk_sql_manager.finish()
+        self.assertEquals(bulk_added, [[self.i3]])
+        self.assertEquals(bulk_changed, [[self.i1]])
+        self.assertEquals(self.add_callbacks, [])
+        self.assertEquals(self.change_callbacks, [])
+
+    def test_bulk_change_then_remove(self):
+        self.setup_view(item.Item.make_view("feed.userTitle='booya'",
+                joins={'feed': 'feed.id=item.feed_id'}))
+        app.bulk_sql_manager.start()
+        self.i1.set_title(u"new title")
+        self.i1.remove()
+        app.bulk_sql_manager.finish()
+        self.assertEquals(self.change_callbacks, [])
+        self.assertEquals(self.remove_callbacks, [self.i1])
+
+    def test_check_objects_sql(self):
+        # check_objects() should work for trackers that can't be checked in
+        # memory too
+        self.setup_view(item.Item.make_view('feed_id=? AND filename IS NULL',
+                (self.feed.id,)))
+        self.i3.feed_id = self.feed.id
+        self.i3.signal_change()
+        self.assertEquals(self.add_callbacks, [self.i3])
+        self.tracker.check_objects([self.i1, self.i2, self.i3])
+        self.assertSameSet(self.change_callbacks, [self.i1, self.i2, self.i3])
+
     def test_unlink(self):
         self.tracker.unlink()
         self.feed2.set_title(u"booya")
@@ -167,6 +213,75 @@ class ViewTrackerTest(DatabaseTestCase):
         self.clear_ddb_object_cache()
         tracker.check_all_objects()
 
+    def test_track_in_memory(self):
+        self.setup_view(item.Item.make_view("feed.userTitle='booya'",
+                joins={'feed': 'feed.id=item.feed_id'}))
+        self.assert_(self.tracker.predicate is not None)
+        # changing a feed doesn't update item trackers, but the next change
+        # to the item should see the new feed data.
+        self.feed2.set_title(u"booya")
+        self.i3.signal_change()
+        self.assertEquals(self.add_callbacks, [self.i3])
+
+    def test_track_sql_fallback(self):
+        # we can't compare filenames in memory
+        self.setup_view(item.Item.make_view('feed_id=? AND filename IS NULL',
+                (self.feed2.id,)))
+        self.assertEquals(self.tracker.predicate, None)
+        self.i3.signal_change()
+        self.assertEquals(self.change_callbacks, [self.i3])
+
+class ViewPredicateTest(DatabaseTestCase):
+    def check_predicate(self, view, obj):
+        predicate = viewpredicate.compile_predicate(view.table_name,
+                view.where, view.joins)
+        in_view = obj.id in view.id_list()
+        self.assertEquals(predicate.matches(obj, view.values), in_view)
+
+    def check_views(self, obj):
+        self.check_predicate(item.Item.feed_view(self.feed.id), obj)
+        self.check_predicate(item.Item.visible_feed_view(self.feed.id), obj)
+        self.check_predicate(item.Item.auto_pending_view(), obj)
+        self.check_predicate(item.Item.manual_pending_view(), obj)
+        self.check_predicate(item.Item.toplevel_view(), obj)
+        self.check_predicate(item.Item.feed_available_view(self.feed.id),
+                obj)
+        self.check_predicate(item.Item.unique_new_video_view(), obj)
+        self.check_predicate(item.Item.media_children_view(obj.id), obj)
+
+    def test_views(self):
+        self.check_views(self.i1)
+        self.check_views(self.i3)
+        self.feed.set_auto_download_mode(u'all')
+        self.i1.set_title(u'new title')
+        self.i1.mark_item_seen()
+        self.check_views(self.i1)
+
+    def test_null_logic(self):
+        self.i1.deleted = None
+        self.i1.signal_change()
+        for where in ('deleted', 'NOT deleted', 'deleted IS NULL',
+                'deleted = 1 OR feed_id = 0', 'NOT (deleted AND 1)',
+                'deleted IN (1, 0)'):
+            self.check_predicate(item.Item.make_view(where), self.i1)
+
+    def test_like(self):
+        self.feed.set_title(u'Booya')
+        for where in ("userTitle LIKE 'booya'", "userTitle LIKE 'b_oy%'",
+                "userTitle NOT LIKE 'boo'", "userTitle LIKE '%oo%'"):
+            self.check_predicate(feed.Feed.make_view(where), self.feed)
+
+    def test_unsupported(self):
+        for where, joins in [
+            ('feed_id NOT IN (SELECT id from feed)', None),
+            ('pim.playlist_id=?', {'playlist_item_map AS pim':
+                'item.id=pim.item_id'}),
+            ('filename=?', None),
+            ("julianday('now') > 0", None),
+            ]:
+            self.assertRaises(viewpredicate.UnsupportedSQL,
+                    viewpredicate.compile_predicate, 'item', where, joins)
+
 # class TestViewLimiter(database.ViewLimiter):
 #     def __init__(self, *feeds_to_include):
 #         self.feeds_to_include = feeds_to_include
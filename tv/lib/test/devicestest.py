@@ -28,6 +28,7 @@
 # statement from all source files in the program, then also delete it here.
 
 import os
+import threading
 try:
     import simplejson as json
 except ImportError:
@@ -35,9 +36,10 @@ except ImportError:
 
 from miro.gtcache import gettext as _
 from miro.plat.utils import PlatformFilenameType
-from miro.test.framework import MiroTestCase
+from miro.test.framework import MiroTestCase, EventLoopTest
 
 from miro import devices
+from miro import fileutil
 
 class DeviceManagerTest(MiroTestCase):
     def build_config_file(self, filename, data):
@@ -302,3 +304,140 @@ class GlobSetTest(MiroTestCase):
         self.assertTrue(gs & set('ab'))
         self.assertTrue(gs & set('bc'))
         self.assertFalse(gs & set('cd'))
+
+class CopyWithProgressTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.source = os.path.join(self.tempdir, 'source')
+        self.dest = os.path.join(self.tempdir, 'dest')
+        self.data = os.urandom(1000) * 1000
+        f = open(self.source, 'wb')
+        f.write(self.data)
+        f.close()
+
+    def test_copy(self):
+        progress = []
+        self.assertTrue(fileutil.copy_with_progress(
+            self.source, self.dest, progress.append, block_size=300000))
+        self.assertEquals(progress, [300000, 300000, 300000, 100000])
+        self.assertEquals(open(self.dest, 'rb').read(), self.data)
+
+    def test_cancel(self):
+        progress = []
+        def progress_callback(count):
+            progress.append(count)
+            return True
+        self.assertFalse(fileutil.copy_with_progress(
+            self.source, self.dest, progress_callback, block_size=300000))
+        self.assertEquals(progress, [300000])
+
+class FakeSyncInfo(object):
+    def __init__(self, id_, video_path):
+        self.id = id_
+        self.video_path = video_path
+        self.size = os.path.getsize(video_path)
+
+class FakeSyncDevice(object):
+    def __init__(self):
+        self.info = None
+        self.database = devices.DeviceDatabase()
+
+class TestSyncManager(devices.DeviceSyncManager):
+    def __init__(self, test, device):
+        devices.DeviceSyncManager.__init__(self, device)
+        self.test = test
+        self.added = []
+
+    def _add_item(self, final_path, info):
+        self.added.append((final_path, info))
+
+    def _schedule_sync_changed(self):
+        pass
+
+    def _check_finished(self):
+        if not self.copying:
+            self.test.stopEventLoop(abnormal=False)
+
+class ProgressSyncManager(TestSyncManager):
+    # send sync changed messages often and record the progress for them
+    SYNC_CHANGED_INTERVAL = 0.01
+    _schedule_sync_changed = devices.DeviceSyncManager._schedule_sync_changed
+
+    def __init__(self, test, device):
+        TestSyncManager.__init__(self, test, device)
+        self.sent_progress = []
+
+    def _send_sync_changed(self):
+        self.sent_progress.append(self.get_progress())
+        self.test.on_sync_changed()
+
+class DeviceSyncCopyTest(EventLoopTest):
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        self.manager = TestSyncManager(self, FakeSyncDevice())
+        self.infos = []
+        for i in range(4):
+            path = os.path.join(self.tempdir, 'source-%d' % i)
+            f = open(path, 'wb')
+            f.write(str(i) * (100000 * (i + 1)))
+            f.close()
+            self.infos.append(FakeSyncInfo(i, path))
+
+    def dest_path(self, info):
+        return os.path.join(self.tempdir, 'dest-%d' % info.id)
+
+    def test_copy(self):
+        for info in self.infos:
+            self.manager.copy_file(info, self.dest_path(info))
+        self.runEventLoop()
+        self.assertEquals(sorted(info.id for path, info in
+                                 self.manager.added), [0, 1, 2, 3])
+        for path, info in self.manager.added:
+            self.assertEquals(path, self.dest_path(info))
+            self.assertEquals(open(path, 'rb').read(),
+                              open(info.video_path, 'rb').read())
+        self.assertEquals(self.manager.finished, 4)
+        self.assertEquals(self.manager.get_progress(), 1.0)
+
+    def on_sync_changed(self):
+        pass
+
+    def test_progress_messages(self):
+        # we should send progress while a file is being copied, not just when
+        # it finishes
+        self.manager = ProgressSyncManager(self, FakeSyncDevice())
+        copied_some = threading.Event()
+        resume = threading.Event()
+        real_copy_with_progress = fileutil.copy_with_progress
+        def slow_copy_with_progress(source, dest, progress_callback):
+            def wait_for_progress(count):
+                rv = progress_callback(count)
+                copied_some.set()
+                resume.wait(10)
+                return rv
+            return real_copy_with_progress(source, dest, wait_for_progress,
+                                           block_size=100000)
+        def on_sync_changed():
+            if copied_some.isSet():
+                resume.set()
+        self.on_sync_changed = on_sync_changed
+        fileutil.copy_with_progress = slow_copy_with_progress
+        try:
+            self.manager.copy_file(self.infos[3], self.dest_path(self.infos[3]))
+            self.runEventLoop()
+        finally:
+            fileutil.copy_with_progress = real_copy_with_progress
+            resume.set()
+        self.assertEquals(len(self.manager.added), 1)
+        partial = [p for p in self.manager.sent_progress if 0 < p < 1]
+        self.assertNotEquals(partial, [])
+
+    def test_cancel(self):
+        self.manager.stopping = True
+        for info in self.infos:
+            self.manager.copy_file(info, self.dest_path(info))
+        self.runEventLoop()
+        self.assertEquals(self.manager.added, [])
+        self.assertEquals(self.manager.finished, 4)
+        for info in self.infos:
+            self.assertFalse(os.path.exists(self.dest_path(info)))
@@ -6,8 +6,9 @@ from miro import app
 from miro import prefs
 from miro import dialogs
 from miro import feedparserutil
-from miro.item import Item
+from miro.item import Item, FileItem, FeedParserValues
 from miro.feed import validate_feed_url, normalize_feed_url, Feed
+from miro.singleclick import _build_entry
 
 from miro.test.framework import MiroTestCase, EventLoopTest
 
@@ -530,5 +531,119 @@ by-nd/1.0</creativeCommons:license>
         self.assertEquals(self.item.get_title(), "new title")
 
 
+class FeedCountsTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.feeds = [Feed(u'dtv:manualFeed', initiallyAutoDownloadable=False)]
+        for i in xrange(3):
+            self.feeds.append(Feed(u'http://example.com/feed%d' % i))
+        self.file_items = []
+        for i, feed in enumerate(self.feeds):
+            for j in xrange(i):
+                url = u'http://example.com/%d/%d.mp4' % (i, j)
+                Item(FeedParserValues(_build_entry(url, 'video/x-unknown')),
+                        feed_id=feed.id)
+            for j in xrange(i + 1):
+                path = self.make_temp_path('.avi')
+                open(path, 'wb').write('data')
+                self.file_items.append(FileItem(path, feed_id=feed.id))
+        self.feed_counts_calls = 0
+        self.old_feed_counts = Item.feed_counts
+        def counting_feed_counts(feed_ids):
+            self.feed_counts_calls += 1
+            return self.old_feed_counts(feed_ids)
+        Item.feed_counts = staticmethod(counting_feed_counts)
+
+    def tearDown(self):
+        Item.feed_counts = self.old_feed_counts
+        MiroTestCase.tearDown(self)
+
+    def check_counts(self):
+        for feed in self.feeds:
+            self.assertEquals(feed.num_downloaded(),
+                    feed.downloaded_items.count())
+            self.assertEquals(feed.num_downloading(),
+                    feed.downloading_items.count())
+            self.assertEquals(feed.num_unwatched(),
+                    feed.unwatched_items.count())
+            self.assertEquals(feed.num_available(),
+                    feed.available_items.count() -
+                    feed.auto_pending_items.count())
+
+    def test_counts(self):
+        self.check_counts()
+        self.assertEquals([feed.num_unwatched() for feed in self.feeds],
+                [1, 2, 3, 4])
+        self.file_items[0].mark_item_seen()
+        self.file_items[-1].mark_item_seen()
+        self.check_counts()
+        self.assertEquals([feed.num_unwatched() for feed in self.feeds],
+                [0, 2, 3, 3])
+
+    def test_single_query(self):
+        # The first count should calculate counts for all feeds in 1 query
+        self.feeds[0].num_unwatched()
+        for feed in self.feeds:
+            feed.num_unwatched()
+            feed.num_available()
+            feed.num_downloaded()
+        self.assertEquals(self.feed_counts_calls, 1)
+        # After counts are invalidated, we should recalculate counts for all
+        # the feeds that need it at once
+        self.feeds[1].invalidate_counts()
+        self.feeds[2].invalidate_counts()
+        self.feeds[1].num_unwatched()
+        self.feeds[2].num_unwatched()
+        self.feeds[3].num_unwatched()
+        self.assertEquals(self.feed_counts_calls, 2)
+        self.check_counts()
+
+    def test_incremental(self):
+        # Once we have counts, item changes should update them without
+        # running feed_counts() again
+        self.check_counts()
+        self.file_items[0].mark_item_seen()
+        self.file_items[-1].mark_item_seen()
+        self.file_items[-2].mark_item_unseen()
+        self.check_counts()
+        self.file_items[-1].expire()
+        self.check_counts()
+        path = self.make_temp_path('.avi')
+        open(path, 'wb').write('data')
+        FileItem(path, feed_id=self.feeds[2].id)
+        Item(FeedParserValues(_build_entry(u'http://example.com/new.mp4',
+            'video/x-unknown')), feed_id=self.feeds[3].id)
+        self.check_counts()
+        self.file_items[1].set_feed(self.feeds[3].id)
+        self.check_counts()
+        list(self.feeds[3].items)[0].remove()
+        self.check_counts()
+        self.assertEquals(self.feed_counts_calls, 1)
+        # mark_as_viewed() changes which items are available, so it needs
+        # to recount
+        self.feeds[3].mark_as_viewed()
+        self.check_counts()
+        self.assertEquals(self.feed_counts_calls, 2)
+
+    def test_restored_items(self):
+        # We don't know what restored items counted towards their feed, so
+        # if they change, the feed should recount
+        self.check_counts()
+        restored = self.reload_object(self.file_items[-1])
+        restored.mark_item_seen()
+        self.check_counts()
+        self.assertEquals(self.feed_counts_calls, 2)
+        # after that we know the item's state
+        restored.mark_item_unseen()
+        self.check_counts()
+        self.assertEquals(self.feed_counts_calls, 2)
+
+    def test_removed_feed(self):
+        self.feeds[0].invalidate_counts()
+        self.feeds[2].invalidate_counts()
+        self.feeds[0].remove()
+        self.assertEquals(self.feeds[2].num_unwatched(), 3)
+        self.assertEquals(self.feed_counts_calls, 1)
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,86 @@
+from miro import eventloop
+from miro import feedupdate
+from miro import signals
+from miro.test.framework import MiroTestCase
+
+class FakeFeed(signals.SignalEmitter):
+    def __init__(self, id_, url):
+        signals.SignalEmitter.__init__(self, 'update-finished', 'removed')
+        self.id = id_
+        self.url = url
+
+    def get_url(self):
+        return self.url
+
+    def get_title(self):
+        return self.url
+
+class FeedUpdateQueueTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.queue = feedupdate.FeedUpdateQueue()
+        self.updated = []
+        self.old_jitter = feedupdate.UPDATE_JITTER
+        feedupdate.UPDATE_JITTER = 0
+
+    def tearDown(self):
+        feedupdate.UPDATE_JITTER = self.old_jitter
+        MiroTestCase.tearDown(self)
+
+    def queue_update(self, feed):
+        self.queue.schedule_update(0, feed, lambda: self.updated.append(feed))
+        self.queue.timeouts[feed.id].cancel()
+        self.queue.do_update(feed, lambda: self.updated.append(feed))
+
+    def scheduled_delay(self, feed):
+        dc = self.queue.timeouts[feed.id]
+        for scheduled_time, heap_dc in eventloop._eventloop.scheduler.heap:
+            if heap_dc is dc:
+                return scheduled_time - eventloop.clock()
+        raise AssertionError("timeout not found")
+
+    def test_host_limit(self):
+        feeds = [FakeFeed(i, u'http://a.com/%d' % i) for i in xrange(5)]
+        feeds.extend([FakeFeed(5, u'http://b.com/1'),
+                FakeFeed(6, u'dtv:search'),
+                FakeFeed(7, u'http://c.com/1')])
+        for feed in feeds:
+            self.queue_update(feed)
+        # feeds[4] has to wait, since 4 other feeds from its host are
+        # updating.  feeds[7] has to wait for a free slot.
+        self.assertEquals(self.updated, feeds[:4] + feeds[5:7])
+        self.assertEquals([f for f, c, t in self.queue.update_queue],
+                [feeds[4], feeds[7]])
+        feeds[0].emit('update-finished')
+        self.queue.run_update_queue()
+        self.assertEquals(self.updated[6:], [feeds[4]])
+        stats = self.queue.get_stats()
+        self.assertEquals(stats['queued'], 1)
+        self.assertEquals(stats['updating'], 6)
+
+    def test_backoff(self):
+        feed = FakeFeed(0, u'http://a.com/1')
+        self.queue.schedule_update(100, feed, None, adaptive=True)
+        self.assertAlmostEquals(self.scheduled_delay(feed), 100, 0)
+        for i in xrange(5):
+            self.queue.record_update_result(feed, False)
+        self.queue.schedule_update(100, feed, None, adaptive=True)
+        self.assertAlmostEquals(self.scheduled_delay(feed),
+                100 * feedupdate.MAX_BACKOFF, 0)
+        # non-adaptive updates shouldn't be delayed
+        self.queue.schedule_update(100, feed, None)
+        self.assertAlmostEquals(self.scheduled_delay(feed), 100, 0)
+        self.queue.record_update_result(feed, True)
+        self.queue.schedule_update(100, feed, None, adaptive=True)
+        self.assertAlmostEquals(self.scheduled_delay(feed), 100, 0)
+
+    def test_jitter(self):
+        feedupdate.UPDATE_JITTER = 0.5
+        feeds = [FakeFeed(i, u'http://a.com/%d' % i)
+                for i in xrange(20)]
+        for feed in feeds:
+            self.queue.schedule_update(100, feed, None)
+        delays = [self.scheduled_delay(feed) for feed in feeds]
+        self.assert_(min(delays) >= 50 - 1)
+        self.assert_(max(delays) <= 150 + 1)
+        self.assertNotEquals(min(delays), max(delays))
@@ -272,6 +272,7 @@ class MiroTestCase(unittest.TestCase):
         # setup the deleted file checker
         item.setup_deleted_checker()
         item.start_deleted_checker()
+        item.setup_expire_scheduler()
         # setup movie data stuff
         self.metadata_progress_updater = FakeMetadataProgressUpdater()
         app.metadata_progress_updater = self.metadata_progress_updater
@@ -400,9 +401,9 @@ class MiroTestCase(unittest.TestCase):
     def make_temp_dir_path(self):
         return tempfile.mkdtemp(dir=self.tempdir)
 
-    def start_http_server(self):
+    def start_http_server(self, threaded=False):
         self.stop_http_server()
-        self.httpserver = testhttpserver.HTTPServer()
+        self.httpserver = testhttpserver.HTTPServer(threaded)
         self.httpserver.start()
 
     def last_http_info(self, info_name):
@@ -442,7 +443,7 @@ class MiroTestCase(unittest.TestCase):
             database.update_last_id()
 
     def clear_ddb_object_cache(self):
-        app.db._ids_loaded = set()
+        app.db._ids_loaded = {}
         app.db._object_map = {}
 
     def setup_new_database(self, path, schema_version, object_schemas):
@@ -463,9 +464,9 @@ class MiroTestCase(unittest.TestCase):
 
     def reload_object(self, obj):
         # force an object to be reloaded from the databas.
-        key = (obj.id, app.db.table_name(obj.__class__))
-        del app.db._object_map[key]
-        app.db._ids_loaded.remove(key)
+        table_name = app.db.table_name(obj.__class__)
+        del app.db._object_map[(obj.id, table_name)]
+        app.db._ids_loaded[table_name].remove(obj.id)
         return obj.__class__.get_by_id(obj.id)
 
     def handle_error(self, obj, report):
@@ -3,6 +3,7 @@ import os
 import logging
 import pycurl
 import pickle
+import time
 from cStringIO import StringIO
 
 from miro import app
@@ -14,6 +15,7 @@ from miro import httpclient
 from miro import signals
 from miro.plat import resources
 from miro.test import mock
+from miro.test import testhttpserver
 from miro.test.framework import EventLoopTest, uses_httpclient
 
 from miro.gtcache import gettext as _
@@ -105,6 +107,32 @@ class HTTPClientTest(HTTPClientTestBase):
         self.httpserver.add_header("content-encoding", "gzip")
         self.grab_url(self.httpserver.build_url('test.txt.gz'))
         self.assertEquals(self.grab_url_info['body'], self.test_response_data)
+        self.assert_('gzip' in
+                self.httpserver.last_info()['headers']['accept-encoding'])
+        gz_path = resources.path("testdata/httpserver/test.txt.gz")
+        stats = self.client.get_stats()
+        self.assertEquals(stats.downloaded, os.path.getsize(gz_path))
+        self.assertEquals(stats.decoded, len(self.test_response_data))
+
+    @uses_httpclient
+    def test_unknown_encoding(self):
+        # libcurl can't decode this, so we should retry without asking for
+        # compression
+        self.httpserver.add_header("content-encoding", "bogus")
+        self.grab_url(self.httpserver.build_url('test.txt'))
+        self.assertEquals(self.grab_url_info['body'], self.test_response_data)
+        self.assert_('accept-encoding' not in
+                self.httpserver.last_info()['headers'])
+
+    @uses_httpclient
+    def test_write_file_no_encoding(self):
+        filename = self.make_temp_path(".txt")
+        self.grab_url(self.httpserver.build_url('test.txt'),
+                write_file=filename)
+        self.assert_('accept-encoding' not in
+                self.httpserver.last_info()['headers'])
+        stats = self.client.get_stats()
+        self.assertEquals(stats.decoded, len(self.test_response_data))
 
     @uses_httpclient
     def test_unicode_url(self):
@@ -437,6 +465,80 @@ class HTTPClientTest(HTTPClientTestBase):
         self.assertEquals(self.client.get_stats().downloaded, download_size)
         self.assertEquals(self.client.get_stats().initial_size, initial_size)
 
+    @uses_httpclient
+    def test_byte_range(self):
+        filename = self.make_temp_path(".txt")
+        size = len(self.test_response_data)
+        open(filename, 'wb').write('\0' * size)
+        self.grab_url(self.httpserver.build_url('test.txt'),
+                write_file=filename, byte_range=(10, 19))
+        self.assertEquals(self.grab_url_info['status'], 206)
+        self.assertEquals(self.httpserver.last_info()['headers']['range'],
+                'bytes=10-19')
+        expected = ('\0' * 10 + self.test_response_data[10:20] +
+                    '\0' * (size - 20))
+        self.assertEquals(open(filename, 'rb').read(), expected)
+
+    @uses_httpclient
+    def test_byte_range_synced(self):
+        # stats.synced should only count data that's been synced to disk
+        old_sync_interval = httpclient.SYNC_INTERVAL
+        httpclient.SYNC_INTERVAL = 1000
+        try:
+            filename = self.make_temp_path(".txt")
+            size = len(self.test_response_data)
+            open(filename, 'wb').write('\0' * size)
+            self.httpserver.pause_after(5)
+            unsynced_stats = []
+            def cancel_after_5_bytes():
+                stats = self.client.get_stats()
+                if stats.downloaded == 5:
+                    unsynced_stats.append(stats)
+                    self.client.cancel()
+                    self.stopEventLoop(False)
+                else:
+                    eventloop.add_timeout(0.1, cancel_after_5_bytes,
+                            'cancel')
+            eventloop.add_timeout(0.1, cancel_after_5_bytes, 'cancel')
+            self.expecting_errback = True
+            self.grab_url(self.httpserver.build_url('test.txt'),
+                    write_file=filename, byte_range=(10, 19))
+            self.wait_for_libcurl_manager()
+        finally:
+            httpclient.SYNC_INTERVAL = old_sync_interval
+        self.assertEquals(unsynced_stats[0].synced, 0)
+        # canceling syncs the file
+        self.assertEquals(self.client.get_stats().synced, 5)
+        expected = ('\0' * 10 + self.test_response_data[10:15] +
+                    '\0' * (size - 15))
+        self.assertEquals(open(filename, 'rb').read(), expected)
+
+    @uses_httpclient
+    def test_byte_range_ignored(self):
+        # If the server sends the whole file, we shouldn't write anything
+        self.httpserver.disable_resume()
+        filename = self.make_temp_path(".txt")
+        open(filename, 'wb').write('\0' * 30)
+        self.expecting_errback = True
+        self.grab_url(self.httpserver.build_url('test.txt'),
+                write_file=filename, byte_range=(10, 19))
+        self.assert_(isinstance(self.grab_url_error,
+            httpclient.UnexpectedStatusCode))
+        self.assertEquals(open(filename, 'rb').read(), '\0' * 30)
+
+    @uses_httpclient
+    def test_max_recv_speed(self):
+        url = self.httpserver.build_url('linux-screen.jpg')
+        self.grab_url_error = self.grab_url_info = None
+        start = time.time()
+        self.client = httpclient.grab_url(url, self.grab_url_callback,
+                self.grab_url_errback)
+        self.client.set_max_recv_speed(20000)
+        self.runEventLoop(timeout=10)
+        self.assertEquals(len(self.grab_url_info['body']), 45572)
+        # 45572 bytes at 20000 bytes/sec should take over 2 seconds
+        self.assert_(time.time() - start > 1.5)
+
     @uses_httpclient
     def test_resume_no_file(self):
         filename = self.make_temp_path(".txt")
@@ -483,6 +585,44 @@ class HTTPClientTest(HTTPClientTestBase):
         self.wait_for_libcurl_manager()
         self.assert_(not os.path.exists(filename))
 
+    @uses_httpclient
+    def test_connection_reuse(self):
+        handlers_created = testhttpserver.MiroHTTPRequestHandler.handlers_created
+        for i in range(3):
+            self.grab_url(self.httpserver.build_url('test.txt'))
+            self.assertEquals(self.grab_url_info['body'],
+                    self.test_response_data)
+        # the write_file case does a HEAD request, then the GET
+        filename = self.make_temp_path(".txt")
+        self.grab_url(self.httpserver.build_url('test.txt'),
+                write_file=filename)
+        self.assertEquals(open(filename).read(), self.test_response_data)
+        stats = httpclient.curl_manager.connection_stats
+        self.assertEquals(stats.handles_created, 1)
+        self.assertEquals(stats.handles_reused, 4)
+        self.assertEquals(stats.transfers, 5)
+        self.assertEquals(stats.connections_reused, 4)
+        self.assertEquals(stats.connection_reuse_rate(), 0.8)
+        self.assertEquals(testhttpserver.MiroHTTPRequestHandler.handlers_created,
+                handlers_created + 1)
+
+    @uses_httpclient
+    def test_handle_pool_size(self):
+        manager = httpclient.curl_manager
+        transfers = []
+        for i in range(httpclient.HANDLE_POOL_SIZE + 2):
+            transfer = httpclient.CurlTransfer(httpclient.TransferOptions(
+                self.httpserver.build_url('test.txt')), None, None)
+            transfer.handle = manager.get_handle()
+            transfers.append(transfer)
+        for transfer in transfers:
+            manager.release_handle(transfer.handle, transfer)
+            self.assertEquals(transfer.handle, None)
+        self.assertEquals(len(manager.handle_pool),
+                httpclient.HANDLE_POOL_SIZE)
+        self.assertEquals(manager.connection_stats.handles_created,
+                httpclient.HANDLE_POOL_SIZE + 2)
+
 class HTTPAuthTest(HTTPClientTestBase):
     def setUp(self):
         HTTPClientTestBase.setUp(self)
@@ -1,7 +1,11 @@
 import os
+import time
 
+from miro import app
 from miro import download_utils
+from miro import eventloop
 from miro import httpclient
+from miro import prefs
 from miro.test.framework import (
     EventLoopTest, uses_httpclient, skip_for_platforms)
 from miro.plat import resources
@@ -32,7 +36,7 @@ class TestingDownloader(download.HTTPDownloader):
         # doesn't exist.
         pass
 
-class HTTPDownloaderTest(EventLoopTest):
+class HTTPDownloaderTestBase(EventLoopTest):
     def setUp(self):
         EventLoopTest.setUp(self)
         download.chatter = False
@@ -65,6 +69,8 @@ class HTTPDownloaderTest(EventLoopTest):
         self.wait_for_libcurl_manager()
         return len(httpclient.curl_manager.transfer_map)
 
+class HTTPDownloaderTest(HTTPDownloaderTestBase):
+
 #    Really slow test that downloads a very large file.
 #    def testHuge(self):
 #        url = ('http://archive-c01.libsyn.com/aXdueJh2m32XeGh6l3efp5qtZXiX/'
@@ -85,6 +91,17 @@ class HTTPDownloaderTest(EventLoopTest):
         self.assertEquals(self.getDownloadedData(),
                 open(self.download_path).read())
 
+    @uses_httpclient
+    def test_bandwidth_limit(self):
+        start = time.time()
+        self.downloader = TestingDownloader(self, self.download_url, "ID1")
+        self.downloader.set_bandwidth_limit(20000)
+        self.downloader.statusCallback = self.stopOnFinished
+        self.runEventLoop()
+        self.assertEquals(self.downloader.state, 'finished')
+        # 45572 bytes at 20000 bytes/sec should take over 2 seconds
+        self.assert_(time.time() - start > 1.5)
+
     @uses_httpclient
     def test_stop(self):
         # nice large download so that we have time to interrupt it
@@ -165,3 +182,284 @@ class HTTPDownloaderTest(EventLoopTest):
         self.downloader2.statusCallback = status_callback
         self.runEventLoop()
         self.assert_(not self.restarted)
+
+class SegmentsTest(EventLoopTest):
+    def test_encode_decode(self):
+        segments = [[0, 99, 10], [100, 199, 100]]
+        data = download.encode_segments(segments)
+        self.assertEquals(data, u'0-99:10,100-199:100')
+        self.assertEquals(download.decode_segments(data), segments)
+        self.assertEquals(download.encode_segments(None), None)
+        self.assertEquals(download.decode_segments(None), None)
+        self.assertEquals(download.decode_segments(u'0-99'), None)
+
+class FakeBandwidthDownloader(object):
+    def __init__(self, rate, priority=download_utils.PRIORITY_NORMAL,
+                 state=u'downloading'):
+        self.rate = rate
+        self.priority = priority
+        self.state = state
+        self.bandwidth_limit = None
+
+    def get_rate(self):
+        return self.rate
+
+    def set_bandwidth_limit(self, limit):
+        self.bandwidth_limit = limit
+
+class BandwidthSchedulerTest(EventLoopTest):
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        download._downloads = {}
+        self.scheduler = download.BandwidthScheduler()
+        app.config.set(prefs.LIMIT_DOWNSTREAM, True)
+        app.config.set(prefs.DOWNSTREAM_LIMIT_IN_KBS, 100)
+
+    def tearDown(self):
+        download._downloads = {}
+        EventLoopTest.tearDown(self)
+
+    def test_allocate_by_weight(self):
+        self.assertEquals(download.allocate_bandwidth(100000,
+            [(4, 100000), (1, 100000)]), [80000, 20000])
+
+    def test_allocate_unused_share(self):
+        # The slow download only needs min_rate, the rest goes to the
+        # fast one.
+        self.assertEquals(download.allocate_bandwidth(100000,
+            [(1, 100000), (4, 1000)]), [95904, 4096])
+        # Everyone is satisfied, the leftovers get split by weight
+        self.assertEquals(download.allocate_bandwidth(100000,
+            [(1, 1000), (1, 1000)]), [50000, 50000])
+        self.assertEquals(download.allocate_bandwidth(100000, []), [])
+
+    def test_allocate_never_unlimited(self):
+        self.assertEquals(download.allocate_bandwidth(0, [(1, 1000)]), [1])
+
+    def test_rebalance(self):
+        normal = FakeBandwidthDownloader(200000)
+        background = FakeBandwidthDownloader(200000,
+                download_utils.PRIORITY_BACKGROUND)
+        paused = FakeBandwidthDownloader(200000, state=u'paused')
+        download._downloads = {'1': normal, '2': background, '3': paused}
+        self.scheduler.rebalance(periodic=False)
+        self.assertEquals(normal.bandwidth_limit, 81920)
+        self.assertEquals(background.bandwidth_limit, 20480)
+        self.assertEquals(paused.bandwidth_limit, None)
+        # pausing a download clears its limit and gives the bandwidth to the
+        # others
+        normal.state = u'paused'
+        self.scheduler.rebalance(periodic=False)
+        self.assertEquals(normal.bandwidth_limit, None)
+        self.assertEquals(background.bandwidth_limit, 102400)
+        # turning off the limit clears all limits
+        normal.state = u'downloading'
+        self.scheduler.rebalance(periodic=False)
+        app.config.set(prefs.LIMIT_DOWNSTREAM, False)
+        self.scheduler.rebalance(periodic=False)
+        self.assertEquals(normal.bandwidth_limit, None)
+        self.assertEquals(background.bandwidth_limit, None)
+
+    def test_default_apply_limit(self):
+        # downloaders that don't override _apply_bandwidth_limit() can still
+        # be given a limit
+        downloader = download.BGDownloader(u'http://example.com/a.mp4', 'ID1')
+        downloader.set_bandwidth_limit(1024)
+        self.assertEquals(downloader.bandwidth_limit, 1024)
+
+class FakeStateUpdateAlert(object):
+    def __init__(self, status):
+        self.status = status
+
+class FakeLibtorrent(object):
+    # stands in for the libtorrent module in TorrentSessionTest
+    state_update_alert = FakeStateUpdateAlert
+
+class FakeTorrentHandle(object):
+    def __init__(self, i):
+        self._info_hash = '%040x' % i
+
+    def info_hash(self):
+        return self._info_hash
+
+class FakeTorrentStatus(object):
+    def __init__(self, handle):
+        self.handle = handle
+
+class FakeTorrentDownloader(object):
+    def __init__(self, i):
+        self.torrent = FakeTorrentHandle(i)
+        self.statuses = []
+
+    def update_status(self, status=None):
+        self.statuses.append(status)
+
+class FakeLibtorrentSession(object):
+    def __init__(self):
+        self.alerts = []
+        self.post_count = 0
+
+    def post_torrent_updates(self):
+        self.post_count += 1
+
+    def pop_alerts(self):
+        alerts = self.alerts
+        self.alerts = []
+        return alerts
+
+class TorrentSessionTest(EventLoopTest):
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        self.old_lt = download.lt
+        download.lt = FakeLibtorrent
+        self.session = download.TorrentSession()
+        self.session.session = FakeLibtorrentSession()
+        self.session.use_state_updates = True
+        self.downloaders = [FakeTorrentDownloader(i) for i in xrange(3)]
+        for downloader in self.downloaders:
+            self.session.add_torrent(downloader)
+
+    def tearDown(self):
+        download.lt = self.old_lt
+        EventLoopTest.tearDown(self)
+
+    def send_state_update(self, *downloaders):
+        statuses = [FakeTorrentStatus(d.torrent) for d in downloaders]
+        self.session.session.alerts = [object(),
+                FakeStateUpdateAlert(statuses)]
+        return statuses
+
+    def test_state_updates(self):
+        # new torrents get polled on the first update, then we ask for a
+        # state update
+        self.session.update_torrents()
+        self.assertEquals([d.statuses for d in self.downloaders],
+                [[None], [None], [None]])
+        self.assertEquals(self.session.session.post_count, 1)
+        # after that, only the torrents in the state update get updated
+        status, = self.send_state_update(self.downloaders[1])
+        self.session.update_torrents()
+        self.assertEquals([d.statuses for d in self.downloaders],
+                [[None], [None, status], [None]])
+        self.assertEquals(self.session.session.post_count, 2)
+        # no changes, no updates
+        self.session.update_torrents()
+        self.assertEquals([len(d.statuses) for d in self.downloaders],
+                [1, 2, 1])
+
+    def test_removed_torrents(self):
+        # torrents removed before the first update don't get polled, and
+        # statuses for removed torrents are ignored
+        self.session.remove_torrent(self.downloaders[0])
+        self.session.update_torrents()
+        self.assertEquals(self.downloaders[0].statuses, [])
+        self.send_state_update(self.downloaders[0], self.downloaders[2])
+        self.session.remove_torrent(self.downloaders[2])
+        self.session.update_torrents()
+        self.assertEquals([len(d.statuses) for d in self.downloaders],
+                [0, 1, 1])
+
+class SegmentedHTTPDownloaderTest(HTTPDownloaderTestBase):
+    def setUp(self):
+        HTTPDownloaderTestBase.setUp(self)
+        # use a threaded server, since we make several connections at once
+        self.start_http_server(threaded=True)
+        self.httpserver.add_header('Accept-Ranges', 'bytes')
+        self.download_url = unicode(
+                self.httpserver.build_url('screen-redirect'))
+        app.config.set(prefs.HTTP_SEGMENTED_DOWNLOADS, True)
+        app.config.set(prefs.HTTP_DOWNLOAD_SEGMENTS, 4)
+        self.old_min_segment_size = download.MIN_SEGMENT_SIZE
+        download.MIN_SEGMENT_SIZE = 10000
+        self.saw_segments = False
+
+    def tearDown(self):
+        download.MIN_SEGMENT_SIZE = self.old_min_segment_size
+        HTTPDownloaderTestBase.tearDown(self)
+
+    def check_segments(self):
+        if self.downloader.segments is not None:
+            self.saw_segments = True
+        self.stopOnFinished()
+
+    @uses_httpclient
+    def test_download(self):
+        self.downloader = TestingDownloader(self, self.download_url, "ID1")
+        self.downloader.statusCallback = self.check_segments
+        self.runEventLoop()
+        self.assert_(self.saw_segments)
+        self.assertEquals(self.downloader.state, 'finished')
+        self.assertEquals(self.downloader.currentSize, self.download_size)
+        self.assertEquals(self.downloader.totalSize, self.download_size)
+        self.assertEquals(self.getDownloadedData(),
+                open(self.download_path, 'rb').read())
+        self.assertEquals(self.downloader.get_status()['segments'], None)
+
+    @uses_httpclient
+    def test_no_accept_ranges(self):
+        self.httpserver.httpserver.headers_to_send = []
+        self.downloader = TestingDownloader(self, self.download_url, "ID1")
+        self.downloader.statusCallback = self.check_segments
+        self.runEventLoop()
+        self.assert_(not self.saw_segments)
+        self.assertEquals(self.getDownloadedData(),
+                open(self.download_path, 'rb').read())
+
+    @uses_httpclient
+    def test_ranges_ignored(self):
+        # The server says it accepts ranges, but really doesn't.  We should
+        # fall back to a single connection.
+        self.httpserver.disable_resume()
+        self.downloader = TestingDownloader(self, self.download_url, "ID1")
+        self.downloader.statusCallback = self.check_segments
+        self.runEventLoop()
+        self.assert_(self.downloader.segments_failed)
+        self.assertEquals(self.downloader.state, 'finished')
+        self.assertEquals(self.getDownloadedData(),
+                open(self.download_path, 'rb').read())
+
+    @uses_httpclient
+    def test_restore(self):
+        self.downloader = TestingDownloader(self, self.download_url, "ID1")
+        def pause_in_middle():
+            if (self.downloader.state == 'downloading' and
+                    self.downloader.currentSize == 20000):
+                self.downloader.pause()
+                wait_for_progress()
+        def wait_for_progress():
+            # the segments store the rest of their progress once httpclient
+            # has synced the file
+            if self.downloader.currentSize == 20000:
+                self.stopEventLoop(False)
+            else:
+                eventloop.add_timeout(0.01, wait_for_progress,
+                        'wait for progress')
+        self.downloader.statusCallback = pause_in_middle
+        # each of the 4 segments gets 5000 bytes
+        self.httpserver.pause_after(5000)
+        self.runEventLoop()
+        self.assertEquals(self.downloader.state, 'paused')
+        self.assertEquals(self.countConnections(), 0)
+        restore = self.downloader.lastStatus.copy()
+        segments = download.decode_segments(restore['segments'])
+        self.assertEquals(len(segments), 4)
+        for start, end, downloaded in segments:
+            self.assertEquals(downloaded, 5000)
+        restore['state'] = 'downloading'
+        download._downloads = {}
+        self.httpserver.pause_after(-1)
+        self.downloader2 = TestingDownloader(self, restore=restore)
+        self.restarted = False
+        def start_new_download_intercept():
+            self.restarted = True
+            self.stopEventLoop(False)
+        def status_callback():
+            if self.downloader2.state == 'finished':
+                self.stopEventLoop(False)
+        self.downloader2.start_new_download = start_new_download_intercept
+        self.downloader2.statusCallback = status_callback
+        self.runEventLoop()
+        self.assert_(not self.restarted)
+        self.assertEquals(self.downloader2.currentSize, self.download_size)
+        self.assertEquals(open(self.downloader2.filename, 'rb').read(),
+                open(self.download_path, 'rb').read())
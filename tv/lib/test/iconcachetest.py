@@ -1,9 +1,14 @@
+import os
+
+from miro import app
 from miro import database
+from miro import httpclient
 
 from miro import iconcache
 from miro import item
 from miro import feed
 from miro import guide
+from miro import prefs
 
 from miro.test.framework import EventLoopTest, uses_httpclient
 
@@ -52,3 +57,132 @@ class IconCacheTest(EventLoopTest):
                 iconcache.IconCache.get_by_id, item_icon_cache_id)
         self.assertRaises(database.ObjectNotFoundError,
                 iconcache.IconCache.get_by_id, guide_icon_cache_id)
+
+class IconCacheSharingTest(EventLoopTest):
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        self.cachedir = os.path.join(self.tempdir, 'icon-cache')
+        app.config.set(prefs.ICON_CACHE_DIRECTORY, self.cachedir)
+        self.grab_url_calls = []
+        self.old_grab_url = httpclient.grab_url
+        httpclient.grab_url = self.fake_grab_url
+        self.old_updater = iconcache.icon_cache_updater
+        iconcache.icon_cache_updater = iconcache.IconCacheUpdater()
+        self.feed = feed.Feed(u'dtv:manualFeed')
+        self.items = [self.make_item(u'http://example.com/icon.png')
+                for i in xrange(3)]
+        self.runPendingIdles()
+
+    def tearDown(self):
+        self.runPendingIdles()
+        httpclient.grab_url = self.old_grab_url
+        iconcache.icon_cache_updater = self.old_updater
+        iconcache._downloads_in_progress.clear()
+        EventLoopTest.tearDown(self)
+
+    def fake_grab_url(self, url, callback, errback, write_file=None):
+        self.grab_url_calls.append((url, callback, errback, write_file))
+
+    def make_item(self, thumbnail_url):
+        obj = item.Item(item.FeedParserValues({}), feed_id=self.feed.id)
+        obj.thumbnail_url = thumbnail_url
+        obj.signal_change()
+        return obj
+
+    def finish_download(self, index, data):
+        url, callback, errback, write_file = self.grab_url_calls[index]
+        f = open(write_file, 'wb')
+        f.write(data)
+        f.close()
+        callback({'status': 200, 'filename': 'icon.png'})
+        self.runPendingIdles()
+
+    def test_coalesce_downloads(self):
+        self.assertEquals(len(self.grab_url_calls), 1)
+        self.finish_download(0, 'icon data')
+        filenames = set(i.icon_cache.filename for i in self.items)
+        self.assertEquals(len(filenames), 1)
+        filename = filenames.pop()
+        self.assertEquals(open(filename, 'rb').read(), 'icon data')
+        # new items with the same URL should share the file without
+        # downloading it again
+        new_item = self.make_item(u'http://example.com/icon.png')
+        self.runPendingIdles()
+        self.assertEquals(len(self.grab_url_calls), 1)
+        self.assertEquals(new_item.icon_cache.filename, filename)
+
+    def test_shared_contents(self):
+        self.finish_download(0, 'icon data')
+        other_item = self.make_item(u'http://example.com/icon2.png')
+        self.runPendingIdles()
+        self.assertEquals(len(self.grab_url_calls), 2)
+        self.finish_download(1, 'icon data')
+        self.assertEquals(other_item.icon_cache.filename,
+                self.items[0].icon_cache.filename)
+        self.assertEquals(len(os.listdir(self.cachedir)), 1)
+
+    def test_reference_counting(self):
+        self.finish_download(0, 'icon data')
+        filename = self.items[0].icon_cache.filename
+        for obj in self.items[:-1]:
+            obj.remove()
+            self.assert_(os.path.exists(filename))
+        self.items[-1].remove()
+        self.assert_(not os.path.exists(filename))
+
+    def test_reset(self):
+        self.finish_download(0, 'icon data')
+        filename = self.items[0].icon_cache.filename
+        for obj in self.items[:-1]:
+            obj.icon_cache.reset()
+            self.assertEquals(obj.icon_cache.filename, None)
+            self.assert_(os.path.exists(filename))
+        self.items[-1].icon_cache.reset()
+        self.assert_(not os.path.exists(filename))
+
+    def test_bulk_remove(self):
+        self.finish_download(0, 'icon data')
+        filename = self.items[0].icon_cache.filename
+        app.bulk_sql_manager.start()
+        try:
+            for obj in self.items:
+                obj.remove()
+            # the rows aren't deleted yet, so we can't release the file
+            self.assert_(os.path.exists(filename))
+        finally:
+            app.bulk_sql_manager.finish()
+        self.assert_(not os.path.exists(filename))
+
+    def test_remove_feed(self):
+        # Feed.remove() removes its items inside a BulkSQLManager region
+        self.finish_download(0, 'icon data')
+        filename = self.items[0].icon_cache.filename
+        self.feed.remove()
+        self.runPendingIdles()
+        self.assert_(not os.path.exists(filename))
+
+    def test_download_error(self):
+        url, callback, errback, write_file = self.grab_url_calls[0]
+        errback(ValueError())
+        self.runPendingIdles()
+        for obj in self.items:
+            self.assertEquals(obj.icon_cache.filename, None)
+            self.assert_(not obj.icon_cache.updating)
+        self.assertEquals(os.listdir(self.cachedir), [])
+
+    def test_collapse_duplicate_files(self):
+        self.finish_download(0, 'icon data')
+        # simulate files from older versions that stored a separate file
+        # for each object
+        os.makedirs(os.path.join(self.cachedir, 'old'))
+        for i, obj in enumerate(self.items):
+            path = os.path.join(self.cachedir, 'old', 'icon%d.png' % i)
+            open(path, 'wb').write('icon data')
+            obj.icon_cache.filename = path
+            obj.icon_cache.signal_change()
+        for dummy in iconcache.collapse_duplicate_files():
+            pass
+        filenames = set(i.icon_cache.filename for i in self.items)
+        self.assertEquals(len(filenames), 1)
+        self.assertEquals(len(os.listdir(os.path.join(self.cachedir,
+            'old'))), 1)
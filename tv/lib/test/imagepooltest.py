@@ -0,0 +1,63 @@
+from miro import messages
+from miro import util
+from miro.test import mock
+from miro.test.framework import MiroTestCase
+from miro.frontends.widgets import imagepool
+from miro.frontends.widgets import itemtrack
+
+class FakePool(util.Cache):
+    def __init__(self):
+        util.Cache.__init__(self, 100)
+        self.created = []
+
+    def create_new_value(self, key):
+        self.created.append(key)
+        return object()
+
+class FakeItemInfo(object):
+    def __init__(self, id_, thumbnail):
+        self.id = id_
+        self.thumbnail = thumbnail
+
+class ImagePoolTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.old_pools = (imagepool._imagepool,
+                imagepool._image_surface_pool)
+        imagepool._imagepool = FakePool()
+        imagepool._image_surface_pool = FakePool()
+
+    def tearDown(self):
+        imagepool._imagepool, imagepool._image_surface_pool = self.old_pools
+        MiroTestCase.tearDown(self)
+
+    def test_invalidate(self):
+        image = imagepool.get('/foo.png')
+        small_image = imagepool.get('/foo.png', (10, 10))
+        surface = imagepool.get_surface('/foo.png')
+        other_image = imagepool.get('/bar.png')
+        self.assert_(imagepool.get('/foo.png') is image)
+        imagepool.invalidate('/foo.png')
+        self.assert_(imagepool.get('/foo.png') is not image)
+        self.assert_(imagepool.get('/foo.png', (10, 10)) is not small_image)
+        self.assert_(imagepool.get_surface('/foo.png') is not surface)
+        self.assert_(imagepool.get('/bar.png') is other_image)
+
+    def test_thumbnail_changed(self):
+        # When an item starts using a different thumbnail,
+        # ItemListTracker should drop any stale images for it.
+        tracker = itemtrack.ItemListTracker(u'feed', 1)
+        tracker.item_list = mock.Mock()
+        tracker.search_filter = mock.Mock()
+        tracker.search_filter.filter_changes.return_value = ([], [], [])
+        tracker.add_initial_items([FakeItemInfo(1, '/old.png'),
+            FakeItemInfo(2, '/other.png')])
+        old_image = imagepool.get('/old.png')
+        new_image = imagepool.get('/new.png')
+        other_image = imagepool.get('/other.png')
+        changed = [FakeItemInfo(1, '/new.png'), FakeItemInfo(2, '/other.png')]
+        tracker.on_items_changed(messages.ItemsChanged(u'feed', 1, [],
+            changed, []))
+        self.assert_(imagepool.get('/new.png') is not new_image)
+        self.assert_(imagepool.get('/old.png') is old_image)
+        self.assert_(imagepool.get('/other.png') is other_image)
@@ -4,6 +4,8 @@ import shutil
 import tempfile
 
 from miro import app
+from miro import config
+from miro import item
 from miro import prefs
 from miro.feed import Feed
 from miro.item import Item, FileItem, FeedParserValues
@@ -141,6 +143,89 @@ class ExpiredViewTest(MiroTestCase):
 
         self.assertEquals(list(f3.expiring_items()), [i5])
 
+class ExpireSchedulerTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self._expire_after_x_days_value = app.config.get(
+                prefs.EXPIRE_AFTER_X_DAYS)
+        app.config.set(prefs.EXPIRE_AFTER_X_DAYS, 6)
+        app.backend_config_watcher = config.ConfigWatcher(
+                lambda func, *args: func(*args))
+        self.feed = Feed(u'http://example.com/1')
+        self.feed.set_expiration(u'feed', 24)
+        self.items = []
+        for i in xrange(3):
+            self.items.append(Item(fp_values_for_url(
+                u'http://example.com/1/item%d' % i), feed_id=self.feed.id))
+        self.set_watched_time(self.items[0], timedelta(days=3))
+        self.set_watched_time(self.items[1], timedelta(hours=12))
+        self.scheduler = item._expire_scheduler
+        self.scheduler.start()
+
+    def tearDown(self):
+        self.scheduler.stop()
+        app.backend_config_watcher = None
+        app.config.set(prefs.EXPIRE_AFTER_X_DAYS,
+                self._expire_after_x_days_value)
+        MiroTestCase.tearDown(self)
+
+    def set_watched_time(self, obj, ago):
+        obj.watchedTime = datetime.now() - ago
+        obj.signal_change()
+
+    def check_expired(self, *expired_items):
+        self.scheduler.expire_items()
+        for obj in self.items:
+            self.assertEquals(obj.expired, obj in expired_items)
+
+    def test_expire(self):
+        self.check_expired(self.items[0])
+        # we should wake up when items[1] is ready to expire
+        self.assertEquals(self.scheduler.timeout_time,
+                self.items[1].watchedTime + timedelta(hours=24))
+
+    def test_item_changed(self):
+        self.set_watched_time(self.items[2], timedelta(days=2))
+        self.check_expired(self.items[0], self.items[2])
+
+    def test_keep(self):
+        self.items[0].save()
+        self.check_expired()
+
+    def test_unwatched(self):
+        self.items[0].mark_item_unseen()
+        self.items[0].watchedTime = None
+        self.items[0].signal_change()
+        self.check_expired()
+
+    def test_feed_expiration_changed(self):
+        self.feed.set_expiration(u'never', 0)
+        self.check_expired()
+        self.assertEquals(self.scheduler.timeout, None)
+        self.feed.set_expiration(u'feed', 6)
+        self.check_expired(self.items[0], self.items[1])
+
+    def test_no_feed_id(self):
+        # items without a feed_id, like the children of container items,
+        # don't expire
+        child = Item(fp_values_for_url(u'http://example.com/1/child'),
+                parent_id=self.items[2].id)
+        self.items.append(child)
+        self.set_watched_time(child, timedelta(days=3))
+        self.check_expired(self.items[0])
+        self.scheduler.schedule_all()
+        self.check_expired(self.items[0])
+        # items without a feed or a parent shouldn't cause errors
+        child.parent_id = None
+        self.scheduler.item_changed(child)
+        self.check_expired(self.items[0])
+
+    def test_config_change(self):
+        self.feed.set_expiration(u'system', 0)
+        self.check_expired()
+        app.config.set(prefs.EXPIRE_AFTER_X_DAYS, 1)
+        self.check_expired(self.items[0])
+
 class ItemRatingTest(MiroTestCase):
     def test_get_auto_rating(self):
         feed = Feed(u'http://example.com/1')
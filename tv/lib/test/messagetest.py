@@ -1,6 +1,8 @@
+import copy
 import logging
 import cPickle
 import functools
+import threading
 
 from miro import app
 from miro import prefs
@@ -12,10 +14,12 @@ from miro.playlist import SavedPlaylist
 from miro.folder import PlaylistFolder, ChannelFolder
 from miro.singleclick import _build_entry
 from miro.tabs import TabOrder
+from miro import iteminfocache
 from miro import itemsource
 from miro import messages
 from miro import messagehandler
 from miro import metadataprogress
+from miro import search
 
 from miro.test import mock
 from miro.test.framework import MiroTestCase, EventLoopTest, uses_httpclient
@@ -407,6 +411,8 @@ class FeedTrackTest(TrackerTest):
 
 
 class FeedItemTrackTest(TrackerTest):
+    send_patches = False
+
     def setUp(self):
         TrackerTest.setUp(self)
         self.items = []
@@ -414,7 +420,8 @@ class FeedItemTrackTest(TrackerTest):
         self.make_item(u'http://example.com/', u'my first item')
         self.make_item(u'http://example.com/2', u'my second item')
         self.runUrgentCalls()
-        messages.TrackItems('feed', self.feed.id).send_to_backend()
+        messages.TrackItems('feed', self.feed.id,
+                send_patches=self.send_patches).send_to_backend()
         self.runUrgentCalls()
 
     def make_item(self, url, title=u'default item title'):
@@ -498,6 +505,74 @@ class FeedItemTrackTest(TrackerTest):
         self.runUrgentCalls()
         self.assertEquals(len(self.test_handler.messages), 1)
 
+class FeedItemPatchTrackTest(FeedItemTrackTest):
+    # run the FeedItemTrackTest tests, but with the backend sending
+    # ItemInfoPatches for changed items
+    send_patches = True
+
+    def check_changed_message(self, index, added=None, changed=None,
+                              removed=None, **kwargs):
+        # apply the patches in the message the same way the frontend would,
+        # then check the results like a normal message
+        message = self.test_handler.messages[index]
+        current_infos = dict((i.id, i)
+                for i in self.test_handler.messages[0].items)
+        for patch in message.patches:
+            message.changed.append(patch.apply(current_infos[patch.id]))
+        message.patches = []
+        FeedItemTrackTest.check_changed_message(self, index, added, changed,
+                removed, **kwargs)
+
+    def test_patch_contents(self):
+        self.items[0].set_title(u'new name')
+        self.runUrgentCalls()
+        message = self.test_handler.messages[1]
+        self.assertEquals(message.changed, [])
+        self.assertEquals(len(message.patches), 1)
+        patch = message.patches[0]
+        self.assertEquals(patch.id, self.items[0].id)
+        self.assertEquals(patch.changes['name'], u'new name')
+        # attributes that didn't change shouldn't be sent
+        self.assert_('description' not in patch.changes)
+        self.assert_('file_url' not in patch.changes)
+
+    def test_no_change(self):
+        # signal_change() without any changes to the info shouldn't send
+        # anything
+        self.items[0].signal_change()
+        self.runUrgentCalls()
+        self.assertEquals(len(self.test_handler.messages), 1)
+
+class ItemInfoPatchTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.feed = Feed(u'dtv:manualFeed')
+        entry = _build_entry(u'http://example.com/', 'video/x-unknown')
+        self.item = Item(FeedParserValues(entry), feed_id=self.feed.id)
+
+    def make_info(self):
+        return itemsource.DatabaseItemSource._item_info_for(self.item)
+
+    def test_calc_and_apply(self):
+        old_info = self.make_info()
+        old_file_url = old_info.file_url
+        self.item.set_title(u'new title')
+        new_info = self.make_info()
+        new_info.extra_value = 1
+        del new_info.__dict__['file_url']
+        patch = messages.ItemInfoPatch.calc(old_info, new_info)
+        self.assertEquals(patch.removed, ['file_url'])
+        self.assertEquals(patch.changes['extra_value'], 1)
+        patched = patch.apply(old_info)
+        self.assertEquals(patched.__dict__, new_info.__dict__)
+        # apply() shouldn't change the old info
+        self.assertNotEquals(old_info.name, u'new title')
+        self.assertEquals(old_info.file_url, old_file_url)
+
+    def test_calc_no_change(self):
+        self.assertEquals(messages.ItemInfoPatch.calc(self.make_info(),
+            self.make_info()), None)
+
 class PlaylistItemTrackTest(TrackerTest):
     def setUp(self):
         TrackerTest.setUp(self)
@@ -606,6 +681,136 @@ class ItemInfoCacheTest(FeedItemTrackTest):
         app.item_info_cache.save()
         self.setup_new_item_info_cache()
 
+class PickleItemInfoCacheTest(ItemInfoCacheTest):
+    # Run the ItemInfoCacheTest tests using the old pickle format
+    def setUp(self):
+        self.old_codec_class = iteminfocache.ItemInfoCache.codec_class
+        iteminfocache.ItemInfoCache.codec_class = \
+                iteminfocache.PickleInfoCodec
+        ItemInfoCacheTest.setUp(self)
+
+    def tearDown(self):
+        iteminfocache.ItemInfoCache.codec_class = self.old_codec_class
+        ItemInfoCacheTest.tearDown(self)
+
+class PackedInfoCodecTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.codec = iteminfocache.PackedInfoCodec()
+        self.feed = Feed(u'dtv:manualFeed')
+        entry = _build_entry(u'http://example.com/', 'video/x-unknown',
+                {'title': u'my item', 'description': u'<b>bold</b> text'})
+        self.item = Item(FeedParserValues(entry), feed_id=self.feed.id)
+        self.info = itemsource.DatabaseItemSource._item_info_for(self.item)
+
+    def round_trip(self, info, interned=None):
+        if interned is None:
+            interned = {}
+        return self.codec.blob_to_info(self.codec.info_to_blob(info),
+                self.codec.stats_to_blob(info), interned)
+
+    def check_round_trip(self, info):
+        loaded = self.round_trip(info)
+        self.assertEquals(loaded.description, info.description)
+        loaded.decode_description()
+        self.assertEquals(loaded.__dict__, info.__dict__)
+        return loaded
+
+    def test_round_trip(self):
+        self.check_round_trip(self.info)
+
+    def test_description(self):
+        # The description isn't decoded until it's needed
+        loaded = self.round_trip(self.info)
+        self.assert_('description' not in loaded.__dict__)
+        self.assert_('description_stripped' not in loaded.__dict__)
+        self.assertEquals(loaded.description_stripped,
+                self.info.description_stripped)
+        self.assertEquals(loaded.description, self.info.description)
+        self.assert_('_description_data' not in loaded.__dict__)
+        self.assertEquals(loaded.__dict__, self.info.__dict__)
+
+    def test_description_not_decoded(self):
+        # saving and pickling infos that haven't decoded their description
+        # should still work
+        loaded = self.round_trip(self.info)
+        reloaded = self.round_trip(loaded)
+        self.assert_('_description_data' in loaded.__dict__)
+        self.assertEquals(reloaded.description, self.info.description)
+        unpickled = cPickle.loads(cPickle.dumps(self.round_trip(self.info)))
+        self.assertEquals(unpickled.description, self.info.description)
+        self.assertEquals(unpickled.description_stripped,
+                self.info.description_stripped)
+        copied = copy.copy(self.round_trip(self.info))
+        self.assertEquals(copied.description_stripped,
+                self.info.description_stripped)
+        self.assertRaises(AttributeError, getattr, loaded, 'foo')
+
+    def test_description_threads(self):
+        loaded = self.round_trip(self.info)
+        results = []
+        def get_description():
+            results.append((loaded.description,
+                loaded.description_stripped))
+        threads = [threading.Thread(target=get_description)
+                for i in xrange(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(results, [(self.info.description,
+            self.info.description_stripped)] * 10)
+
+    def test_stats(self):
+        self.info.download_info = messages.PendingDownloadInfo()
+        self.info.down_rate = 1234
+        self.info.display_rate = u'1.2 KB/s'
+        stats_blob = self.codec.stats_to_blob(self.info)
+        loaded = self.codec.blob_to_info(self.codec.info_to_blob(self.info),
+                stats_blob, {})
+        self.assertEquals(loaded.download_info.__dict__,
+                self.info.download_info.__dict__)
+        self.assertEquals(loaded.down_rate, 1234)
+        self.assertEquals(loaded.display_rate, u'1.2 KB/s')
+        self.assert_(len(stats_blob) <
+                len(self.codec.info_to_blob(self.info)))
+
+    def test_special_values(self):
+        self.info.download_info = messages.PendingDownloadInfo()
+        self.info.children = [self.round_trip(self.info)]
+        # attributes that aren't in FIELDS should also be stored, even if
+        # marshal can't handle them
+        self.info.connections = 5
+        self.info.weird_value = set([1, 2])
+        self.info.display_rate = FakeUnicode(u'5 KB/s')
+        loaded = self.round_trip(self.info)
+        self.assertEquals(loaded.download_info.__dict__,
+                self.info.download_info.__dict__)
+        self.assertEquals(loaded.children[0].id, self.info.id)
+        self.assertEquals(loaded.connections, 5)
+        self.assertEquals(loaded.weird_value, set([1, 2]))
+        self.assertEquals(loaded.display_rate, u'5 KB/s')
+        self.assertEquals(loaded.release_date, self.info.release_date)
+        self.assertEquals(loaded.date_added, self.info.date_added)
+
+    def test_non_unicode_description(self):
+        self.info.description = None
+        self.info.description_stripped = (u'', [])
+        self.check_round_trip(self.info)
+        self.info.description = FakeUnicode(u'description')
+        self.info.description_stripped = (FakeUnicode(u'description'), [])
+        self.check_round_trip(self.info)
+
+    def test_interned(self):
+        interned = {}
+        info1 = self.round_trip(self.info, interned)
+        info2 = self.round_trip(self.info, interned)
+        self.assert_(info1.feed_name is info2.feed_name)
+
+class FakeUnicode(unicode):
+    # marshal can't handle unicode subclasses
+    pass
+
 class ItemInfoCacheErrorTest(MiroTestCase):
     # Test errors when loading the Item info cache
     def setUp(self):
@@ -641,9 +846,11 @@ class ItemInfoCacheErrorTest(MiroTestCase):
         app.db.cursor.execute("SELECT COUNT(*) FROM item_info_cache")
         self.assertEquals(app.db.cursor.fetchone()[0], len(self.items))
         for item in self.items:
-            app.db.cursor.execute("SELECT pickle FROM item_info_cache "
-                    "WHERE id=%s" % item.id)
-            db_info = cPickle.loads(str(app.db.cursor.fetchone()[0]))
+            app.db.cursor.execute("SELECT pickle, stats "
+                    "FROM item_info_cache WHERE id=%s" % item.id)
+            db_info = app.item_info_cache._blob_to_info(
+                    *app.db.cursor.fetchone())
+            db_info.decode_description()
             real_info = itemsource.DatabaseItemSource._item_info_for(item)
             self.assertEquals(db_info.__dict__, real_info.__dict__)
 
@@ -706,6 +913,67 @@ class ItemInfoCacheErrorTest(MiroTestCase):
         app.db.cursor.execute("SELECT COUNT(*) FROM item_info_cache")
         self.assertEquals(app.db.cursor.fetchone()[0], 0)
 
+    def test_stats_update(self):
+        app.db.finish_transaction()
+        app.item_info_cache.save()
+        item = self.items[0]
+        old_info = app.item_info_cache.id_to_info[item.id]
+        # pretend a download made progress, which only changes the stats
+        new_info = messages.ItemInfo.__new__(messages.ItemInfo)
+        new_info.__dict__ = old_info.__dict__.copy()
+        new_info.display_rate = u'5 KB/s'
+        old_item_info_for = \
+                itemsource.DatabaseItemSource.__dict__['_item_info_for']
+        itemsource.DatabaseItemSource._item_info_for = staticmethod(
+                lambda item: new_info)
+        try:
+            item.signal_change()
+        finally:
+            itemsource.DatabaseItemSource._item_info_for = old_item_info_for
+        self.assert_(item.id in app.item_info_cache._stats_changed)
+        self.assert_(item.id not in app.item_info_cache._infos_changed)
+        app.db.finish_transaction()
+        app.item_info_cache.save()
+        self.setup_new_item_info_cache()
+        cache_info = self.get_info_from_item_info_cache(item.id)
+        self.assertEquals(cache_info.display_rate, u'5 KB/s')
+        # other changes rewrite the whole row
+        item.title = u'new title'
+        item.signal_change()
+        self.assert_(item.id in app.item_info_cache._infos_changed)
+        self.assert_(item.id not in app.item_info_cache._stats_changed)
+
+    def test_codec_change(self):
+        app.db.finish_transaction()
+        app.item_info_cache.save()
+        # Changing the codec changes version(), so we should throw away the
+        # data stored with the old one
+        old_codec_class = iteminfocache.ItemInfoCache.codec_class
+        iteminfocache.ItemInfoCache.codec_class = \
+                iteminfocache.PickleInfoCodec
+        try:
+            self.setup_new_item_info_cache()
+        finally:
+            iteminfocache.ItemInfoCache.codec_class = old_codec_class
+        app.db.cursor.execute("SELECT COUNT(*) FROM item_info_cache")
+        self.assertEquals(app.db.cursor.fetchone()[0], 0)
+
+    def test_search_terms(self):
+        # search terms are stored in the cache, so we don't need to
+        # calculate them when we load it
+        app.db.finish_transaction()
+        app.item_info_cache.save()
+        self.setup_new_item_info_cache()
+        for item in self.items:
+            real_info = itemsource.DatabaseItemSource._item_info_for(item)
+            cache_info = self.get_info_from_item_info_cache(item.id)
+            self.assertEquals(cache_info.search_terms,
+                    search.calc_search_terms(real_info))
+        self.items[0].title = u'new title'
+        self.items[0].signal_change()
+        cache_info = self.get_info_from_item_info_cache(self.items[0].id)
+        self.assert_(u'new' in cache_info.search_terms)
+
 class MetadataProgressUpdaterTest(EventLoopTest):
     def setUp(self):
         EventLoopTest.setUp(self)
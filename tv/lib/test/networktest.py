@@ -338,6 +338,70 @@ class NetworkBufferTest(MiroTestCase):
         self.assertEquals(self.buffer.getValue(), "ONETWOTHREE")
         # check to make sure the value doesn't change as a result
         self.assertEquals(self.buffer.getValue(), "ONETWOTHREE")
+        self.buffer.read(4)
+        self.assertEquals(self.buffer.getValue(), "WOTHREE")
+        self.assertEquals(self.buffer.read(), "WOTHREE")
+        self.assertEquals(self.buffer.getValue(), "")
+
+    def test_read_across_chunks(self):
+        for chunk in ("ABC", "DEF", "GHI", "JKL"):
+            self.buffer.addData(chunk)
+        self.assertEquals(self.buffer.read(2), "AB")
+        self.assertEquals(self.buffer.read(5), "CDEFG")
+        self.assertEquals(self.buffer.read(1), "H")
+        self.assertEquals(self.buffer.read(100), "IJKL")
+        self.assertEquals(self.buffer.length, 0)
+        self.assertEquals(self.buffer.read(), "")
+        self.assert_(not self.buffer.has_data())
+
+    def test_read_line_across_chunks(self):
+        self.buffer.addData("FIR")
+        self.buffer.addData("ST\r")
+        self.assertEquals(self.buffer.readline(), None)
+        self.buffer.addData("\nSEC")
+        self.buffer.addData("")
+        self.assertEquals(self.buffer.readline(), 'FIRST')
+        self.assertEquals(self.buffer.readline(), None)
+        self.buffer.addData("OND\n\nTHIRD")
+        self.assertEquals(self.buffer.readline(), 'SECOND')
+        self.assertEquals(self.buffer.readline(), '')
+        self.assertEquals(self.buffer.readline(), None)
+        self.assertEquals(self.buffer.length, 5)
+        # unread data that contains a newline after readline() has already
+        # scanned the buffer
+        self.buffer.unread("ZERO\n")
+        self.assertEquals(self.buffer.readline(), 'ZERO')
+        self.assertEquals(self.buffer.read(), 'THIRD')
+
+    def test_unread_after_partial_read(self):
+        self.buffer.addData("ABCDEF")
+        self.assertEquals(self.buffer.read(3), "ABC")
+        self.buffer.unread("XY")
+        self.assertEquals(self.buffer.length, 5)
+        self.assertEquals(self.buffer.read(), "XYDEF")
+
+    def test_readinto(self):
+        self.buffer.addData("1234")
+        self.buffer.addData("5678")
+        self.buffer.addData("90")
+        buf = bytearray(5)
+        self.assertEquals(self.buffer.readinto(buf), 5)
+        self.assertEquals(str(buf), "12345")
+        self.assertEquals(self.buffer.length, 5)
+        buf = bytearray(10)
+        self.assertEquals(self.buffer.readinto(buf), 5)
+        self.assertEquals(str(buf[:5]), "67890")
+        self.assertEquals(self.buffer.length, 0)
+        self.assertEquals(self.buffer.readinto(buf), 0)
+
+    def test_readinto_after_partial_read(self):
+        self.buffer.addData("ABCDEFG")
+        self.buffer.addData("HIJ")
+        self.assertEquals(self.buffer.read(2), "AB")
+        buf = bytearray("------")
+        self.assertEquals(self.buffer.readinto(buf), 6)
+        self.assertEquals(str(buf), "CDEFGH")
+        self.assertEquals(self.buffer.read(), "IJ")
 
 
 class WeirdCloseConnectionTest(AsyncSocketTest):
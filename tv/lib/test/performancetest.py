@@ -2,13 +2,30 @@ import shutil
 import os
 import pstats
 import cProfile
+import copy
+import cPickle
+import random
+import string
+import struct
+import sys
+import time
 
 from miro import app
+from miro import iteminfocache
+from miro import libdaap
+from miro import itemsource
 from miro import messagehandler
 from miro import messages
 from miro import models
+from miro import net
+from miro import search
+from miro.dl_daemon import command
+from miro.dl_daemon import download
+from miro.dl_daemon import protocol
 from miro.fileobject import FilenameType
-from miro.test.framework import EventLoopTest
+from miro.item import FeedParserValues
+from miro.singleclick import _build_entry
+from miro.test.framework import EventLoopTest, MiroTestCase
 from miro.test import messagetest
 
 class PerformanceTest(EventLoopTest):
@@ -66,3 +83,378 @@ class PerformanceTest(EventLoopTest):
     def track_item_count(self):
         messages.TrackNewVideoCount().send_to_backend()
         self.runUrgentCalls()
+
+    def test_query_with_many_objects_loaded(self):
+        # load all of our items, then run a bunch of small queries.  The cost
+        # of each query should depend on the number of results, not the
+        # number of objects in memory.
+        self.loaded_items = list(models.Item.make_view())
+        self._run_test("self.query_small_views()")
+
+    def query_small_views(self):
+        for item in self.loaded_items[:1000]:
+            list(models.Item.make_view('id=?', (item.id,)))
+
+class SearchIndexPerformanceTest(MiroTestCase):
+    # Compare the memory use and search speed of the N-gram index backends
+    # for ItemSearcher.
+    ITEM_COUNT = 20000
+
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        rand = random.Random(12345)
+        words = [u''.join(rand.choice(string.ascii_lowercase)
+            for i in xrange(rand.randint(3, 10))) for j in xrange(5000)]
+        self.searches = [words[0], words[1][:3], words[2][1:],
+                u'%s -%s' % (words[3], words[4]), u'%s %s' % (words[5][:3],
+                    words[6][:3]), u'xyzzy']
+        self.infos = []
+        for id_ in xrange(self.ITEM_COUNT):
+            terms = [rand.choice(words) for i in xrange(20)]
+            self.infos.append(FakeSearchInfo(id_, terms))
+
+    def _index_size(self, searcher):
+        # rough estimate of the memory used by the index containers
+        seen = set()
+        def size_of(obj):
+            if id(obj) in seen:
+                return 0
+            seen.add(id(obj))
+            total = sys.getsizeof(obj)
+            if isinstance(obj, dict):
+                for key, value in obj.iteritems():
+                    total += size_of(key) + size_of(value)
+            elif isinstance(obj, (list, tuple, set, frozenset)):
+                for value in obj:
+                    total += size_of(value)
+            return total
+        return sum(size_of(value)
+                for value in searcher._index.__dict__.values())
+
+    def _benchmark(self, index_class):
+        start = time.time()
+        searcher = search.ItemSearcher(index_class)
+        for info in self.infos:
+            searcher.add_item(info)
+        build_time = time.time() - start
+        start = time.time()
+        results = {}
+        for x in xrange(20):
+            for search_text in self.searches:
+                results[search_text] = searcher.search(search_text)
+        search_time = time.time() - start
+        print '%s: build %.2fs, 120 searches %.3fs, ~%.1f MB' % (
+                index_class.__name__, build_time, search_time,
+                self._index_size(searcher) / (1024.0 * 1024.0))
+        return results
+
+    def test_index_backends(self):
+        set_results = self._benchmark(search.SetNgramIndex)
+        array_results = self._benchmark(search.ArrayNgramIndex)
+        self.assertEquals(set_results, array_results)
+
+    def _ngram_list_matches(self, search_text):
+        # list_matches() the way we used to do it, by calculating the
+        # N-grams for each item.
+        parsed_search = search._get_boolean_search(search_text)
+        positive_set = set()
+        negative_set = set()
+        for term in parsed_search.positive_terms:
+            positive_set |= set(search._ngrams_for_term(term))
+        for term in parsed_search.negative_terms:
+            negative_set |= set(search._ngrams_for_term(term))
+        for info in self.infos:
+            item_ngrams = set(search._ngrams_for_item(info))
+            if (positive_set.issubset(item_ngrams) and
+                    negative_set.isdisjoint(item_ngrams)):
+                yield info
+
+    def _benchmark_list_matches(self, name, matcher):
+        start = time.time()
+        results = {}
+        for search_text in self.searches:
+            results[search_text] = set(info.id
+                    for info in matcher(search_text))
+        print '%s: %d searches %.3fs' % (name, len(self.searches),
+                time.time() - start)
+        return results
+
+    def test_list_matches(self):
+        ngram_results = self._benchmark_list_matches('N-gram list_matches',
+                self._ngram_list_matches)
+        results = self._benchmark_list_matches('list_matches',
+                lambda text: search.list_matches(self.infos, text))
+        self.assertEquals(results, ngram_results)
+        self.assertEquals(results, self._benchmark(search.SetNgramIndex))
+
+class FakeSearchInfo(object):
+    """Minimal ItemInfo replacement for SearchIndexPerformanceTest."""
+    def __init__(self, id_, search_terms):
+        self.id = id_
+        self.search_terms = search_terms
+
+class ItemInfoCodecPerformanceTest(MiroTestCase):
+    # Compare how fast the ItemInfoCache codecs save and load ItemInfos.
+    INFO_COUNT = 20000
+
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        feed = models.Feed(u'dtv:manualFeed')
+        entry = _build_entry(u'http://example.com/', 'video/x-unknown',
+                {'title': u'my item', 'description': u'<p>%s</p>' % (
+                    u'some description text ' * 20)})
+        item = models.Item(FeedParserValues(entry), feed_id=feed.id)
+        template = itemsource.DatabaseItemSource._item_info_for(item)
+        self.infos = []
+        for id_ in xrange(self.INFO_COUNT):
+            info = copy.copy(template)
+            info.id = id_
+            info.name = u'item %s' % id_
+            self.infos.append(info)
+
+    def _benchmark(self, codec):
+        start = time.time()
+        blobs = [codec.info_to_blob(info) for info in self.infos]
+        save_time = time.time() - start
+        start = time.time()
+        stats_blobs = [codec.stats_to_blob(info) for info in self.infos]
+        stats_time = time.time() - start
+        start = time.time()
+        interned = {}
+        loaded = [codec.blob_to_info(blob, stats_blob, interned)
+                for blob, stats_blob in zip(blobs, stats_blobs)]
+        load_time = time.time() - start
+        # PackedInfoCodec doesn't decode descriptions until they're used.
+        # Time using all of them, which is the worst case for it.
+        start = time.time()
+        for info in loaded:
+            info.description_stripped
+        description_time = time.time() - start
+        size = sum(len(blob) for blob in blobs)
+        stats_size = sum(len(blob) for blob in stats_blobs if blob)
+        print ('%s: save %.2fs, stats %.2fs, load %.2fs, descriptions '
+                '%.2fs, %.1f MB (stats %.1f MB)' % (codec.name, save_time,
+                    stats_time, load_time, description_time,
+                    size / (1024.0 * 1024.0),
+                    stats_size / (1024.0 * 1024.0)))
+
+    def test_codecs(self):
+        self._benchmark(iteminfocache.PickleInfoCodec())
+        self._benchmark(iteminfocache.PackedInfoCodec())
+
+class NetworkBufferPerformanceTest(MiroTestCase):
+    # Read large downloader daemon style commands out of a NetworkBuffer
+    # that is fed in socket sized chunks.
+    COMMAND_SIZES = [1024 * 1024, 4 * 1024 * 1024, 8 * 1024 * 1024]
+    CHUNK_SIZE = 4096
+
+    def _benchmark(self, command_size):
+        payload = 'x' * command_size
+        raw = struct.pack("I", len(payload)) + payload
+        chunks = [raw[i:i+self.CHUNK_SIZE]
+                for i in xrange(0, len(raw), self.CHUNK_SIZE)]
+        buf = net.NetworkBuffer()
+        start = time.time()
+        for chunk in chunks:
+            buf.addData(chunk)
+            # the daemon checks the length after every chunk, but only
+            # reads once the whole command is there
+            if buf.length >= 4 + command_size:
+                (size,) = struct.unpack("I", buf.read(4))
+                data = buf.read(size)
+        read_time = time.time() - start
+        self.assertEquals(len(data), command_size)
+        start = time.time()
+        for chunk in chunks:
+            buf.addData(chunk)
+        while buf.has_data():
+            buf.read(1024)
+        small_read_time = time.time() - start
+        print '%.1f MB command: %.3fs, 1 KB reads: %.3fs (%.1f MB/s)' % (
+                command_size / (1024.0 * 1024.0), read_time, small_read_time,
+                command_size / (1024.0 * 1024.0) / max(small_read_time, 1e-6))
+
+    def test_throughput(self):
+        for size in self.COMMAND_SIZES:
+            self._benchmark(size)
+
+class DaemonProtocolPerformanceTest(MiroTestCase):
+    # Compare pickling BatchUpdateDownloadStatus commands with the framed
+    # delta encoding in dl_daemon.protocol.
+    DOWNLOAD_COUNT = 300
+    UPDATE_COUNT = 100
+
+    def make_status(self, i, update):
+        return {'dlid': u'dl%d' % i,
+                'url': u'http://example.com/%d.torrent' % i,
+                'state': u'downloading',
+                'totalSize': 1000000000,
+                'currentSize': update * 1000 + i,
+                'eta': 1000 - update,
+                'rate': 1234.5 + update,
+                'uploaded': update * 10,
+                'filename': '/home/user/Movies/Incomplete/%d.avi.part' % i,
+                'startTime': 1234.5,
+                'endTime': 1234.5,
+                'shortFilename': '%d.avi' % i,
+                'reasonFailed': u'No Error',
+                'shortReasonFailed': u'No Error',
+                'dlerType': 'BitTorrent',
+                'retryTime': None,
+                'retryCount': -1,
+                'channelName': u'My Channel',
+                'upRate': 2.5,
+                'activity': None,
+                'seeders': 4,
+                'leechers': update % 3,
+                'connections': 10,
+                'info_hash': 'a' * 40}
+
+    def _benchmark(self, name, encode, decode):
+        commands = [command.BatchUpdateDownloadStatus(None,
+            [self.make_status(i, update)
+                for i in xrange(self.DOWNLOAD_COUNT)], False)
+            for update in xrange(self.UPDATE_COUNT)]
+        encode_time = decode_time = 0
+        size = 0
+        for comm in commands:
+            start = time.time()
+            data = encode(comm)
+            encode_time += time.time() - start
+            size += len(data)
+            start = time.time()
+            decode(data)
+            decode_time += time.time() - start
+        print '%s: encode %.3fs, decode %.3fs, %d bytes per update' % (
+                name, encode_time, decode_time, size / self.UPDATE_COUNT)
+
+    def test_status_updates(self):
+        self._benchmark('pickle',
+                lambda comm: cPickle.dumps(comm, cPickle.HIGHEST_PROTOCOL),
+                cPickle.loads)
+        self._benchmark('framed', protocol.CommandEncoder().encode,
+                protocol.CommandDecoder().decode)
+
+class DaapListingPerformanceTest(MiroTestCase):
+    # Encode and decode a DAAP item listing the size of a large shared
+    # library.
+    ITEM_COUNT = 50000
+    META = ['dmap.itemid', 'dmap.itemname', 'dmap.containeritemid',
+            'daap.songtime', 'daap.songsize', 'daap.songformat',
+            'daap.songalbumartist', 'com.apple.itunes.mediakind']
+
+    def make_item(self, i):
+        return {'dmap.itemid': i,
+                'dmap.itemname': 'Track number %d' % i,
+                'dmap.containeritemid': i,
+                'daap.songtime': 180000 + i,
+                'daap.songsize': 5000000 + i,
+                'daap.songformat': 'mp3',
+                'daap.songalbumartist': 'Some Artist',
+                'com.apple.itunes.mediakind': 1}
+
+    def test_listing(self):
+        items = [self.make_item(i) for i in xrange(self.ITEM_COUNT)]
+        start = time.time()
+        fragments = [libdaap.encode_item(item, self.META) for item in items]
+        fragment_time = time.time() - start
+        start = time.time()
+        reply = [('adbs', [('mstt', 200),
+                           ('mtco', self.ITEM_COUNT),
+                           ('mrco', self.ITEM_COUNT),
+                           ('mlcl', fragments)])]
+        data = str(libdaap.encode_response(reply))
+        encode_time = time.time() - start
+        start = time.time()
+        listing, deleted = libdaap.decode_listing(data, self.META)
+        decode_time = time.time() - start
+        self.assertEquals(len(listing), self.ITEM_COUNT)
+        start = time.time()
+        libdaap.decode_response(data)
+        full_decode_time = time.time() - start
+        print ('%d items (%.1f MB): encode items %.3fs, reply %.3fs, '
+               'decode listing %.3fs, full decode %.3fs' % (
+                self.ITEM_COUNT, len(data) / (1024.0 * 1024.0),
+                fragment_time, encode_time, decode_time, full_decode_time))
+
+class FakeTorrentStatus(object):
+    def __init__(self, handle, update):
+        self.handle = handle
+        self.state = None
+        self.total_wanted = 1000000000
+        self.total_wanted_done = update * 1000
+        self.download_payload_rate = 1000 + update
+        self.upload_payload_rate = 100
+        self.total_payload_upload = update * 100
+        self.num_complete = 4
+        self.num_incomplete = 2
+        self.num_connections = 10
+
+class FakeTorrentHandle(object):
+    def __init__(self, i):
+        self._info_hash = '%040x' % i
+        self.update = 0
+
+    def info_hash(self):
+        return self._info_hash
+
+    def has_metadata(self):
+        return True
+
+    def status(self):
+        return FakeTorrentStatus(self, self.update)
+
+class TorrentStatusPerformanceTest(MiroTestCase):
+    # Update the status of a large number of torrents, most of them idle.
+    # Compare polling every torrent with handling the statuses from a
+    # libtorrent state update, which only has the ones that changed.
+    TORRENT_COUNT = 500
+    ACTIVE_COUNT = 10
+    UPDATE_COUNT = 60
+
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.session = download.TorrentSession()
+        self.downloaders = []
+        for i in xrange(self.TORRENT_COUNT):
+            downloader = download.BTDownloader(restore={
+                'dlid': u'dl%d' % i,
+                'url': u'http://example.com/%d.torrent' % i,
+                'state': u'paused',
+                'uploaded': 0,
+                })
+            downloader.state = u'uploading'
+            downloader.torrent = FakeTorrentHandle(i)
+            self.session.add_torrent(downloader)
+            self.downloaders.append(downloader)
+        self.session.new_torrents = set()
+
+    def tearDown(self):
+        download.DOWNLOAD_UPDATER.to_update = set()
+        MiroTestCase.tearDown(self)
+
+    def _benchmark(self, name, update):
+        download.DOWNLOAD_UPDATER.to_update = set()
+        queued = 0
+        start = time.time()
+        for i in xrange(self.UPDATE_COUNT):
+            for downloader in self.downloaders[:self.ACTIVE_COUNT]:
+                downloader.torrent.update += 1
+            update()
+            queued += len(download.DOWNLOAD_UPDATER.to_update)
+            download.DOWNLOAD_UPDATER.to_update = set()
+        elapsed = time.time() - start
+        print '%s: %.3fs, %.4fs per update, %d statuses queued per update' % (
+                name, elapsed, elapsed / self.UPDATE_COUNT,
+                queued / self.UPDATE_COUNT)
+        return queued / self.UPDATE_COUNT
+
+    def test_status_updates(self):
+        self.assertEquals(self._benchmark('polling',
+            self.session.update_torrents), self.TORRENT_COUNT)
+        # stands in for the statuses from a state_update_alert
+        def state_update():
+            self.session.update_statuses([downloader.torrent.status()
+                for downloader in self.downloaders[:self.ACTIVE_COUNT]])
+        self.assertEquals(self._benchmark('state updates', state_update),
+                self.ACTIVE_COUNT)
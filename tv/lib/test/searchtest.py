@@ -1,4 +1,5 @@
 import gc
+from array import array
 
 from miro import messages
 from miro import models
@@ -99,9 +100,11 @@ class SearchTest(MiroTestCase):
                 ['veryb', 'erybi', 'rybig'])
 
 class ItemSearcherTest(MiroTestCase):
+    index_class = search.SetNgramIndex
+
     def setUp(self):
         MiroTestCase.setUp(self)
-        self.searcher = search.ItemSearcher()
+        self.searcher = search.ItemSearcher(self.index_class)
         self.feed = models.Feed(u'http://example.com/')
         self.item1 = self.make_item(u'http://example.com/', u'my first item')
         self.item2 = self.make_item(u'http://example.com/', u'my second item')
@@ -141,6 +144,34 @@ class ItemSearcherTest(MiroTestCase):
         self.check_search_results('my', self.item1)
         self.check_empty_result('second')
 
+    def test_negative_terms(self):
+        self.check_search_results('my -first', self.item2)
+        self.check_empty_result('-item')
+        self.check_search_results('-miro', self.item1, self.item2)
+
+class ArrayItemSearcherTest(ItemSearcherTest):
+    # run the same tests using the compact N-gram index
+    index_class = search.ArrayNgramIndex
+
+    def test_intersect_sorted(self):
+        large = array('i', range(0, 1000, 3))
+        small = array('i', [0, 5, 6, 500, 501, 999, 2000])
+        self.assertEquals(list(search._intersect_sorted(small, large)),
+                [0, 6, 501, 999])
+        self.assertEquals(list(search._intersect_sorted(array('i'), large)),
+                [])
+
+    def test_add_out_of_order(self):
+        # adding an item with a lower id than the others should keep the
+        # posting lists sorted
+        self.searcher.remove_item(self.item1.id)
+        self.searcher.remove_item(self.item2.id)
+        self.searcher.add_item(self.make_info(self.item2))
+        self.searcher.add_item(self.make_info(self.item1))
+        self.check_search_results('my', self.item1, self.item2)
+        self.check_search_results('second', self.item2)
+        self.check_search_results('my -second', self.item1)
+
 class SearchFilterTest(MiroTestCase):
     def setUp(self):
         MiroTestCase.setUp(self)
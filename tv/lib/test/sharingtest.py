@@ -0,0 +1,226 @@
+from miro import app
+from miro import config
+from miro import libdaap
+from miro import sharing
+from miro.test.framework import MiroTestCase
+
+META = ['dmap.itemid', 'dmap.itemname', 'com.apple.itunes.mediakind']
+
+class DaapEncodeTest(MiroTestCase):
+    def test_round_trip(self):
+        reply = [('adbs', [('mstt', 200),
+                           ('mlcl', [('mlit', [('miid', 5),
+                                               ('minm', 'foo')])]),
+                           ('mudl', [('miid', 3)])])]
+        data = str(libdaap.encode_response(reply))
+        self.assertEquals(libdaap.decode_response(data), reply)
+
+    def test_fragments(self):
+        item = {'dmap.itemid': 5, 'dmap.itemname': 'foo',
+                'daap.songformat': None}
+        fragment = libdaap.encode_item(item, ['dmap.itemname',
+                                              'daap.songformat',
+                                              'dmap.itemid'])
+        self.assert_(isinstance(fragment, libdaap.EncodedFragment))
+        reply = [('adbs', [('mlcl', [fragment, fragment]),
+                           ('mstt', 200)])]
+        data = str(libdaap.encode_response(reply))
+        # mikd always comes first, then the requested meta in order.
+        mlit = ('mlit', [('mikd', libdaap.DAAP_ITEMKIND_AUDIO),
+                         ('minm', 'foo'), ('miid', 5)])
+        self.assertEquals(libdaap.decode_response(data),
+                          [('adbs', [('mlcl', [mlit, mlit]),
+                                     ('mstt', 200)])])
+
+    def test_unicode_string(self):
+        data = str(libdaap.encode_response([('minm', u'caf\xe9')]))
+        self.assertEquals(libdaap.decode_response(data),
+                          [('minm', 'caf\xc3\xa9')])
+
+    def test_malformed(self):
+        data = str(libdaap.encode_response([('mlcl', [('miid', 5)])]))
+        self.assertEquals(libdaap.decode_response(data[:-1]), [(-1, [])])
+        self.assertEquals(libdaap.decode_response('junk' + data),
+                          [(-1, [])])
+
+    def test_lazy_decode(self):
+        data = str(libdaap.encode_response([('mlcl', [('miid', 5)]),
+                                            ('mstt', 200)]))
+        decoded = list(libdaap.iter_decode(data, lazy=True))
+        self.assertEquals(decoded[0][0], 'mlcl')
+        self.assert_(isinstance(decoded[0][1], libdaap.DmapContainer))
+        self.assertEquals(list(decoded[0][1]), [('miid', 5)])
+        self.assertEquals(decoded[1], ('mstt', 200))
+
+    def test_decode_listing(self):
+        reply = [('adbs', [('mstt', 200),
+                           ('mlcl', [('mlit', [('miid', 5),
+                                               ('minm', 'foo')]),
+                                     ('mlit', [('miid', 6)])]),
+                           ('mudl', [('miid', 3), ('miid', 4)])])]
+        data = str(libdaap.encode_response(reply))
+        listing, deleted = libdaap.decode_listing(data, ['dmap.itemname',
+                                                         'bogus'])
+        self.assertEquals(listing, {5: {'dmap.itemname': 'foo'},
+                                    6: {'dmap.itemname': None}})
+        self.assertEquals(deleted, [3, 4])
+        self.assertEquals(libdaap.decode_listing(data[:-2], []),
+                          ({}, []))
+
+class SharingBackendListingTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        app.backend_config_watcher = config.ConfigWatcher(
+            lambda func, *args: func(*args))
+        self.backend = sharing.SharingManagerBackend()
+        self.backend.share_types = [
+            sharing.SharingManagerBackend.SHARE_AUDIO]
+        for i in range(3):
+            self.add_item(i)
+
+    def tearDown(self):
+        app.backend_config_watcher = None
+        MiroTestCase.tearDown(self)
+
+    def add_item(self, item_id, name='item'):
+        # This is what make_item_dict() would build, cut down to what the
+        # listing cares about.
+        self.backend.daapitems[item_id] = {
+            'dmap.itemid': item_id,
+            'dmap.itemname': name,
+            'com.apple.itunes.mediakind': libdaap.DAAP_MEDIAKIND_AUDIO,
+            'org.participatoryculture.miro.itemkind': None,
+            'revision': self.backend.revision,
+            'valid': True,
+        }
+        self.backend.forget_item_fragments(item_id)
+
+    def decode_listing(self, listing):
+        revision, count, encoded, deleted = listing
+        items = libdaap.decode_response(encoded)
+        self.assertEquals(len(items), count)
+        return dict((dict(value)['miid'], dict(value)['minm'])
+                    for tag, value in items)
+
+    def test_listing(self):
+        listing = self.backend.get_item_listing(None, META, 0)
+        self.assertEquals(listing[0], self.backend.revision)
+        self.assertEquals(self.decode_listing(listing),
+                          {0: 'item', 1: 'item', 2: 'item'})
+        self.assertEquals(listing[3], [])
+
+    def test_cached_until_revision_changes(self):
+        listing = self.backend.get_item_listing(None, META, 0)
+        self.assert_(self.backend.get_item_listing(None, META, 0) is listing)
+        with self.backend.item_lock:
+            self.backend.update_revision()
+            self.add_item(1, 'changed')
+            self.backend.daapitems[2] = self.backend.deleted_item()
+        new_listing = self.backend.get_item_listing(None, META, 0)
+        self.assertEquals(new_listing[0], self.backend.revision)
+        self.assertEquals(self.decode_listing(new_listing),
+                          {0: 'item', 1: 'changed'})
+        self.assertEquals(new_listing[3], [2])
+
+    def test_delta(self):
+        old_revision = self.backend.revision
+        with self.backend.item_lock:
+            self.backend.update_revision()
+            self.add_item(1, 'changed')
+        listing = self.backend.get_item_listing(None, META, old_revision)
+        self.assertEquals(self.decode_listing(listing), {1: 'changed'})
+
+    def test_fragments_reused(self):
+        self.backend.get_item_listing(None, META, 0)
+        fragments = self.backend.item_fragments[tuple(META)]
+        fragment = fragments[0]
+        with self.backend.item_lock:
+            self.backend.update_revision()
+            self.add_item(1, 'changed')
+        self.assertFalse(1 in fragments)
+        self.backend.get_item_listing(None, META, 0)
+        self.assert_(fragments[0] is fragment)
+
+    def test_playlist(self):
+        self.backend.playlist_item_map[10] = [0, 2]
+        listing = self.backend.get_item_listing(10, META, 0)
+        self.assertEquals(self.decode_listing(listing),
+                          {0: 'item', 2: 'item'})
+        self.assertEquals(listing[3], [1])
+        # Unknown playlists are empty
+        listing = self.backend.get_item_listing(11, META, 0)
+        self.assertEquals(listing[1:], (0, '', []))
+
+class FakeClient(object):
+    def __init__(self, db_id=1, db_persistent_id=1234, revision=10,
+                 supports_update=True):
+        self.db_id = db_id
+        self.db_persistent_id = db_persistent_id
+        self.revision = revision
+        self.supports_update = supports_update
+
+class SharingCatalogTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.path = self.make_temp_path('.catalog')
+        self.catalog = sharing.SharingCatalog(self.path)
+        self.catalog.db_id = 1
+        self.catalog.db_persistent_id = 1234
+        self.catalog.revision = 5
+        self.catalog.base_playlist = 100
+        self.catalog.update_playlists({100: {'dmap.itemname': 'Library'},
+                                       101: {'dmap.itemname': 'pl'}}, [])
+        self.catalog.update_items(100, {1: {'dmap.itemid': 1},
+                                        2: {'dmap.itemid': 2}}, [])
+        self.catalog.update_items(101, {1: {'dmap.itemid': 1}}, [])
+
+    def test_save_load(self):
+        self.catalog.save()
+        catalog = sharing.SharingCatalog(self.path)
+        self.assert_(catalog.load())
+        for name in sharing.SharingCatalog.FIELDS:
+            self.assertEquals(getattr(catalog, name),
+                              getattr(self.catalog, name))
+
+    def test_load_missing_or_corrupt(self):
+        catalog = sharing.SharingCatalog(self.path)
+        self.assertFalse(catalog.load())
+        f = open(self.path, 'wb')
+        f.write('garbage')
+        f.close()
+        self.assertFalse(catalog.load())
+        self.assertEquals(catalog.items, {})
+
+    def test_can_resume(self):
+        self.assert_(self.catalog.can_resume(FakeClient()))
+        # Server restarted: new persistent id.
+        self.assertFalse(self.catalog.can_resume(
+            FakeClient(db_persistent_id=5678)))
+        self.assertFalse(self.catalog.can_resume(FakeClient(db_id=2)))
+        # Revision went backwards
+        self.assertFalse(self.catalog.can_resume(FakeClient(revision=4)))
+        self.assertFalse(self.catalog.can_resume(
+            FakeClient(supports_update=False)))
+        self.catalog.revision = None
+        self.assertFalse(self.catalog.can_resume(FakeClient()))
+
+    def test_updates(self):
+        self.catalog.update_items(100, {3: {'dmap.itemid': 3}}, [1])
+        self.catalog.update_items(101, {2: {}}, [1])
+        self.assertEquals(sorted(self.catalog.items.keys()), [2, 3])
+        self.assertEquals(self.catalog.playlist_items[101], set([2]))
+        self.catalog.update_playlists({102: {'dmap.itemname': 'new'}},
+                                      [101])
+        self.assertEquals(sorted(self.catalog.playlists.keys()), [100, 102])
+        self.assertFalse(101 in self.catalog.playlist_items)
+
+class DaapClientRevisionTest(MiroTestCase):
+    def test_resume(self):
+        client = libdaap.make_daap_client('localhost')
+        client.supports_update = True
+        client.revision = 20
+        self.assertEquals(client.revision_query(True),
+                          [('revision-number', 20), ('delta', 1)])
+        client.resume(15)
+        self.assertEquals(client.revision_query(True),
+                          [('revision-number', 20), ('delta', 15)])
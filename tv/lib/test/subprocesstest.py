@@ -1,3 +1,4 @@
+import logging
 import os
 import time
 import Queue
@@ -6,7 +7,7 @@ from miro import app
 from miro import subprocessmanager
 from miro import workerprocess
 from miro.plat import resources
-from miro.test.framework import EventLoopTest
+from miro.test.framework import EventLoopTest, MiroTestCase
 
 # setup some test messages/handlers
 class TestSubprocessHandler(subprocessmanager.SubprocessHandler):
@@ -207,10 +208,15 @@ class WorkerProcessTest(EventLoopTest):
     def setUp(self):
         EventLoopTest.setUp(self)
         # override the normal handler class with our own
-        workerprocess._subprocess_manager.handler_class = (
-                UnittestWorkerProcessHandler)
+        self.old_handler_class = workerprocess._handler_class
+        workerprocess._handler_class = UnittestWorkerProcessHandler
         self.result = self.error = None
 
+    def tearDown(self):
+        EventLoopTest.tearDown(self)
+        workerprocess._handler_class = self.old_handler_class
+        workerprocess._task_queue.reset()
+
     def callback(self, result):
         self.result = result
         self.stopEventLoop(abnormal=False)
@@ -252,16 +258,32 @@ class WorkerProcessTest(EventLoopTest):
 
     def test_crash(self):
         # force a crash of our subprocess right after we send the task
-        workerprocess.startup()
-        original_pid = workerprocess._subprocess_manager.process.pid
+        workerprocess.startup(worker_count=1)
+        manager = workerprocess._subprocess_managers[0]
+        original_pid = manager.process.pid
         self.send_feedparser_task()
-        workerprocess._subprocess_manager.process.terminate()
+        manager.process.terminate()
         self.runEventLoop(4.0)
         # check that we really restarted the subprocess
-        self.assertNotEqual(original_pid,
-                workerprocess._subprocess_manager.process.pid)
+        self.assertNotEqual(original_pid, manager.process.pid)
         self.check_successful_result()
 
+    def test_crash_with_pool(self):
+        # crash the worker that our task was sent to, while the other worker
+        # keeps running
+        workerprocess.startup(worker_count=2)
+        self.send_feedparser_task()
+        load = workerprocess._task_queue.worker_load()
+        self.assertEquals(sorted(load), [0, 1])
+        crashed = workerprocess._subprocess_managers[load.index(1)]
+        other = workerprocess._subprocess_managers[load.index(0)]
+        other_pid = other.process.pid
+        crashed.process.terminate()
+        self.runEventLoop(4.0)
+        self.check_successful_result()
+        self.assertEquals(other.process.pid, other_pid)
+        self.assertEquals(workerprocess._task_queue.worker_load(), [0, 0])
+
     def test_queue_before_start(self):
         # test sending tasks before we start the worker process
 
@@ -271,3 +293,106 @@ class WorkerProcessTest(EventLoopTest):
         workerprocess.startup()
         self.runEventLoop(4.0)
         self.check_successful_result()
+
+class FakeWorker(object):
+    def __init__(self):
+        self.is_running = True
+        self.sent = []
+
+    def send_message(self, msg):
+        self.sent.append(msg)
+
+class TaskQueueTest(MiroTestCase):
+    """Test how TaskQueue dispatches tasks to the worker processes."""
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.queue = workerprocess.TaskQueue()
+        self.workers = [FakeWorker(), FakeWorker()]
+        self.results = []
+        self.errors = []
+
+    def add_metadata_task(self):
+        msg = workerprocess.MediaMetadataExtractorTask('/tmp/foo', None)
+        self.queue.add_task(msg, self.results.append, self.errors.append)
+        return msg
+
+    def add_feedparser_task(self):
+        msg = workerprocess.FeedparserTask('<rss />')
+        self.queue.add_task(msg, self.results.append, self.errors.append)
+        return msg
+
+    def send_result(self, worker_index, msg, result):
+        self.queue.process_result(workerprocess.TaskResult(msg.task_id,
+            result), worker_index)
+
+    def test_queue_before_workers(self):
+        msg = self.add_metadata_task()
+        self.queue.set_workers(self.workers)
+        self.assertEquals(self.workers[0].sent + self.workers[1].sent, [msg])
+
+    def test_least_loaded(self):
+        self.queue.set_workers(self.workers)
+        tasks = [self.add_metadata_task() for i in xrange(3)]
+        self.assertEquals(self.queue.worker_load(), [2, 1])
+        self.assertEquals(self.workers[1].sent, [tasks[1]])
+        self.send_result(1, tasks[1], 'result')
+        self.assertEquals(self.results, ['result'])
+        # the next task should go to worker 1, since it has the least load
+        self.assertEquals(self.queue.worker_load(), [2, 0])
+        task = self.add_metadata_task()
+        self.assertEquals(self.queue.worker_load(), [2, 1])
+        self.assertEquals(self.workers[1].sent[-1], task)
+
+    def test_max_tasks(self):
+        self.queue.set_workers(self.workers)
+        tasks = [self.add_metadata_task() for i in xrange(10)]
+        max_tasks = self.queue.MAX_TASKS_PER_WORKER
+        self.assertEquals(self.queue.worker_load(), [max_tasks, max_tasks])
+        sent = self.workers[0].sent + self.workers[1].sent
+        self.assertEquals(len(sent), max_tasks * 2)
+        self.assertEquals(set(sent), set(tasks[:max_tasks * 2]))
+
+    def test_feedparser_priority(self):
+        self.queue.set_workers(self.workers)
+        for i in xrange(10):
+            self.add_metadata_task()
+        feed_task = self.add_feedparser_task()
+        first_task = self.workers[0].sent[0]
+        self.send_result(0, first_task, 'result')
+        # the feedparser task should jump ahead of the metadata tasks
+        self.assertEquals(self.workers[0].sent[-1], feed_task)
+
+    def test_errback(self):
+        self.queue.set_workers(self.workers)
+        task = self.add_metadata_task()
+        error = ValueError()
+        self.send_result(0, task, error)
+        self.assertEquals(self.errors, [error])
+        self.assertEquals(self.results, [])
+
+    def test_worker_restart(self):
+        self.queue.set_workers(self.workers)
+        tasks = [self.add_metadata_task() for i in xrange(6)]
+        worker_0_tasks = list(self.workers[0].sent)
+        # simulate worker 0 crashing.  Its tasks stay assigned to it until
+        # the process restarts, so when worker 1 has room it gets the next
+        # task from the queue.
+        self.workers[0].is_running = False
+        self.workers[0].sent = []
+        self.send_result(1, self.workers[1].sent[0], 'result')
+        self.assertEquals(self.workers[1].sent[-1], tasks[4])
+        for task in worker_0_tasks:
+            self.assert_(task not in self.workers[1].sent)
+        self.assertEquals(self.queue.worker_load(), [2, 2])
+        # when worker 0 restarts, it should get its old tasks back first
+        self.workers[0].is_running = True
+        self.queue.run_pending_tasks(0)
+        self.assertEquals(self.workers[0].sent, worker_0_tasks)
+        self.assertEquals(self.queue.worker_load(), [2, 2])
+
+    def test_unknown_result(self):
+        self.queue.set_workers(self.workers)
+        self.send_result(0, workerprocess.FeedparserTask(''), 'result')
+        self.assertEquals(self.results, [])
+        self.log_filter.check_record_count(1)
+        self.log_filter.check_record_level(logging.WARN)
@@ -5,6 +5,7 @@ The code here is based off of the standard SimpleHTTPServer code.
 
 
 import BaseHTTPServer
+import SocketServer
 import hashlib
 import cgi
 import os
@@ -55,7 +56,8 @@ class MiroHTTPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
                 if self.start_pos > 0:
                     f.seek(self.start_pos, os.SEEK_CUR)
                 if self.end_pos > 0:
-                    count = self.end_pos - self.start_pos
+                    # the end of the range is inclusive
+                    count = self.end_pos - max(self.start_pos, 0) + 1
                 else:
                     count = -1
                 data = f.read(count)
@@ -211,7 +213,9 @@ class MiroHTTPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         else:
             code = 200
             path = self.translate_path(self.path)
-        if 'range' in self.headers and self.server.allow_resume:
+        # ranges only apply to the actual content, not redirects or errors
+        if ('range' in self.headers and self.server.allow_resume and
+                code == 200):
             range = self.headers['range']
             if range.startswith("bytes="):
                 byte_range = range[len('bytes='):]
@@ -234,7 +238,7 @@ class MiroHTTPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         fs = os.fstat(f.fileno())
         length = fs[6]
         if self.end_pos > 0:
-            length = min(self.end_pos, length)
+            length = min(self.end_pos + 1, length)
         if self.start_pos > 0:
             length -= self.start_pos
         if 'content-length' not in self.server.headers_to_send:
@@ -285,10 +289,20 @@ class MiroHTTPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     def log_error(self, *args):
         pass
 
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn,
+        BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
 class HTTPServer(threading.Thread):
-    def __init__(self):
+    def __init__(self, threaded=False):
+        """Create a HTTPServer.
+
+        :param threaded: if True, handle each connection in its own thread.
+            Use this for tests that make several connections at once.
+        """
         threading.Thread.__init__(self)
         self.event = threading.Event()
+        self.threaded = threaded
 
     def start(self):
         threading.Thread.start(self)
@@ -306,7 +320,11 @@ class HTTPServer(threading.Thread):
         else:
             utils.finish_thread_loop(self)
             raise AssertionError("Can't find an open port")
-        self.httpserver = BaseHTTPServer.HTTPServer(('', self.port),
+        if self.threaded:
+            server_class = ThreadingHTTPServer
+        else:
+            server_class = BaseHTTPServer.HTTPServer
+        self.httpserver = server_class(('', self.port),
                 MiroHTTPRequestHandler)
         self.httpserver.allow_head = True
         self.httpserver.headers_to_send = []
@@ -684,6 +684,58 @@ class MatrixTest(unittest.TestCase):
         self.assertEquals(m[0,0], 1)
         self.assertEquals(m[0,1], None)
 
+class LengthCache(util.Cache):
+    """Cache that weighs values by their length."""
+    def __init__(self, size):
+        util.Cache.__init__(self, size)
+        self.created = []
+
+    def create_new_value(self, key):
+        self.created.append(key)
+        return key * 2
+
+    def get_weight(self, value):
+        return len(value)
+
+class CacheTest(unittest.TestCase):
+    def test_lru(self):
+        cache = LengthCache(6)
+        for key in ('a', 'b', 'c'):
+            cache.get(key)
+        cache.get('a')
+        cache.get('d')
+        # 'b' is least recently used, so it should be dropped
+        self.assertEquals(cache.keys(), ['c', 'a', 'd'])
+        self.assertEquals(cache.total_weight, 6)
+        self.assertEquals(cache.get('c'), 'cc')
+        self.assertEquals(cache.created, ['a', 'b', 'c', 'd'])
+        self.assertEquals((cache.hits, cache.misses), (2, 4))
+
+    def test_weight(self):
+        cache = LengthCache(8)
+        cache.get('a')
+        cache.get('b')
+        cache.get('ccc')
+        self.assertEquals(cache.keys(), ['b', 'ccc'])
+        self.assertEquals(cache.total_weight, 8)
+        # values bigger than the cache still get stored by themselves
+        cache.get('ddddd')
+        self.assertEquals(cache.keys(), ['ddddd'])
+        self.assertEquals(cache.total_weight, 10)
+
+    def test_remove(self):
+        cache = LengthCache(100)
+        for key in ('a', 'b', 'ab'):
+            cache.get(key)
+        cache.remove_matching(lambda key: key.startswith('a'))
+        self.assertEquals(cache.keys(), ['b'])
+        self.assertEquals(cache.total_weight, 2)
+        cache.remove('b')
+        cache.remove('b')
+        self.assertEquals(cache.total_weight, 0)
+        cache.get('a')
+        self.assertEquals(cache.created, ['a', 'b', 'ab', 'a'])
+
 class TestGatherSubtitlesFiles(unittest.TestCase):
     def setUp(self):
         unittest.TestCase.setUp(self)
@@ -35,7 +35,6 @@ any other Miro modules.
 
 from hashlib import sha1 as sha
 from StringIO import StringIO
-import itertools
 import logging
 import os
 import random
@@ -1093,39 +1092,102 @@ class DebuggingTimer:
         logging.timing("total time: %0.3f", clock() - self.start_time)
 
 class Cache(object):
+    """Least-recently-used cache for values made by create_new_value().
+
+    Each value counts as 1 towards size by default.  Subclasses can override
+    get_weight() to count values by something else, like memory usage.
+    Getting, adding and evicting values are all constant time.
+    """
+    # Entries are stored as [prev, next, key, value, weight] lists that form
+    # a circular doubly linked list in least-recently-used order.
+    # (collections.OrderedDict would do this for us, but it's not available
+    # in python 2.6)
+    PREV, NEXT, KEY, VALUE, WEIGHT = range(5)
+
     def __init__(self, size):
         self.size = size
+        # maps keys to entries
         self.dict = {}
-        self.counter = itertools.count()
-        self.access_times = {}
+        # sentinel for the linked list, root[NEXT] is the least recently
+        # used entry and root[PREV] is the most recently used one.
+        self.root = []
+        self.root[:] = [self.root, self.root, None, None, 0]
+        self.total_weight = 0
+        self.hits = 0
+        self.misses = 0
 
     def get(self, key):
-        if key in self.dict:
-            self.access_times[key] = self.counter.next()
-            return self.dict[key]
-        else:
+        try:
+            entry = self.dict[key]
+        except KeyError:
+            self.misses += 1
             value = self.create_new_value(key)
             self.set(key, value)
             return value
+        else:
+            self.hits += 1
+            self._unlink(entry)
+            self._append(entry)
+            return entry[self.VALUE]
 
     def set(self, key, value):
-        if len(self.dict) == self.size:
-            self.shrink_size()
-        self.access_times[key] = self.counter.next()
-        self.dict[key] = value
+        self.remove(key)
+        weight = self.get_weight(value)
+        entry = [None, None, key, value, weight]
+        self._append(entry)
+        self.dict[key] = entry
+        self.total_weight += weight
+        self.shrink_size()
+
+    def remove(self, key):
+        """Remove a value from the cache, if it's there."""
+        try:
+            entry = self.dict.pop(key)
+        except KeyError:
+            return
+        self._unlink(entry)
+        self.total_weight -= entry[self.WEIGHT]
+
+    def remove_matching(self, predicate):
+        """Remove all values whose key matches predicate."""
+        for key in [k for k in self.dict if predicate(k)]:
+            self.remove(key)
+
+    def clear(self):
+        self.dict.clear()
+        self.root[:] = [self.root, self.root, None, None, 0]
+        self.total_weight = 0
+
+    def keys(self):
+        """Get the keys in the cache, least recently used first."""
+        keys = []
+        entry = self.root[self.NEXT]
+        while entry is not self.root:
+            keys.append(entry[self.KEY])
+            entry = entry[self.NEXT]
+        return keys
 
     def shrink_size(self):
-        # shrink by LRU
-        to_sort = self.access_times.items()
-        to_sort.sort(key=lambda m: m[1])
-        new_dict = {}
-        new_access_times = {}
-        latest_times = to_sort[len(self.dict) // 2:]
-        for (key, time) in latest_times:
-            new_dict[key] = self.dict[key]
-            new_access_times[key] = time
-        self.dict = new_dict
-        self.access_times = new_access_times
+        # drop least recently used values, but always keep the newest one,
+        # even if it's larger than size by itself
+        while self.total_weight > self.size and len(self.dict) > 1:
+            self.remove(self.root[self.NEXT][self.KEY])
+
+    def _append(self, entry):
+        last = self.root[self.PREV]
+        entry[self.PREV] = last
+        entry[self.NEXT] = self.root
+        last[self.NEXT] = entry
+        self.root[self.PREV] = entry
+
+    def _unlink(self, entry):
+        prev_entry = entry[self.PREV]
+        next_entry = entry[self.NEXT]
+        prev_entry[self.NEXT] = next_entry
+        next_entry[self.PREV] = prev_entry
+
+    def get_weight(self, value):
+        return 1
 
     def create_new_value(self, val):
         raise NotImplementedError()
@@ -0,0 +1,468 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2005, 2006, 2007, 2008, 2009, 2010, 2011
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+"""viewpredicate.py -- Evaluate View WHERE clauses against DDBObjects.
+
+ViewTrackers need to know if a single object is part of their view every time
+that object changes.  Asking SQLite means a query per tracker per change.
+This module compiles the subset of SQL that our views use into python
+functions that check the DDBObjects we already have in memory.
+
+We handle AND/OR/NOT, comparisons, IS [NOT] NULL, [NOT] IN with a literal
+list, [NOT] LIKE, string/number literals and "?" placeholders.  Joins are
+supported if they join on the id of the joined table (for example
+``item.feed_id=feed.id``).  Anything else raises UnsupportedSQL and the
+caller should fall back to querying the database.
+
+Evaluation follows SQL's three-valued logic: None is used for NULL and only
+a result of True means the object is in the view.
+"""
+
+import datetime
+import re
+
+from miro import app
+
+class UnsupportedSQL(ValueError):
+    """Raised when we can't compile a WHERE clause."""
+    pass
+
+class NeedsSQL(Exception):
+    """Raised when we can't evaluate a predicate for a specific object.
+
+    This happens when a joined object isn't loaded into memory.
+    """
+    pass
+
+_token_re = re.compile(r"""
+    \s*(?:
+        (?P<string>'(?:[^']|'')*') |
+        (?P<number>\d+(?:\.\d+)?) |
+        (?P<name>[A-Za-z_][A-Za-z0-9_]*(?:\.[A-Za-z_][A-Za-z0-9_]*)?) |
+        (?P<op>==|!=|<>|<=|>=|=|<|>|\(|\)|,|\?)
+    )""", re.VERBOSE)
+
+_keywords = frozenset(['and', 'or', 'not', 'is', 'null', 'in', 'like',
+    'as', 'select'])
+
+def _tokenize(sql):
+    tokens = []
+    pos = 0
+    sql = sql.rstrip()
+    while pos < len(sql):
+        m = _token_re.match(sql, pos)
+        if m is None:
+            raise UnsupportedSQL("can't parse %r at %d" % (sql, pos))
+        pos = m.end()
+        if m.group('string') is not None:
+            value = m.group('string')[1:-1].replace("''", "'")
+            tokens.append(('literal', unicode(value)))
+        elif m.group('number') is not None:
+            text = m.group('number')
+            if '.' in text:
+                tokens.append(('literal', float(text)))
+            else:
+                tokens.append(('literal', int(text)))
+        elif m.group('name') is not None:
+            name = m.group('name')
+            if name.lower() in _keywords:
+                tokens.append(('keyword', name.lower()))
+            else:
+                tokens.append(('name', name))
+        else:
+            tokens.append(('op', m.group('op')))
+    return tokens
+
+# SQL NULL handling.  None means NULL and every operator that gets a NULL
+# input returns NULL, except for AND/OR which short-circuit.
+
+def _sql_truth(value):
+    """Convert a SQL value to True, False or None (NULL)."""
+    if value is None:
+        return None
+    if isinstance(value, basestring):
+        # sqlite converts strings to numbers in a boolean context
+        m = re.match(r'\s*[-+]?(\d+(\.\d*)?|\.\d+)', value)
+        return m is not None and float(m.group(0)) != 0
+    if isinstance(value, (datetime.datetime, datetime.timedelta)):
+        # stored as text that starts with a non-zero number
+        return True
+    return bool(value)
+
+def _and(left, right):
+    def evaluate(context):
+        lhs = left(context)
+        if lhs is False:
+            return False
+        rhs = right(context)
+        if rhs is False:
+            return False
+        if lhs is None or rhs is None:
+            return None
+        return True
+    return evaluate
+
+def _or(left, right):
+    def evaluate(context):
+        lhs = left(context)
+        if lhs is True:
+            return True
+        rhs = right(context)
+        if rhs is True:
+            return True
+        if lhs is None or rhs is None:
+            return None
+        return False
+    return evaluate
+
+def _not(operand):
+    def evaluate(context):
+        value = operand(context)
+        if value is None:
+            return None
+        return not value
+    return evaluate
+
+def _truth(operand):
+    return lambda context: _sql_truth(operand(context))
+
+_comparisons = {
+    '=': lambda a, b: a == b,
+    '==': lambda a, b: a == b,
+    '!=': lambda a, b: a != b,
+    '<>': lambda a, b: a != b,
+    '<': lambda a, b: a < b,
+    '<=': lambda a, b: a <= b,
+    '>': lambda a, b: a > b,
+    '>=': lambda a, b: a >= b,
+}
+
+def _compare(op, left, right):
+    func = _comparisons[op]
+    def evaluate(context):
+        lhs = left(context)
+        rhs = right(context)
+        if lhs is None or rhs is None:
+            return None
+        try:
+            return func(lhs, rhs)
+        except TypeError:
+            # sqlite can compare values that python can't
+            raise NeedsSQL("can't compare %r and %r" % (lhs, rhs))
+    return evaluate
+
+def _is_null(operand, negate):
+    def evaluate(context):
+        return (operand(context) is None) != negate
+    return evaluate
+
+def _in(operand, choices, negate):
+    def evaluate(context):
+        value = operand(context)
+        if value is None:
+            return None
+        values = [c(context) for c in choices]
+        if value in values:
+            return not negate
+        if None in values:
+            return None
+        return negate
+    return evaluate
+
+def _like_regex(pattern):
+    parts = []
+    for char in pattern:
+        if char == '%':
+            parts.append('.*')
+        elif char == '_':
+            parts.append('.')
+        else:
+            parts.append(re.escape(char))
+    # sqlite's LIKE is case-insensitive for ASCII characters
+    return re.compile(''.join(parts) + r'\Z', re.IGNORECASE | re.DOTALL)
+
+def _like(operand, pattern, negate):
+    cache = {}
+    def evaluate(context):
+        value = operand(context)
+        pattern_value = pattern(context)
+        if value is None or pattern_value is None:
+            return None
+        try:
+            regex = cache[pattern_value]
+        except KeyError:
+            regex = cache[pattern_value] = _like_regex(
+                    unicode(pattern_value))
+        return (regex.match(unicode(value)) is not None) != negate
+    return evaluate
+
+def _literal(value):
+    return lambda context: value
+
+def _placeholder(index):
+    return lambda context: context.values[index]
+
+def _column(alias, name):
+    def evaluate(context):
+        obj = context.objects[alias]
+        if obj is None:
+            # LEFT JOIN that didn't match anything
+            return None
+        try:
+            return getattr(obj, name)
+        except AttributeError:
+            raise NeedsSQL("%s has no attribute %s" % (obj, name))
+    return evaluate
+
+class _Parser(object):
+    """Recursive descent parser that turns SQL into python functions.
+
+    Each function takes an _EvaluationContext and returns True, False, None
+    or a value.
+    """
+    def __init__(self, sql, resolve_column):
+        self.tokens = _tokenize(sql)
+        self.pos = 0
+        self.placeholder_count = 0
+        self.resolve_column = resolve_column
+
+    def parse(self):
+        result = self.parse_or()
+        if self.pos != len(self.tokens):
+            raise UnsupportedSQL("unexpected token: %r" % (self.peek(),))
+        return result
+
+    def peek(self):
+        try:
+            return self.tokens[self.pos]
+        except IndexError:
+            return (None, None)
+
+    def accept(self, kind, value=None):
+        token_kind, token_value = self.peek()
+        if token_kind == kind and (value is None or token_value == value):
+            self.pos += 1
+            return token_value
+        return None
+
+    def expect(self, kind, value=None):
+        token_value = self.accept(kind, value)
+        if token_value is None:
+            raise UnsupportedSQL("expected %s %s got %r" % (kind, value,
+                self.peek()))
+        return token_value
+
+    def parse_or(self):
+        result = self.parse_and()
+        while self.accept('keyword', 'or'):
+            result = _or(_truth(result), _truth(self.parse_and()))
+        return result
+
+    def parse_and(self):
+        result = self.parse_not()
+        while self.accept('keyword', 'and'):
+            result = _and(_truth(result), _truth(self.parse_not()))
+        return result
+
+    def parse_not(self):
+        if self.accept('keyword', 'not'):
+            return _not(_truth(self.parse_not()))
+        return self.parse_predicate()
+
+    def parse_predicate(self):
+        operand = self.parse_operand()
+        op = self.accept('op')
+        if op is not None:
+            if op not in _comparisons:
+                self.pos -= 1
+                return operand
+            return _compare(op, operand, self.parse_operand())
+        if self.accept('keyword', 'is'):
+            negate = bool(self.accept('keyword', 'not'))
+            self.expect('keyword', 'null')
+            return _is_null(operand, negate)
+        negate = bool(self.accept('keyword', 'not'))
+        if self.accept('keyword', 'in'):
+            return _in(operand, self.parse_operand_list(), negate)
+        if self.accept('keyword', 'like'):
+            return _like(operand, self.parse_operand(), negate)
+        if negate:
+            raise UnsupportedSQL("unexpected NOT")
+        return operand
+
+    def parse_operand_list(self):
+        self.expect('op', '(')
+        choices = [self.parse_operand()]
+        while self.accept('op', ','):
+            choices.append(self.parse_operand())
+        self.expect('op', ')')
+        return choices
+
+    def parse_operand(self):
+        kind, value = self.peek()
+        if kind == 'literal':
+            self.pos += 1
+            return _literal(value)
+        elif kind == 'name':
+            self.pos += 1
+            return _column(*self.resolve_column(value))
+        elif kind == 'keyword' and value == 'null':
+            self.pos += 1
+            return _literal(None)
+        elif kind == 'op' and value == '?':
+            self.pos += 1
+            self.placeholder_count += 1
+            return _placeholder(self.placeholder_count - 1)
+        elif kind == 'op' and value == '(':
+            self.pos += 1
+            result = self.parse_or()
+            self.expect('op', ')')
+            return result
+        raise UnsupportedSQL("unexpected token: %r" % ((kind, value),))
+
+class _EvaluationContext(object):
+    __slots__ = ('objects', 'values')
+
+    def __init__(self, objects, values):
+        self.objects = objects
+        self.values = values
+
+class ViewPredicate(object):
+    """Python version of a View's WHERE clause.
+
+    Use compile_predicate() to create these.
+    """
+    def __init__(self, table_name, where, joins):
+        self.table_name = table_name
+        # list of (alias, table_name, foreign key column) for each join
+        self.joins = []
+        # maps aliases to the columns we can check in memory
+        self._alias_columns = {
+            table_name: app.db.comparable_columns(table_name)
+        }
+        self._all_columns = {
+            table_name: app.db.table_columns(table_name)
+        }
+        if joins is not None:
+            for join_table, join_where in joins.items():
+                self._parse_join(join_table, join_where)
+        if where:
+            parser = _Parser(where, self._resolve_column)
+            self._evaluate = _truth(parser.parse())
+            self.placeholder_count = parser.placeholder_count
+        else:
+            self._evaluate = lambda context: True
+            self.placeholder_count = 0
+
+    def _parse_join(self, join_table, join_where):
+        parts = join_table.split()
+        if len(parts) == 1:
+            join_table_name = alias = parts[0]
+        elif len(parts) == 2:
+            join_table_name, alias = parts
+        elif len(parts) == 3 and parts[1].lower() == 'as':
+            join_table_name, alias = parts[0], parts[2]
+        else:
+            raise UnsupportedSQL("can't parse join: %r" % join_table)
+        try:
+            self._alias_columns[alias] = app.db.comparable_columns(
+                    join_table_name)
+            self._all_columns[alias] = app.db.table_columns(
+                    join_table_name)
+        except KeyError:
+            raise UnsupportedSQL("unknown table: %s" % join_table_name)
+
+        # The only joins we handle look like "item.feed_id=feed.id"
+        tokens = _tokenize(join_where)
+        if (len(tokens) != 3 or tokens[1] not in (('op', '='), ('op', '=='))
+                or tokens[0][0] != 'name' or tokens[2][0] != 'name'):
+            raise UnsupportedSQL("can't handle join: %r" % join_where)
+        sides = [self._split_column(tokens[0][1], alias),
+                 self._split_column(tokens[2][1], alias)]
+        if sides[1] == (alias, 'id'):
+            sides.reverse()
+        if sides[0] != (alias, 'id') or sides[1][0] != self.table_name:
+            raise UnsupportedSQL("can't handle join: %r" % join_where)
+        self.joins.append((alias, join_table_name, sides[1][1]))
+
+    def _split_column(self, name, join_alias):
+        if '.' in name:
+            return tuple(name.split('.'))
+        elif name in self._all_columns[self.table_name]:
+            return (self.table_name, name)
+        else:
+            return (join_alias, name)
+
+    def _resolve_column(self, name):
+        if '.' in name:
+            alias, column = name.split('.')
+            if alias not in self._all_columns:
+                raise UnsupportedSQL("unknown table: %s" % alias)
+        else:
+            column = name
+            # unqualified names refer to whatever table has that column
+            matches = [a for a, columns in self._all_columns.items()
+                    if column in columns]
+            if self.table_name in matches:
+                alias = self.table_name
+            elif len(matches) == 1:
+                alias = matches[0]
+            else:
+                raise UnsupportedSQL("can't resolve column: %s" % name)
+        if column not in self._alias_columns[alias]:
+            raise UnsupportedSQL("can't check %s in memory" % name)
+        return alias, column
+
+    def matches(self, obj, values):
+        """Check if a DDBObject matches our WHERE clause.
+
+        :param obj: DDBObject from our table
+        :param values: values to use for placeholders
+        :raises NeedsSQL: we can't check obj without querying the database
+        """
+        objects = {self.table_name: obj}
+        for alias, join_table_name, column in self.joins:
+            join_id = getattr(obj, column)
+            if join_id is None:
+                objects[alias] = None
+                continue
+            try:
+                objects[alias] = app.db.get_obj_by_table(join_id,
+                        join_table_name)
+            except KeyError:
+                raise NeedsSQL("%s %s not loaded" % (join_table_name,
+                    join_id))
+        return self._evaluate(_EvaluationContext(objects, values)) is True
+
+def compile_predicate(table_name, where, joins=None):
+    """Get a ViewPredicate for a view.
+
+    :raises UnsupportedSQL: if we can't check where in memory
+    """
+    return ViewPredicate(table_name, where, joins)
@@ -27,16 +27,21 @@
 # this exception statement from your version. If you delete this exception
 # statement from all source files in the program, then also delete it here.
 
-"""```workerprocess.py``` -- Miro worker subprocess
+"""```workerprocess.py``` -- Miro worker subprocesses
 
 To avoid UI freezing due to the GIL, we farm out all CPU-intensive backend
-tasks to this process.  See #17328 for more details.  Right now this just
-includes feedparser, but we could pretty easily extend this to other tasks.
+tasks to a pool of worker processes.  See #17328 for more details.  Right now
+this includes feedparser and the media metadata extractor, but we could pretty
+easily extend this to other tasks.
 """
 
+import collections
 import itertools
+import logging
 
+from miro import app
 from miro import feedparserutil
+from miro import prefs
 from miro import subprocessmanager
 from miro import util
 
@@ -46,12 +51,18 @@ from miro.plat import utils
 
 class TaskMessage(subprocessmanager.SubprocessMessage):
     _id_counter = itertools.count()
+    # Tasks with lower priority values get sent to the workers first
+    priority = 10
 
     def __init__(self):
         subprocessmanager.SubprocessMessage.__init__(self)
         self.task_id = TaskMessage._id_counter.next()
 
 class FeedparserTask(TaskMessage):
+    # Feed updates are user visible, don't make them wait behind a big batch
+    # of metadata extraction.
+    priority = 0
+
     def __init__(self, html):
         TaskMessage.__init__(self)
         self.html = html
@@ -90,54 +101,173 @@ class WorkerProcessHandler(subprocessmanager.SubprocessHandler):
         return utils.run_media_metadata_extractor(filename, thumbnail)
 
 class WorkerProcessResponder(subprocessmanager.SubprocessResponder):
+    def __init__(self, worker_index):
+        subprocessmanager.SubprocessResponder.__init__(self)
+        self.worker_index = worker_index
+
     def on_startup(self):
-        _task_queue.run_pending_tasks()
+        _task_queue.run_pending_tasks(self.worker_index)
 
     def handle_task_result(self, msg):
-        _task_queue.process_result(msg)
+        _task_queue.process_result(msg, self.worker_index)
 
 # Manage task queue
 
 class TaskQueue(object):
+    """Queues tasks and dispatches them to the worker processes.
+
+    Tasks wait in a queue for their task type until a worker has room for
+    them.  We only send MAX_TASKS_PER_WORKER tasks to a worker at once, the
+    rest stay here so that high priority tasks can skip ahead of them.
+    """
+
+    # Sending a couple of tasks at once keeps the worker from sitting idle
+    # while its result makes the round trip through our event loop.
+    MAX_TASKS_PER_WORKER = 2
+
     def __init__(self):
-        # maps task_ids to (msg, callback, errback) tuples
-        self.tasks_in_progress = {}
+        self.reset()
 
     def reset(self):
+        # maps task_ids to (msg, callback, errback) tuples for all tasks that
+        # haven't finished, whether they've been sent to a worker or not
         self.tasks_in_progress = {}
+        # maps task classes to deques of task ids that we haven't sent yet
+        self.queues = {}
+        # SubprocessManager for each worker process
+        self.workers = []
+        # set of task ids that we've sent to each worker
+        self.worker_tasks = []
+
+    def set_workers(self, workers):
+        """Change the worker processes that we send tasks to.
+
+        Any tasks that we sent to the old workers, but didn't get a result
+        for will be requeued.
+        """
+        for task_ids in self.worker_tasks:
+            self._requeue(task_ids)
+        self.workers = list(workers)
+        self.worker_tasks = [set() for worker in self.workers]
+        self._dispatch()
 
     def add_task(self, msg, callback, errback):
         """Add a new task to the queue."""
         self.tasks_in_progress[msg.task_id] = (msg, callback, errback)
-        if _subprocess_manager.is_running:
-            msg.send_to_process()
+        self._queue_for_task(msg).append(msg.task_id)
+        self._dispatch()
 
-    def process_result(self, reply):
-        """Process a TaskResult from our subprocess."""
-        msg, callback, errback = self.tasks_in_progress.pop(reply.task_id)
+    def process_result(self, reply, worker_index):
+        """Process a TaskResult from one of our subprocesses."""
+        self.worker_tasks[worker_index].discard(reply.task_id)
+        try:
+            msg, callback, errback = self.tasks_in_progress.pop(
+                    reply.task_id)
+        except KeyError:
+            logging.warn("Got result for unknown task: %s", reply.task_id)
+            return
+        # keep the worker busy while we run the callback
+        self._dispatch()
         if isinstance(reply.result, Exception):
             errback(reply.result)
         else:
             callback(reply.result)
 
-    def run_pending_tasks(self):
-        """Rerun all tasks in the queue."""
-        for msg, callback, errback in self.tasks_in_progress.values():
-            msg.send_to_process()
+    def run_pending_tasks(self, worker_index):
+        """Called when a worker process (re)starts.
+
+        Tasks that we sent to the previous process for this worker get
+        requeued, since we will never get a result for them.  Then we send
+        out as many tasks as we can.
+        """
+        self._requeue(self.worker_tasks[worker_index])
+        self.worker_tasks[worker_index] = set()
+        self._dispatch()
+
+    def worker_load(self):
+        """Get the number of tasks sent to each worker."""
+        return [len(task_ids) for task_ids in self.worker_tasks]
+
+    def _queue_for_task(self, msg):
+        try:
+            return self.queues[msg.__class__]
+        except KeyError:
+            queue = self.queues[msg.__class__] = collections.deque()
+            return queue
+
+    def _requeue(self, task_ids):
+        # put the tasks back at the front of their queues, in the order that
+        # they were added.
+        for task_id in sorted(task_ids, reverse=True):
+            if task_id in self.tasks_in_progress:
+                msg = self.tasks_in_progress[task_id][0]
+                self._queue_for_task(msg).appendleft(task_id)
+
+    def _next_task(self):
+        best_queue = None
+        for task_class, queue in self.queues.iteritems():
+            if queue and (best_queue is None or
+                    task_class.priority < best_queue[0].priority):
+                best_queue = (task_class, queue)
+        if best_queue is None:
+            return None
+        return best_queue[1].popleft()
+
+    def _least_loaded_worker(self):
+        best_index = None
+        best_load = self.MAX_TASKS_PER_WORKER
+        for index, worker in enumerate(self.workers):
+            load = len(self.worker_tasks[index])
+            if worker.is_running and load < best_load:
+                best_index = index
+                best_load = load
+        return best_index
+
+    def _dispatch(self):
+        """Send queued tasks to workers that have room for them."""
+        while True:
+            worker_index = self._least_loaded_worker()
+            if worker_index is None:
+                return
+            task_id = self._next_task()
+            if task_id is None:
+                return
+            self.worker_tasks[worker_index].add(task_id)
+            msg = self.tasks_in_progress[task_id][0]
+            self.workers[worker_index].send_message(msg)
 
 _task_queue = TaskQueue()
 
-# Manage subprocess
-_subprocess_manager = subprocessmanager.SubprocessManager(TaskMessage,
-        WorkerProcessResponder(), WorkerProcessHandler)
+# Manage subprocesses
+_handler_class = WorkerProcessHandler
+_subprocess_managers = []
+
+def startup(worker_count=None):
+    """Startup the worker processes.
 
-def startup():
-    """Startup the worker process."""
-    _subprocess_manager.start()
+    :param worker_count: number of processes to start.  If None we use the
+        WORKER_PROCESS_COUNT pref.
+    """
+    global _subprocess_managers
+    if _subprocess_managers:
+        return
+    if worker_count is None:
+        worker_count = app.config.get(prefs.WORKER_PROCESS_COUNT)
+    worker_count = max(1, worker_count)
+    _subprocess_managers = [subprocessmanager.SubprocessManager(None,
+        WorkerProcessResponder(i), _handler_class)
+        for i in xrange(worker_count)]
+    _task_queue.set_workers(_subprocess_managers)
+    for manager in _subprocess_managers:
+        manager.start()
 
 def shutdown():
-    """Shutdown the worker process."""
-    _subprocess_manager.shutdown()
+    """Shutdown the worker processes."""
+    global _subprocess_managers
+    for manager in _subprocess_managers:
+        manager.shutdown()
+    _subprocess_managers = []
+    _task_queue.set_workers([])
 
 # API for sending tasks
 def run_media_metadata_extractor(filename, thumbnail, callback, errback):